@@ -0,0 +1,155 @@
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import awkward as ak
+import uproot
+from colorama import Fore, Style
+from hdumper import process_trees, read_csv, prepare_output, variant_selections
+from histogram_io import read_histograms
+from weights_and_constants import event_selections, fscore_definitions, leading_jet_definitions
+
+# Synthetic samples: an MC sample split into tt+jets components, a plain MC sample and collision data
+synthetic_samples = ["mc/ttbar-powheg_tree.root", "mc/ttW_tree.root", "data/singlemu_tree.root"]
+
+def synthetic_columns(n_events, hist_configs, year, rng):
+    """
+    Generate the columns read by the selections, the event weights, the event classification and the histograms, with realistic types:
+    float scores and weights, integer multiplicities and generator categories, boolean triggers and jagged jet kinematics.
+    The other branches of the histograms are uniform in the range of the histogram, with some overflow.
+    Return a dictionary {column : array}.
+
+    Parameters:
+    - n_events: Number of events.
+    - hist_configs: List of dictionaries with keys 'branch', 'nbins', 'xmin', 'xmax'.
+    - year: Data taking year.
+    - rng: NumPy random generator.
+    """
+    columns = dict()
+    # Scores summing to one, favouring tt_Wcb and disfavouring ttLF so that all the event classification categories are populated
+    scores = rng.dirichlet([2., 0.5, 0.5, 0.5, 0.5, 0.2], n_events).astype(np.float32)
+    for idx, process in enumerate(["tt_Wcb", "ttbb", "ttbj", "ttcc", "ttcj", "ttLF"]):
+        columns[f"score_{process}"] = scores[:, idx]
+
+    columns["n_ak4"] = rng.integers(3, 9, n_events).astype(np.int32)
+    columns["n_btagM"] = rng.integers(0, 4, n_events).astype(np.int32)
+    columns["n_ctagM"] = rng.integers(0, 3, n_events).astype(np.int32)
+    columns["genEventClassifier"] = rng.integers(0, 11, n_events).astype(np.int32)
+    columns["wcb"] = (rng.random(n_events) < 0.1).astype(np.int32)
+    columns["tt_category"] = rng.integers(0, 3, n_events).astype(np.int32)
+    columns["higgs_decay"] = (rng.random(n_events) < 0.1).astype(np.int32)
+    columns["year"] = np.full(n_events, year, dtype=np.int32)
+    columns["lep1_pdgId"] = rng.choice([-13, -11, 11, 13], n_events).astype(np.int32)
+    columns["lep1_eta"] = rng.uniform(-2.5, 2.5, n_events).astype(np.float32)
+    columns["lep1_phi"] = rng.uniform(-np.pi, np.pi, n_events).astype(np.float32)
+    for trigger in ["passTrigEl", "passTrigMu", "passmetfilters"]:
+        columns[trigger] = rng.random(n_events) < 0.8
+    for weight in ["lumiwgt", "genWeight", "xsecWeight", "l1PreFiringWeight", "puWeight", "muEffWeight", "elEffWeight", "flavTagWeight", "topptWeight"]:
+        columns[weight] = rng.uniform(0.5, 1.5, n_events).astype(np.float32)
+
+    # Jets, the number of which is given by n_ak4
+    n_jets = int(np.sum(columns["n_ak4"]))
+    for var, (low, high) in [("pt", (30., 300.)), ("eta", (-2.5, 2.5)), ("phi", (-np.pi, np.pi))]:
+        columns[f"ak4_{var}"] = ak.unflatten(rng.uniform(low, high, n_jets).astype(np.float32), columns["n_ak4"])
+
+    for hist_config in hist_configs:
+        branch_name = hist_config['branch']
+        if branch_name in columns or branch_name in fscore_definitions or branch_name in leading_jet_definitions:
+            continue
+        xmin, xmax = float(hist_config['xmin']), float(hist_config['xmax'])
+        columns[branch_name] = rng.uniform(xmin, xmax + 0.1 * (xmax - xmin), n_events).astype(np.float32)
+
+    return columns
+
+def write_synthetic_ntuples(ntuple_dir, tree_name, n_events, hist_configs, year, seed=1):
+    """
+    Write the synthetic samples with uproot. Return the list of input directories.
+
+    Parameters:
+    - ntuple_dir: Output directory of the synthetic samples.
+    - tree_name: Name of the TTree.
+    - n_events: Number of events per sample.
+    - hist_configs: List of dictionaries with keys 'branch', 'nbins', 'xmin', 'xmax'.
+    - year: Data taking year.
+    - seed: Seed of the random generator.
+    """
+    rng = np.random.default_rng(seed)
+    for sample in synthetic_samples:
+        output_file = os.path.join(ntuple_dir, sample)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        columns = synthetic_columns(n_events, hist_configs, year, rng)
+        with uproot.recreate(output_file) as root_file:
+            # A TTree (uproot writes an RNTuple by default), with the jagged columns as variable-size arrays
+            tree = root_file.mktree(tree_name, {column: values.dtype if isinstance(values, np.ndarray) else "var * float32" for column, values in columns.items()})
+            tree.extend(columns)
+        print(f"Synthetic sample with {n_events} events: {Fore.GREEN}{output_file}{Style.RESET_ALL}")
+
+    return sorted(set([os.path.join(ntuple_dir, os.path.dirname(sample), "") for sample in synthetic_samples]))
+
+def compare_histograms(reference_dir, other_dir, tolerance):
+    """
+    Compare the bin contents, the errors and the number of entries of the histograms in the output files of two directories.
+    Return the number of histograms compared and the list of differences.
+
+    Parameters:
+    - reference_dir: Directory with the reference output files.
+    - other_dir: Directory with the output files to compare.
+    - tolerance: Relative tolerance on the bin contents and errors.
+    """
+    compared = 0
+    differences = []
+    for reference_file in sorted(glob.glob(f"{reference_dir}**/h_*.root", recursive=True)):
+        other_file = os.path.join(other_dir, os.path.relpath(reference_file, reference_dir))
+        if not os.path.exists(other_file):
+            differences.append(f"{other_file} missing")
+            continue
+        other_histograms = read_histograms(other_file)
+        for hist_name, reference in read_histograms(reference_file).items():
+            if not reference.InheritsFrom("TH1"): # Only the one-dimensional histograms are compared
+                continue
+            other = other_histograms.get(hist_name)
+            compared += 1
+            if not other or not other.GetNbinsX() == reference.GetNbinsX():
+                differences.append(f"{other_file}:{hist_name} missing or with a different binning")
+                continue
+            for idx in range(reference.GetNbinsX() + 2):
+                for name, a, b in [("content", reference.GetBinContent(idx), other.GetBinContent(idx)), ("error", reference.GetBinError(idx), other.GetBinError(idx))]:
+                    if abs(a - b) > tolerance * max(1., abs(a)):
+                        differences.append(f"{other_file}:{hist_name} bin {idx} {name}: {a} != {b}")
+            if not reference.GetEntries() == other.GetEntries():
+                differences.append(f"{other_file}:{hist_name} entries: {reference.GetEntries()} != {other.GetEntries()}")
+
+    return compared, differences
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the RDataFrame and NumPy backends of hdumper.py on synthetic ntuples and compare their histograms.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Output directory of the synthetic ntuples and of the histograms of both backends.")
+    parser.add_argument("--input_csv", type=str, default="hconfig_scores.csv", required=False, help="The csv file to read variables and ranges from (hconfig_fscores.csv with --eventClassification).")
+    parser.add_argument("--n_events", type=int, default=200000, required=False, help="Number of events per synthetic sample.")
+    parser.add_argument("--year", type=int, default=2018, required=False, help="Data taking year.")
+    parser.add_argument("--eventClassification", nargs="?", const=1, type=bool, default=False, required=False, help="Apply event classification selection.")
+    parser.add_argument("--chunk_size", type=int, default=1000000, required=False, help="Number of entries read and processed at once by the NumPy backend.")
+    parser.add_argument("--tolerance", type=float, default=1e-9, required=False, help="Relative tolerance on the bin contents and errors.")
+
+    args = parser.parse_args()
+
+    hist_configs = read_csv(args.input_csv)
+    input_dirs = write_synthetic_ntuples(os.path.join(args.output_dir, "ntuples"), "Events", args.n_events, hist_configs, args.year)
+    input_files = [infile for input_dir in input_dirs for infile in sorted(glob.glob(f"{input_dir}*.root"))]
+    selections = variant_selections(event_selections, [], None)
+
+    # The RDataFrame backend runs single-threaded, so that the histograms are filled in the same order by both backends
+    timing = dict()
+    for backend in ["rdf", "numpy"]:
+        backend_dir = os.path.join(args.output_dir, backend, "")
+        output_files = prepare_output(backend_dir, input_files)
+        start = time.time()
+        process_trees(input_files, output_files, "Events", hist_configs, args.year, selections, args.eventClassification, False, backend=backend, chunk_size=args.chunk_size)
+        timing[backend] = time.time() - start
+
+    compared, differences = compare_histograms(os.path.join(args.output_dir, "rdf", ""), os.path.join(args.output_dir, "numpy", ""), args.tolerance)
+    for difference in differences[:20]:
+        print(f"{Fore.RED}{difference}{Style.RESET_ALL}")
+    print(f"{Fore.YELLOW}Compared {compared} histograms: {len(differences)} differences beyond a relative tolerance of {args.tolerance}.{Style.RESET_ALL}")
+    print(f"{Fore.YELLOW}Wall time for {len(input_files)} files of {args.n_events} events: RDataFrame {timing['rdf']:.2f} s, NumPy {timing['numpy']:.2f} s{Style.RESET_ALL}")
@@ -0,0 +1,325 @@
+import csv
+import fcntl
+import os
+import re
+
+# Comparison of two numeric literals, which can be evaluated before the event loop
+literal_comparison = re.compile(r"^\s*(-?\d+(?:\.\d*)?)\s*(==|!=|<=|>=|<|>)\s*(-?\d+(?:\.\d*)?)\s*$")
+comparisons = {
+    "==": lambda a, b: a == b, "!=": lambda a, b: a != b,
+    "<=": lambda a, b: a <= b, ">=": lambda a, b: a >= b,
+    "<":  lambda a, b: a < b,  ">":  lambda a, b: a > b
+}
+
+def split_top_level(expression, operator):
+    """
+    Split an expression at the occurrences of a logical operator ('&&' or '||') that are not nested in parentheses, brackets or braces.
+    Return the list of the (stripped) parts.
+
+    Parameters:
+    - expression: C++ expression.
+    - operator: '&&' or '||'.
+    """
+    parts = []
+    depth = 0
+    start = 0
+    idx = 0
+    while idx < len(expression):
+        char = expression[idx]
+        if char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+        elif depth == 0 and expression.startswith(operator, idx):
+            parts.append(expression[start:idx].strip())
+            idx += len(operator)
+            start = idx
+            continue
+        idx += 1
+    parts.append(expression[start:].strip())
+
+    return parts
+
+def enclosing_parentheses(expression):
+    """
+    Return True if the whole expression is enclosed in a pair of parentheses, e.g. "(a && b)" but not "(a) && (b)".
+
+    Parameters:
+    - expression: C++ expression, stripped.
+    """
+    if not (expression.startswith("(") and expression.endswith(")")):
+        return False
+    depth = 0
+    for idx, char in enumerate(expression):
+        if char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+        if depth == 0 and idx < len(expression) - 1:
+            return False
+
+    return True
+
+def parse(expression):
+    """
+    Parse the logical structure of an expression into a tree of tuples: ('or', [children]), ('and', [children]), ('not', child),
+    ('const', bool), and ('atom', text) for anything else. The parenthesized groups inside the atoms are parsed as well.
+
+    Parameters:
+    - expression: C++ expression.
+    """
+    expression = expression.strip()
+    while enclosing_parentheses(expression):
+        expression = expression[1:-1].strip()
+
+    # Ternary operators bind more loosely than the logical operators: keep the expression as a parenthesized atom if it has one outside parentheses.
+    # Ternary operators in parenthesized groups are kept as atoms when the groups are parsed.
+    if len(split_top_level(expression, "?")) > 1:
+        return ("atom", f"({expression})")
+
+    for operator, kind in [("||", "or"), ("&&", "and")]:
+        parts = split_top_level(expression, operator)
+        if len(parts) > 1:
+            return (kind, [parse(part) for part in parts if part])
+
+    if expression.startswith("!") and not expression.startswith("!=") and enclosing_parentheses(expression[1:].strip()):
+        return ("not", parse(expression[1:]))
+
+    if expression in ["true", "false"]:
+        return ("const", expression == "true")
+    match = literal_comparison.match(expression)
+    if match:
+        return ("const", comparisons[match.group(2)](float(match.group(1)), float(match.group(3))))
+
+    return ("atom", parse_groups(expression))
+
+def parse_groups(expression):
+    """
+    Fold the constants in the parenthesized groups of an atom, e.g. the boolean factor of a product of weights.
+    Return the atom with the simplified groups.
+
+    Parameters:
+    - expression: C++ expression with no top-level logical operator.
+    """
+    result = ""
+    depth = 0
+    start = 0
+    for idx, char in enumerate(expression):
+        if char == "(":
+            if depth == 0:
+                result += expression[start:idx + 1]
+                start = idx + 1
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                group = expression[start:idx]
+                # Function arguments (e.g. abs(x), or several comma-separated arguments) are left untouched
+                rendered = render(simplify(parse(group))) if group.strip() and not "," in group else group
+                result += rendered[1:-1] if enclosing_parentheses(rendered) else rendered # Already enclosed in the parentheses of the group
+                start = idx
+    result += expression[start:]
+
+    return result
+
+def simplify(node):
+    """
+    Simplify a parsed expression: constants are propagated through the logical operators and nested operators of the same kind are flattened.
+
+    Parameters:
+    - node: Parsed expression.
+    """
+    kind = node[0]
+    if kind == "not":
+        child = simplify(node[1])
+        return ("const", not child[1]) if child[0] == "const" else ("not", child)
+    if kind in ["and", "or"]:
+        # The neutral element is dropped, the absorbing element determines the result
+        neutral = kind == "and"
+        children = []
+        for child in [simplify(child) for child in node[1]]:
+            if child[0] == "const":
+                if child[1] == neutral:
+                    continue
+                return ("const", not neutral)
+            children += child[1] if child[0] == kind else [child]
+        if not children:
+            return ("const", neutral)
+        return children[0] if len(children) == 1 else (kind, children)
+
+    return node
+
+def render(node):
+    """
+    Render a parsed expression as a C++ expression.
+
+    Parameters:
+    - node: Parsed expression.
+    """
+    kind = node[0]
+    if kind == "const":
+        return "true" if node[1] else "false"
+    if kind == "atom":
+        return node[1]
+    if kind == "not":
+        return f"!({render(node[1])})"
+    operator = " && " if kind == "and" else " || "
+    # The children of a logical operator are parenthesized unless they are atoms or negations
+    return operator.join([render(child) if child[0] in ["atom", "not", "const"] else f"({render(child)})" for child in node[1]])
+
+def substitute_constants(expression, constants):
+    """
+    Replace the names of known constants (e.g. the data taking year) with their values.
+
+    Parameters:
+    - expression: C++ expression.
+    - constants: Dictionary {name : value}.
+    """
+    for name, value in constants.items():
+        expression = re.sub(rf"(?<![\w.:]){re.escape(name)}(?![\w(])", str(value), expression)
+
+    return expression
+
+def fold_constants(expression, constants):
+    """
+    Replace the known constants in an expression and evaluate the parts that only depend on them.
+
+    Parameters:
+    - expression: C++ expression.
+    - constants: Dictionary {name : value}.
+    """
+    return render(simplify(parse(substitute_constants(expression, constants))))
+
+def split_conjuncts(expression):
+    """
+    Split a selection into the conditions that must all be fulfilled. Empty conditions (e.g. from a leading ' && ') are dropped.
+
+    Parameters:
+    - expression: Selection.
+    """
+    node = simplify(parse(expression)) if expression.strip() else ("const", True)
+    if node[0] == "and":
+        return [render(child) if child[0] in ["atom", "not", "const"] else f"({render(child)})" for child in node[1]]
+    if node == ("const", True):
+        return []
+
+    return [render(node)]
+
+def conjunct_cost(conjunct):
+    """
+    Estimate the cost of evaluating a condition as the number of distinct names (columns or functions) it contains.
+
+    Parameters:
+    - conjunct: Condition.
+    """
+    return max(1, len(set(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", conjunct))))
+
+def order_conjuncts(conjuncts, pass_rates=None):
+    """
+    Order the conditions of a selection so that the most rejecting and cheapest ones are evaluated first, i.e. by increasing
+    cost / (1 - pass rate), which minimizes the expected cost of the selection for independent conditions.
+    Conditions with unknown pass rate keep their relative order, after the measured ones.
+
+    Parameters:
+    - conjuncts: List of conditions.
+    - pass_rates: Dictionary {condition : fraction of events passing it}, or None to keep the order.
+    """
+    if not pass_rates:
+        return list(conjuncts)
+
+    def rank(conjunct):
+        if not conjunct in pass_rates:
+            return float("inf")
+        rejection = 1. - pass_rates[conjunct]
+        return conjunct_cost(conjunct) / rejection if rejection > 0 else float("inf")
+
+    return sorted(conjuncts, key=rank)
+
+def optimize_conjuncts(expression, constants, pass_rates=None):
+    """
+    Fold the known constants of a selection and return its conditions, ordered by rejection power and cost.
+
+    Parameters:
+    - expression: Selection.
+    - constants: Dictionary {name : value}.
+    - pass_rates: Dictionary {condition : fraction of events passing it}, or None to keep the order.
+    """
+    return order_conjuncts(split_conjuncts(substitute_constants(expression, constants)), pass_rates)
+
+def optimize_selection(expression, constants, pass_rates=None):
+    """
+    Fold the known constants of a selection and order its conditions by rejection power.
+    Return the optimized selection, or "true" if no condition is left.
+
+    Parameters:
+    - expression: Selection.
+    - constants: Dictionary {name : value}.
+    - pass_rates: Dictionary {condition : fraction of events passing it}, or None to keep the order.
+    """
+    conjuncts = optimize_conjuncts(expression, constants, pass_rates)
+
+    return " && ".join(conjuncts) if conjuncts else "true"
+
+def chain_filters(df, conjuncts, kernel=None):
+    """
+    Apply the conditions of a selection as a chain of Filters, named after the conditions, in the given order.
+    Return the last node of the chain.
+
+    Parameters:
+    - df: RDataFrame node.
+    - conjuncts: List of conditions.
+    - kernel: Function (node, expression) -> expression passed to Filter (see kernels.py), or None to pass the conditions unchanged.
+    """
+    for conjunct in conjuncts:
+        df = df.Filter(kernel(df, conjunct) if kernel else conjunct, conjunct)
+
+    return df
+
+def read_pass_rates(pass_rates_file):
+    """
+    Read the pass rate of each condition from a csv file with columns 'conjunct' and 'pass_rate'.
+    Return a dictionary {condition : pass rate}.
+
+    Parameters:
+    - pass_rates_file: Input csv file.
+    """
+    with open(pass_rates_file, mode='r', newline='') as f:
+        return {row["conjunct"]: float(row["pass_rate"]) for row in csv.DictReader(f)}
+
+def update_pass_rates(pass_rates_file, counts):
+    """
+    Add measured event counts to the pass rates file, so that the measurements of all the samples and runs are combined.
+    The file lists the conditions in the learned order, i.e. the most rejecting and cheapest first, with columns
+    'conjunct', 'passed', 'total', 'pass_rate', 'cost'. The directory of the file is locked (with a single lock file per directory) while the file
+    is being updated by concurrent processes, and the temporary file is removed if the writing fails.
+
+    Parameters:
+    - pass_rates_file: csv file, created if it does not exist.
+    - counts: Dictionary {condition : [events passing it, events tested]}.
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(pass_rates_file)), ".pass_rates.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        tmp_file = f"{pass_rates_file}.{os.getpid()}.tmp"
+        try:
+            all_counts = dict()
+            if os.path.exists(pass_rates_file):
+                with open(pass_rates_file, mode='r', newline='') as f:
+                    all_counts = {row["conjunct"]: [int(row["passed"]), int(row["total"])] for row in csv.DictReader(f)}
+            for conjunct, (passed, total) in counts.items():
+                all_counts.setdefault(conjunct, [0, 0])
+                all_counts[conjunct][0] += passed
+                all_counts[conjunct][1] += total
+
+            pass_rates = {conjunct: passed / total for conjunct, (passed, total) in all_counts.items() if total > 0}
+            with open(tmp_file, mode='w', newline='') as f:
+                csv_writer = csv.writer(f)
+                csv_writer.writerow(["conjunct", "passed", "total", "pass_rate", "cost"])
+                for conjunct in order_conjuncts(list(all_counts.keys()), pass_rates):
+                    passed, total = all_counts[conjunct]
+                    csv_writer.writerow([conjunct, passed, total, passed / total if total > 0 else 1., conjunct_cost(conjunct)])
+            os.replace(tmp_file, pass_rates_file)
+        finally:
+            # Nothing is left behind if the writing failed
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            fcntl.flock(lock, fcntl.LOCK_UN)
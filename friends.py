@@ -0,0 +1,110 @@
+import ROOT
+import json
+import os
+from colorama import Fore, Style
+from weights_and_constants import fscore_definitions, leading_jet_definitions
+
+# Increase when the way the friend trees are written changes, to rebuild all of them
+FRIEND_VERSION = 1
+friend_tree_name = "Friends"
+
+def friend_definitions(weight):
+    """
+    Return the derived columns stored in the friend trees, as a dictionary {column : definition}.
+
+    Parameters:
+    - weight: Event weight expression, or None for collision data (no weight column is stored).
+    """
+    definitions = dict(fscore_definitions)
+    definitions.update(leading_jet_definitions)
+    if weight is not None:
+        definitions["event_weight"] = f"static_cast<double>({weight})"
+
+    return definitions
+
+def friend_path(infile, friend_dir=None):
+    """
+    Return the path of the friend file of an input file. By default, the friend files are stored in the friends/ subdirectory
+    of the input directory, so that they are not picked up as input files.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - friend_dir: Directory of the friend files, or None to store them next to the input file.
+    """
+    if friend_dir is None:
+        friend_dir = os.path.join(os.path.dirname(infile), "friends")
+
+    return os.path.join(friend_dir, os.path.basename(infile))
+
+def friend_stamp(input_file, tree_name, definitions):
+    """
+    Return the stamp of a friend tree: the friend is stale as soon as any of its fields changes.
+
+    Parameters:
+    - input_file: The opened input TFile.
+    - tree_name: Name of the TTree.
+    - definitions: Dictionary {column : definition} of the derived columns.
+    """
+    return {
+        "version": FRIEND_VERSION, "size": input_file.GetSize(), "date": input_file.GetModificationDate().Convert(),
+        "tree": tree_name, "definitions": definitions
+    }
+
+def build_friend(tree, friend_file, definitions, stamp):
+    """
+    Compute the derived columns for all the entries of a tree and write them to a friend tree.
+    The stamp is written next to the friend file as <friend>.json.
+
+    Parameters:
+    - tree: Input TTree.
+    - friend_file: Output ROOT file of the friend tree.
+    - definitions: Dictionary {column : definition} of the derived columns.
+    - stamp: Stamp of the friend tree.
+    """
+    print(f"{Fore.YELLOW}Building friend tree with {len(definitions)} derived columns: {friend_file}{Style.RESET_ALL}")
+    os.makedirs(os.path.dirname(friend_file), exist_ok=True)
+
+    # The entries of a friend tree must be in the same order as in the input tree, which a multithreaded Snapshot does not guarantee
+    threads = ROOT.ROOT.GetThreadPoolSize() if ROOT.ROOT.IsImplicitMTEnabled() else 0
+    ROOT.ROOT.DisableImplicitMT()
+
+    df = ROOT.RDataFrame(tree)
+    for column, definition in definitions.items():
+        df = df.Define(column, definition)
+    tmp_file = f"{friend_file}.{os.getpid()}.tmp"
+    df.Snapshot(friend_tree_name, tmp_file, list(definitions.keys()))
+    os.replace(tmp_file, friend_file)
+
+    if threads > 0:
+        ROOT.ROOT.EnableImplicitMT(threads)
+
+    with open(f"{friend_file}.json", "w") as f:
+        json.dump(stamp, f, indent=1)
+
+def attach_friend(input_file, tree, tree_name, definitions, friend_dir=None):
+    """
+    Attach the friend tree with the derived columns to a tree, building it first if it is missing or stale.
+    Return the list of columns provided by the friend tree.
+
+    Parameters:
+    - input_file: The opened input TFile.
+    - tree: Input TTree.
+    - tree_name: Name of the TTree.
+    - definitions: Dictionary {column : definition} of the derived columns.
+    - friend_dir: Directory of the friend files, or None to store them next to the input file.
+    """
+    friend_file = friend_path(input_file.GetName(), friend_dir)
+    stamp = friend_stamp(input_file, tree_name, definitions)
+
+    current_stamp = None
+    if os.path.exists(friend_file) and os.path.exists(f"{friend_file}.json"):
+        with open(f"{friend_file}.json") as f:
+            current_stamp = json.load(f)
+    if not current_stamp == stamp:
+        build_friend(tree, friend_file, definitions, stamp)
+    else:
+        print(f"Attaching friend tree: {Fore.GREEN}{friend_file}{Style.RESET_ALL}")
+
+    tree.AddFriend(friend_tree_name, friend_file)
+
+    return list(definitions.keys())
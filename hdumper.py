@@ -5,13 +5,31 @@ import csv
 import os
 import sys
 from colorama import Fore, Style 
+import itertools
+import time
 import numpy as np
+from weights_and_constants import event_category_declaration, event_category_expression, adhoc_event_category, adhoc_category_index, adhoc_category_process
+from weights_and_constants import event_selections, fscore_definitions, leading_jet_definitions
+from scheduler import enable_multithreading, run_process_pool, cluster_starts, entry_range, print_task_timing
+from histogram_cache import histogram_cache, book_cached
+from skim import find_skim
+from friends import friend_definitions, attach_friend
+from kernels import compiled_expression, print_kernel_timing, enable_rdf_timing_log
+from expressions import fold_constants, optimize_conjuncts, chain_filters, read_pass_rates, update_pass_rates
+from manifest import build_manifest, describe_sample
+from histogram_io import read_histograms, sum_histograms, write_histograms_atomically
+from staging import staging_cache
+from memory import reset_peak_rss, peak_rss, available_cores
+from io_tuning import default_io_settings, read_io_csv, apply_global_io_settings, tree_io_settings, configure_tree, io_counters, print_io_report
+from journal import run_journal, unit_name
 
-ROOT.ROOT.EnableImplicitMT()
+# Scores on the axes of the multidimensional score histogram
+score_columns = ["score_tt_Wcb", "score_ttLF", "score_ttbb", "score_ttbj", "score_ttcc", "score_ttcj"]
 
-def process_trees(input_files, output_files, tree_name, hist_configs, year, selections, eventClassification, use5FS):
+def process_trees(input_files, output_files, tree_name, hist_configs, year, selections, eventClassification, use5FS, single_event_loop=False, run_graphs=False, scan_points=None, sparse_nbins=0, fine_binning=False, cache_dir=None, cache_max_size=10., skim_dir=None, friends=False, friend_dir=None, kernels=False, timing=False, optimize=False, pass_rates=None, measure_events=0, pass_rates_file=None, variants=None, samples=None, collect_histograms=False, stage_dir=None, stage_max_size=50., prefetch=2, io_settings=None, backend="rdf", chunk_size=1000000, memory_budget=0., max_threads=0, journal=None, entry_parts=None):
     """
     Processes multiple TTrees, converts them to multiple TH1Ds for specified branches, and saves them to ROOT files.
+    Return a dictionary {output file : {histogram name : histogram}} with the collected histograms (empty unless collect_histograms is set).
 
     Parameters:
     - input_files: List of input ROOT files.
@@ -22,134 +40,720 @@ def process_trees(input_files, output_files, tree_name, hist_configs, year, sele
     - selections: String containing common event preselection.
     - eventClassification: Boolean indicating whether to apply event classification.
     - use5FS: Boolean indicating whether to use 5-flavor scheme MC for ttbb and ttbj processes.
+    - single_event_loop: Boolean indicating whether to book all histograms of a file lazily and fill them in a single event loop.
+    - run_graphs: Boolean indicating whether to build the computation graphs of all files up front and run them concurrently.
+    - scan_points: List of event classification weight sets and thresholds to fill in the same event loop (see read_scan_csv).
+    - sparse_nbins: Number of bins per score of the multidimensional score histogram. 0 means the histogram is not filled.
+    - fine_binning: Boolean indicating whether to fill the event classification histograms with the fine binning, to be rebinned later.
+    - cache_dir: Directory of the histogram cache. None means that the cache is not used.
+    - cache_max_size: Maximum size of the histogram cache in GB.
+    - skim_dir: Directory of the skims produced by skim.py, read instead of the input files when they are up to date. None means that the input files are always read.
+    - friends: Boolean indicating whether to read the derived columns (fractional scores, leading-jet kinematics, event weight) from friend trees, built when missing or stale.
+    - friend_dir: Directory of the friend trees. None means the friends/ subdirectory of the input directory.
+    - kernels: Boolean indicating whether to declare the selections, weights and derived columns as C++ functions once per process, reused by all files.
+    - timing: Boolean indicating whether RDataFrame should report the time spent in just-in-time compilation and in the event loops.
+    - optimize: Boolean indicating whether to fold the known constants (the data taking year) in the selections and weights,
+                filter the base selection once per file, and order the conditions of the selections by rejection power.
+    - pass_rates: Dictionary {condition : fraction of events passing it}, used to order the conditions of the selections. None keeps the order.
+    - measure_events: Number of events of each file on which the pass rate of each condition is measured (requires optimize), in a separate event loop over these events only.
+                      0 means no measurement.
+    - pass_rates_file: csv file where the measured pass rates are accumulated, together with the learned order of the conditions.
+    - variants: List of analysis variants (see read_variants_csv) filled from the same read of each input tree, each written to its own
+                output subdirectory. None means a single variant with the given selections and flavour scheme.
+    - samples: List of the descriptions of the input files from the sample manifest (see manifest.py), in the same order. None means they are derived from the file names.
+    - collect_histograms: Boolean indicating whether to keep the filled histograms in memory and return them instead of writing them,
+                          e.g. so that the parts of an input file split into entry ranges are summed before being written once (requires booking all the histograms of a file first).
+    - stage_dir: Local directory where the input files are copied (see staging.py), the next ones in the background while the current one is processed. None means that the input files are read directly.
+    - stage_max_size: Maximum size of the staging directory in GB.
+    - prefetch: Number of upcoming input files copied in the background.
+    - io_settings: Dictionary of input/output settings: TTreeCache size, read-ahead, cluster prefetching and explicit branch list (see io_tuning.py). None keeps the ROOT defaults.
+    - backend: 'rdf' to fill the histograms with RDataFrame, 'numpy' to read the columns with uproot and fill the histograms with NumPy (see fill_histograms_numpy),
+               which needs no just-in-time compilation but supports neither the multidimensional score histogram nor the options specific to RDataFrame.
+    - chunk_size: Number of entries read and processed at once by the NumPy backend.
+    - memory_budget: Memory budget in GB of the chunks streamed by the NumPy backend, from which the chunk size and the number of threads are chosen. 0 means no budget.
+    - max_threads: Maximum number of threads streaming chunks with the NumPy backend. 0 means all the available cores.
+    - journal: Run journal (see journal.py), where each (file, selection, variant) unit is recorded as soon as its histograms are written (or collected),
+               and from which the units completed by a previous run are skipped (their collected histograms are read back). None means no journal.
+    - entry_parts: List of (part, parts) pairs, in the same order as the input files: only the entries of the given part of each file, split into parts
+                   of about the same size (see scheduler.entry_range), are processed, in a sequential event loop. The histograms of the parts must be
+                   collected and summed. None (or a None entry) means that all the entries of the file are processed.
     """
     print("")
     if not (len(input_files) == len(output_files)):
         raise ValueError("Input files and output files must have the same length.")
+    if samples is None:
+        samples = [None] * len(input_files)
+    if entry_parts is None:
+        entry_parts = [None] * len(input_files)
+    if journal and any(entry_parts):
+        raise ValueError("The units of the input files split into entry ranges are not journaled.")
 
-    for infile, outfile in zip(input_files, output_files):
+    cache = histogram_cache(cache_dir, cache_max_size) if cache_dir else None
+    rdf_log = enable_rdf_timing_log() if timing else None
+    measured_counts = []
+    collected_histograms = dict() if collect_histograms else None
+    staging = staging_cache(stage_dir, stage_max_size, max(1, prefetch)) if stage_dir else None
+    io_settings = io_settings or default_io_settings
+    apply_global_io_settings(io_settings)
+    io_settings = tree_io_settings(io_settings)
+    run_counters = io_counters()
+    run_start = time.time()
+    single_event_loop = single_event_loop or collect_histograms
 
-        print(f"{Fore.RED}Processing file: {infile}{Style.RESET_ALL}")
+    # Skip the units completed by a previous run, and the files with no other unit
+    pending_units = dict()
+    if journal:
+        # The outputs of each unit are written atomically once its file is processed, so the histograms are booked first
+        single_event_loop = True
+        if run_graphs:
+            print(f"{Fore.YELLOW}Processing the files one at a time, so that the journal records each file as soon as it is processed.{Style.RESET_ALL}")
+            run_graphs = False
+        input_files, output_files, samples, pending_units = resume_from_journal(journal, input_files, output_files, samples, year, selections, use5FS, variants, scan_points, collected_histograms)
 
-        # Open input file
-        input_file = ROOT.TFile.Open(infile)
-        if not input_file or input_file.IsZombie():
-            raise FileNotFoundError(f"Could not open file: {infile}")
+    # Arguments shared by all the input files, passed by keyword to the functions filling them
+    options = dict(tree_name=tree_name, hist_configs=hist_configs, year=year, selections=selections, eventClassification=eventClassification, use5FS=use5FS,
+                   scan_points=scan_points, fine_binning=fine_binning, skim_dir=skim_dir, variants=variants)
+    rdf_options = dict(options, sparse_nbins=sparse_nbins, cache=cache, friends=friends, friend_dir=friend_dir, kernels=kernels, optimize=optimize, pass_rates=pass_rates,
+                       measure_events=measure_events, measured_counts=measured_counts, io_settings=io_settings)
+    numpy_options = dict(options, chunk_size=chunk_size, memory_budget=memory_budget, max_threads=max_threads)
 
-        # Access the TTree
-        tree = input_file.Get(tree_name)
-        if not tree or not isinstance(tree, ROOT.TTree):
-            raise ValueError(f"TTree '{tree_name}' not found in file '{infile}'.")
+    if run_graphs:
+        # Book everything first, then let ROOT run the event loops of all files concurrently
+        if staging:
+            staging.prefetch(input_files)
+        booked_files = [
+            (infile, outfile) + book_histograms(infile, outfile, single_event_loop=True, sample=sample, staged_file=staging.get(infile) if staging else None, **rdf_options)
+            for infile, outfile, sample in zip(input_files, output_files, samples)
+        ]
+        all_histograms = [hist for *_, booked_histograms in booked_files for hists in booked_histograms.values() for hist in hists]
+        print(f"{Fore.YELLOW}Running the computation graphs of {len(booked_files)} files concurrently.{Style.RESET_ALL}")
+        # Histograms loaded from the cache are not RDataFrame results and need no event loop
+        ROOT.RDF.RunGraphs([hist for hist in all_histograms if not isinstance(hist, ROOT.TObject)])
+        for infile, outfile, input_file, df, booked_histograms in booked_files:
+            finalize_file(infile, outfile, input_file, df, booked_histograms, cache, collected_histograms)
+            if staging:
+                staging.release(infile)
+        print_io_report(f"{len(booked_files)} files", run_counters, time.time() - run_start)
+        print(f"{Fore.YELLOW}Peak RSS for {len(booked_files)} files: {peak_rss() / 1024**3:.2f} GB{Style.RESET_ALL}")
+    else:
+        for idx, (infile, outfile, sample, entry_part) in enumerate(zip(input_files, output_files, samples, entry_parts)):
+            if journal:
+                journal.start(infile, list(pending_units[infile]))
+            completed_units = [unit for unit in sample_units(infile, outfile, sample, selections, use5FS, variants, scan_points) if not unit in pending_units[infile]] if journal else None
+            start = time.time()
+            file_counters = io_counters()
+            reset_peak_rss()
+            # Copy the next input files in the background while this one is processed
+            staged_file = None
+            if staging:
+                staging.prefetch(input_files[idx:idx + 1 + prefetch])
+                staged_file = staging.get(infile)
+            if backend == "numpy":
+                booked_histograms = fill_histograms_numpy(infile, outfile, sample=sample, staged_file=staged_file, completed_units=completed_units, entry_part=entry_part, **numpy_options)
+                booked = time.time()
+                store_histograms(booked_histograms, collected_histograms)
+            else:
+                input_file, df, booked_histograms = book_histograms(infile, outfile, single_event_loop=single_event_loop, sample=sample, staged_file=staged_file, completed_units=completed_units, entry_part=entry_part, **rdf_options)
+                booked = time.time()
+                finalize_file(infile, outfile, input_file, df, booked_histograms, cache, collected_histograms)
+            if journal:
+                record_units(journal, infile, pending_units[infile], booked_histograms, collected_histograms)
+            if staging:
+                staging.release(infile)
+            print(f"{Fore.YELLOW}Wall time for {infile}: booking {booked - start:.2f} s, event loop (including just-in-time compilation) and writing {time.time() - booked:.2f} s{Style.RESET_ALL}")
+            if backend == "rdf":
+                print_io_report(infile, file_counters, time.time() - start)
+            print(f"{Fore.YELLOW}Peak RSS for {infile}: {peak_rss() / 1024**3:.2f} GB{Style.RESET_ALL}")
 
-        # Create RDataFrame from TTree
-        df = ROOT.RDataFrame(tree)
+    if cache:
+        cache.report()
+    if staging:
+        staging.close()
+        staging.report()
+    if kernels:
+        print_kernel_timing()
+    if measured_counts:
+        counts = dict()
+        for conjunct, passed, total in measured_counts:
+            counts.setdefault(conjunct, [0, 0])
+            counts[conjunct][0] += passed
+            counts[conjunct][1] += total
+        update_pass_rates(pass_rates_file, counts)
+        print(f"Pass rates of {len(counts)} conditions saved to: {pass_rates_file}")
 
-        if eventClassification:
-            print(f"{Fore.YELLOW}Running in event classification mode. Will define a series of fractional scores.{Style.RESET_ALL}")
-            # Define the fractional scores
-            df = df.Define("fscore_ttbb", "score_ttbb / (score_ttbb + score_ttbj + score_ttcc + score_ttcj + score_ttLF)") \
-                .Define("fscore_ttbj", "score_ttbj / (score_ttbb + score_ttbj + score_ttcc + score_ttcj + score_ttLF)") \
-                .Define("fscore_ttcc", "score_ttcc / (score_ttbb + score_ttbj + score_ttcc + score_ttcj + score_ttLF)") \
-                .Define("fscore_ttcj", "score_ttcj / (score_ttbb + score_ttbj + score_ttcc + score_ttcj + score_ttLF)") \
-                .Define("fscore_ttLF", "score_ttLF / (score_ttbb + score_ttbj + score_ttcc + score_ttcj + score_ttLF)")
+    return collected_histograms or dict()
+
+def book_histograms(infile, outfile, tree_name, hist_configs, year, selections, eventClassification, use5FS, single_event_loop, scan_points=None, sparse_nbins=0, fine_binning=False, cache=None, skim_dir=None, friends=False, friend_dir=None, kernels=False, optimize=False, pass_rates=None, measure_events=0, measured_counts=None, variants=None, sample=None, staged_file=None, io_settings=None, completed_units=None, entry_part=None):
+    """
+    Open a TTree and book the histograms of all the selections that apply to it.
+    Unless single_event_loop is set (always the case when scanning event classification weight sets or filling several variants), the histograms of each selection
+    are filled and written (atomically, see histogram_io.py) as soon as they are booked.
+    Histograms found in the cache are loaded instead of being booked.
+    The event counts measuring the pass rates of the conditions of the selections are appended to measured_counts as (condition, passed, total).
+    Return the input file, the RDataFrame and a dictionary {output file : list of booked histograms}.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - outfile: Output ROOT file.
+    - staged_file: Local copy of the input file, read instead of it. None means that the input file is read.
+    - io_settings: Dictionary of input/output settings applied to the input tree (see io_tuning.py). None keeps the ROOT defaults.
+    - completed_units: List of the units (see journal.py) completed by a previous run, which are not booked. None means that all units are booked.
+    - entry_part: (part, parts) pair: only the entries of this part of the tree are processed, which requires implicit multi-threading to be disabled.
+                  None means all the entries.
+    - See process_trees for the other parameters.
+    """
+    print(f"{Fore.RED}Processing file: {infile}{Style.RESET_ALL}")
+
+    # Sample type, event weight and applicable selections, from the sample manifest if available
+    if sample is None:
+        sample = describe_sample(infile, year, list(selections.keys()), assign_event_weight)
+    is_data = sample["type"] == "data"
+
+    # The scan points and the variants are written to separate output directories, so the histograms must be booked first
+    if scan_points or variants:
+        single_event_loop = True
+    if not variants:
+        variants = [{"name": "", "selections": selections, "use5FS": use5FS}]
+
+    # Read the skim of the input file if it is up to date, or else its local copy. The name of the input file still determines how it is processed.
+    # The expressions of all the booked actions determine the columns that are read
+    expressions = booked_expressions(hist_configs, variants, sample, sparse_nbins)
+    read_file = find_read_file(infile, tree_name, selections, expressions, skim_dir, staged_file)
+
+    # Open input file
+    input_file = ROOT.TFile.Open(read_file)
+    if not input_file or input_file.IsZombie():
+        raise FileNotFoundError(f"Could not open file: {read_file}")
+
+    # Access the TTree
+    tree = input_file.Get(tree_name)
+    if not tree or not isinstance(tree, ROOT.TTree):
+        raise ValueError(f"TTree '{tree_name}' not found in file '{read_file}'.")
+
+    # Read the derived columns from the friend tree, so that they are neither compiled nor computed again
+    friend_columns = []
+    if friends:
+        friend_columns = attach_friend(input_file, tree, tree_name, friend_definitions(sample["weight"] if not is_data else None), friend_dir)
+
+    # Configure the TTreeCache of the input tree. The tree (rather than the file name) is given to RDataFrame, so that the friend tree and the cache settings apply.
+    if io_settings:
+        cached_branches = configure_tree(tree, io_settings, expressions)
+        if cached_branches:
+            print(f"Caching {len(cached_branches)} branches read by the booked actions: {cached_branches}")
+
+    # Create RDataFrame from TTree
+    df = ROOT.RDataFrame(tree)
+
+    # Process only one part of the entries, aligned on the clusters of the tree that is actually read (e.g. the skim)
+    if entry_part:
+        begin, end = entry_range(tree.GetEntries(), cluster_starts(tree), *entry_part)
+        print(f"Processing entries [{begin}, {end}) of {tree.GetEntries()} (part {entry_part[0] + 1}/{entry_part[1]})")
+        df = df.Range(begin, end)
+
+    # Declare the expressions as C++ functions once per process, if requested
+    kernel = compiled_expression if kernels else (lambda node, expression: expression)
+
+    if eventClassification:
+        print(f"{Fore.YELLOW}Running in event classification mode. Will define a series of fractional scores.{Style.RESET_ALL}")
+    df = define_columns(df, eventClassification, scan_points, friend_columns, kernel)
+
+    # Event weight based on data taking year and process type
+    weight = sample["weight"]
+
+    # Values known before the event loop, folded into the selections and weights
+    constants = {"year": year}
+    if optimize:
+        weight = fold_constants(weight, constants)
+
+    # Everything that determines the content of the histograms of this file, used as the key of the histogram cache
+    cache_fields = {
+        "file": infile, "file_size": input_file.GetSize(), "file_date": input_file.GetModificationDate().Convert(),
+        "tree": tree_name, "weight": weight if not is_data else "1",
+        "event_category": adhoc_event_category if eventClassification else "",
+        "fscore_definitions": fscore_definitions, "leading_jet_definitions": leading_jet_definitions
+    }
+
+    # Histograms booked for each output file, written only after all selections are booked (single event loop mode)
+    booked_histograms = dict()
+
+    # Nodes filtering on the base selection of each variant, shared by all the selections of the file
+    base_nodes = dict()
+    # Conditions whose pass rates are measured
+    measured_conjuncts = []
+
+    # Process each variant-selection-output combinations
+    for variant, selection_name in [(variant, selection_name) for variant in variants for selection_name in variant["selections"]]:
+        selections = variant["selections"]
+        use5FS = variant["use5FS"]
+
+        # Apply base selection to every sample; apply the ttbar-specific selection to the right 4F, dps, and 5F powheg samples
+        if not selection_name in sample["selections_5FS" if use5FS else "selections_4FS"]:
+            continue
+        if completed_units and unit_name(infile, variant["name"], selection_name) in completed_units:
+            continue
+
+        # Produce output file, in the subdirectory of the variant
+        output_file = selection_output_file(outfile, variant["name"], selection_name)
+        selection_histograms = []
+
+        # Add event selection making sure that the "base" selection is applied everywhere
+        event_selection = full_selection(infile, selections, selection_name)
+        print(f"Applying selection: {Fore.GREEN}{event_selection}{Style.RESET_ALL} -> Producing output file: {output_file}")
+        if optimize:
+            # Each condition is a Filter of its own, in the order learned from the pass rates
+            base_conjuncts = optimize_conjuncts(selections['base'], constants, pass_rates)
+            other_conjuncts = optimize_conjuncts(event_selection[len(selections['base']):], constants, pass_rates)
+            if not selections['base'] in base_nodes:
+                base_nodes[selections['base']] = chain_filters(df, base_conjuncts, kernel)
+            df_selected = chain_filters(base_nodes[selections['base']], other_conjuncts, kernel)
+
+            if measure_events > 0:
+                measured_conjuncts += [conjunct for conjunct in base_conjuncts + other_conjuncts if not conjunct in measured_conjuncts]
         else:
-            df = df.Define("ak4_1_pt", "ak4_pt.size() > 0 ? ak4_pt[0] : 0") \
-                .Define("ak4_1_phi",   "ak4_phi.size() > 0 ? ak4_phi[0] : 0") \
-                .Define("ak4_1_eta",   "ak4_eta.size() > 0 ? ak4_eta[0] : 0") \
-                .Define("ak4_2_pt",    "ak4_pt.size() > 1 ? ak4_pt[1] : 0") \
-                .Define("ak4_2_phi",   "ak4_phi.size() > 1 ? ak4_phi[1] : 0") \
-                .Define("ak4_2_eta",   "ak4_eta.size() > 1 ? ak4_eta[1] : 0") \
-                .Define("ak4_3_pt",    "ak4_pt.size() > 2 ? ak4_pt[2] : 0") \
-                .Define("ak4_3_phi",   "ak4_phi.size() > 2 ? ak4_phi[2] : 0") \
-                .Define("ak4_3_eta",   "ak4_eta.size() > 2 ? ak4_eta[2] : 0") \
-                .Define("ak4_4_pt",    "ak4_pt.size() > 3 ? ak4_pt[3] : 0") \
-                .Define("ak4_4_phi",   "ak4_phi.size() > 3 ? ak4_phi[3] : 0") \
-                .Define("ak4_4_eta",   "ak4_eta.size() > 3 ? ak4_eta[3] : 0")
-
-        tt_file_names = ["ttbb-4f", "ttbb-dps", "ttbar-powheg"]
-        tt4f_strings = ["ttbb", "ttbj"]
-        tt_strings   = ["ttcc", "ttcj", "ttLF"]
-
-        # Assign event weight based on data taking year and process type
-        weight = assign_event_weight(year, infile)
-
-        # Process each selection-output combinations
-        for selection_name in selections:
-
-            # Apply base selection to every sample; apply the ttbar-specific selection to the right 4F, dps, and 5F powheg samples
-            if not "base" in selection_name and not any(x in infile for x in tt_file_names): 
-                continue
-            if any(x in infile for x in tt_file_names) and "base" in selection_name:
+            df_selected = df.Filter(kernel(df, event_selection))
+
+        #print("after first event selection:", df_selected.Count().GetValue())
+
+        # If weight is a complex expression, define it as a new column
+        weight_column = "weight_column"
+        if not is_data:
+            print(f"Event weight: {weight}")
+            df_selected = df_selected.Define(weight_column, kernel(df_selected, weight) if not "event_weight" in friend_columns else "event_weight")
+        else: # Keep the weight 1 for collision data
+            df_selected = df_selected.Define(weight_column, "1")
+
+        # Define event classification for the dedicated mode
+        if eventClassification:
+            from weights_and_constants import adhoc_selection, adhoc_binning, adhoc_fine_binning
+            adhoc_selection = adhoc_selection.copy()
+            adhoc_binning = adhoc_binning.copy() if not fine_binning else adhoc_fine_binning.copy()
+
+        # Create histograms for each branch
+        final_df = dict()
+        for hist_config in hist_configs:
+            branch_name = hist_config['branch']
+            nbins = int(hist_config['nbins'])
+            xmin = float(hist_config['xmin'])
+            xmax = float(hist_config['xmax'])
+            print(f"Creating histogram for branch: {branch_name}")
+
+            # Fill the category histograms of all the scan points in the same event loop, each in its own output directory
+            if eventClassification and scan_points:
+                for idx, point in enumerate(scan_points):
+                    point_file = os.path.join(os.path.dirname(output_file), point['name'], os.path.basename(output_file))
+                    point_selection = f"event_category_{idx} == {adhoc_category_index[branch_name]}"
+                    fields = dict(cache_fields, selection=event_selection, event_category=event_category_expression(point['weights'], point['thresholds']),
+                                  category=point_selection, branch=branch_name, binning=list(adhoc_binning[branch_name]))
+                    hist = book_cached(cache, fields, lambda: df_selected.Filter(point_selection) \
+                        .Histo1D((f"h_{branch_name}", f"Histogram of {branch_name}", len(adhoc_binning[branch_name])-1, adhoc_binning[branch_name]), branch_name, weight_column))
+                    booked_histograms.setdefault(point_file, []).append(hist)
                 continue
-            if use5FS: # "ttbb", "ttbj" -> both powheg and dps samples; "ttcc", "ttcj", "ttLF" --> only powheg
-                if any(x in selection_name for x in tt4f_strings) and not ("powheg" in infile or "dps" in infile):
-                    continue
-                if any(x in selection_name for x in tt_strings) and not "powheg" in infile: 
-                    continue
+
+            final_df[branch_name] = df_selected.Filter(adhoc_selection[branch_name]) if eventClassification else df_selected
+
+            # Create histogram, unless it is already in the cache
+            if eventClassification:
+                fields = dict(cache_fields, selection=event_selection, category=adhoc_selection[branch_name], branch=branch_name, binning=list(adhoc_binning[branch_name]))
+                hist = book_cached(cache, fields, lambda: final_df[branch_name].Histo1D((f"h_{branch_name}", f"Histogram of {branch_name}", len(adhoc_binning[branch_name])-1, adhoc_binning[branch_name]), branch_name, weight_column))
             else:
-                if any(x in selection_name for x in tt4f_strings) and not "bb" in infile:
-                    continue
-                if any(x in selection_name for x in tt_strings) and not "powheg" in infile:
-                    continue
-
-        
-            # Produce output file
-            tt_outfile_name = outfile.replace('.root','_'+selection_name+'.root')
-            output_file = tt_outfile_name if not "base" in selection_name else outfile
-            output_root = ROOT.TFile(output_file, "RECREATE")
-
-            # Add event selection making sure that the "base" selection is applied everywhere
-            event_selection = f"{selections['base']}{selections[selection_name]}" if not "base" in selection_name else f"{selections[selection_name]}"
-            if "singlee" in infile:
-                event_selection += " && passTrigMu==0" # Remove from the electron channel the events that fired the muon trigger. Could choose to do vice versa as well.
-            print(f"Applying selection: {Fore.GREEN}{event_selection}{Style.RESET_ALL} -> Producing output file: {output_file}")
-            df_selected = df.Filter(event_selection)
-
-            #print("after first event selection:", df_selected.Count().GetValue())
-
-            # If weight is a complex expression, define it as a new column
-            weight_column = "weight_column"
-            if not "data" in infile:
-                print(f"Event weight: {weight}")
-                df_selected = df_selected.Define(weight_column, weight)
-            else: # Keep the weight 1 for collision data
-                df_selected = df_selected.Define(weight_column, "1")
-
-            # Define event classification for the dedicated mode
+                fields = dict(cache_fields, selection=event_selection, branch=branch_name, binning=[nbins, xmin, xmax])
+                hist = book_cached(cache, fields, lambda: final_df[branch_name].Histo1D((f"h_{branch_name}", f"Histogram of {branch_name}", nbins, xmin, xmax), branch_name, weight_column))
+
+            #print(f"Number of events after full selection: {hist.Integral()}")
+
+            selection_histograms.append(hist)
+
+        # Fill a fine-binned multidimensional histogram of the scores, from which any rectangular cut on the scores can be derived later.
+        # The title holds the names of the scores on the axes.
+        if sparse_nbins > 0:
+            ndim = len(score_columns)
+            fields = dict(cache_fields, selection=event_selection, branch=score_columns, binning=[sparse_nbins, 0., 1.])
+            hist = book_cached(cache, fields, lambda: df_selected.HistoNSparseD(("h_scores", ":".join(score_columns), ndim, [sparse_nbins]*ndim, [0.]*ndim, [1.]*ndim), score_columns + [weight_column]))
+            selection_histograms.append(hist)
+
+        # Write the histograms to the output file, or keep them booked until all selections are defined
+        if single_event_loop:
+            booked_histograms.setdefault(output_file, []).extend(selection_histograms)
+        else:
+            write_histograms(output_file, selection_histograms)
+
+    # Measure the pass rate of each condition on the first events, in an event loop of its own that reads only these events
+    if measured_conjuncts:
+        measured_counts.extend(measure_pass_rates(tree, measured_conjuncts, measure_events, lambda node: define_columns(node, eventClassification, scan_points, friend_columns, kernel), kernel))
+
+    return input_file, df, booked_histograms
+
+def define_columns(df, eventClassification, scan_points=None, friend_columns=None, kernel=None):
+    """
+    Define the derived columns on an RDataFrame node: the fractional scores and the event categories in event classification mode,
+    the leading jet variables otherwise. Return the new node.
+
+    Parameters:
+    - df: RDataFrame node.
+    - friend_columns: Columns read from the friend tree, which are not defined again. None means that there is no friend tree.
+    - kernel: Function returning the expression (or the compiled function) of a definition on a node. None means that the expressions are used as such.
+    - See process_trees for the other parameters.
+    """
+    friend_columns = friend_columns or []
+    kernel = kernel or (lambda node, expression: expression)
+
+    if eventClassification:
+        # Define the fractional scores
+        for column, definition in fscore_definitions.items():
+            if not column in friend_columns:
+                df = df.Define(column, kernel(df, definition))
+        # Compute the event category once per event; the categories are then split by an integer comparison
+        ROOT.gInterpreter.Declare(event_category_declaration)
+        df = df.Define("event_category", adhoc_event_category)
+        if scan_points:
+            for idx, point in enumerate(scan_points):
+                df = df.Define(f"event_category_{idx}", event_category_expression(point['weights'], point['thresholds']))
+    else:
+        for column, definition in leading_jet_definitions.items():
+            if not column in friend_columns:
+                df = df.Define(column, kernel(df, definition))
+
+    return df
+
+def measure_pass_rates(tree, conjuncts, measure_events, define, kernel):
+    """
+    Measure the pass rate of each condition, independently of the others, on the first events of a tree, in an event loop that reads only these events.
+    Implicit multithreading is disabled during the measurement, since RDataFrame only processes a range of entries in a single thread.
+    Return a list of (condition, events passing it, events tested).
+
+    Parameters:
+    - tree: Input TTree.
+    - conjuncts: List of conditions.
+    - measure_events: Number of events on which the pass rates are measured.
+    - define: Function defining the derived columns on an RDataFrame node (see define_columns).
+    - kernel: Function returning the expression (or the compiled function) of a condition on a node.
+    """
+    threads = ROOT.ROOT.GetThreadPoolSize() if ROOT.ROOT.IsImplicitMTEnabled() else 0
+    if threads:
+        ROOT.ROOT.DisableImplicitMT()
+    try:
+        sample_node = define(ROOT.RDataFrame(tree).Range(measure_events))
+        total = sample_node.Count()
+        passed = [sample_node.Filter(kernel(sample_node, conjunct)).Count() for conjunct in conjuncts]
+        # Accessing the first count runs the only event loop of the measurement
+        total = total.GetValue()
+        measured = [(conjunct, count.GetValue(), total) for conjunct, count in zip(conjuncts, passed)]
+    finally:
+        if threads:
+            ROOT.ROOT.EnableImplicitMT(threads)
+
+    print(f"Pass rates of {len(conjuncts)} conditions measured on {total} events")
+
+    return measured
+
+def fill_histograms_numpy(infile, outfile, tree_name, hist_configs, year, selections, eventClassification, use5FS, scan_points=None, fine_binning=False, skim_dir=None, variants=None, sample=None, staged_file=None, chunk_size=1000000, memory_budget=0., max_threads=0, completed_units=None, entry_part=None):
+    """
+    Fill the histograms of all the selections that apply to an input file without RDataFrame: the columns needed are read in chunks with uproot,
+    and the selections, weights and derived columns are evaluated vectorized with NumPy (see numpy_backend.py).
+    Return a dictionary {output file : list of TH1D}, with the same histograms as book_histograms.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - outfile: Output ROOT file.
+    - staged_file: Local copy of the input file, read instead of it. None means that the input file is read.
+    - chunk_size: Number of entries read and processed at once.
+    - memory_budget: Memory budget of the chunks in GB, from which the chunk size and the number of threads processing chunks concurrently are chosen.
+                     0 means that the chunks of chunk_size entries are processed one at a time.
+    - max_threads: Maximum number of threads processing chunks concurrently. 0 means all the available cores.
+    - completed_units: List of the units (see journal.py) completed by a previous run, which are not filled. None means that all units are filled.
+    - entry_part: (part, parts) pair: only the entries of this part of the tree are read. None means all the entries.
+    - See process_trees for the other parameters.
+    """
+    from numpy_backend import compiled_expression as vectorized_expression, read_chunks, numpy_histogram, bytes_per_entry, choose_chunking, stream_map, fill_chunk, tree_clusters
+    from weights_and_constants import adhoc_selection, adhoc_binning, adhoc_fine_binning
+    print(f"{Fore.RED}Processing file with the NumPy backend: {infile}{Style.RESET_ALL}")
+
+    if sample is None:
+        sample = describe_sample(infile, year, list(selections.keys()), assign_event_weight)
+    is_data = sample["type"] == "data"
+    if not variants:
+        variants = [{"name": "", "selections": selections, "use5FS": use5FS}]
+    read_file = find_read_file(infile, tree_name, selections, booked_expressions(hist_configs, variants, sample), skim_dir, staged_file)
+
+    # Derived columns, evaluated in this order on each chunk
+    definitions = dict(fscore_definitions) if eventClassification else dict(leading_jet_definitions)
+    if eventClassification:
+        definitions["event_category"] = adhoc_event_category
+        for idx, point in enumerate(scan_points or []):
+            definitions[f"event_category_{idx}"] = event_category_expression(point['weights'], point['thresholds'])
+    binning = adhoc_fine_binning if fine_binning else adhoc_binning
+    weight = sample["weight"] if not is_data else "1"
+
+    # Histograms to fill, as (event selection, category selection, branch, histogram), and the histograms of each output file
+    fills = []
+    histograms = dict()
+    for variant, selection_name in [(variant, selection_name) for variant in variants for selection_name in variant["selections"]]:
+        if not selection_name in sample["selections_5FS" if variant["use5FS"] else "selections_4FS"]:
+            continue
+        if completed_units and unit_name(infile, variant["name"], selection_name) in completed_units:
+            continue
+        output_file = selection_output_file(outfile, variant["name"], selection_name)
+        event_selection = full_selection(infile, variant["selections"], selection_name)
+        print(f"Applying selection: {Fore.GREEN}{event_selection}{Style.RESET_ALL} -> Producing output file: {output_file}")
+        for hist_config in hist_configs:
+            branch_name = hist_config['branch']
+            title = f"Histogram of {branch_name}"
+            if eventClassification and scan_points:
+                for idx, point in enumerate(scan_points):
+                    point_file = os.path.join(os.path.dirname(output_file), point['name'], os.path.basename(output_file))
+                    hist = numpy_histogram(f"h_{branch_name}", title, binning[branch_name])
+                    fills.append((event_selection, f"event_category_{idx} == {adhoc_category_index[branch_name]}", branch_name, hist))
+                    histograms.setdefault(point_file, []).append(hist)
+                continue
             if eventClassification:
-                from weights_and_constants import adhoc_selection, adhoc_binning
-                adhoc_selection = adhoc_selection.copy()
-                adhoc_binning = adhoc_binning.copy()
+                hist = numpy_histogram(f"h_{branch_name}", title, binning[branch_name])
+            else:
+                hist = numpy_histogram(f"h_{branch_name}", title, None, int(hist_config['nbins']), float(hist_config['xmin']), float(hist_config['xmax']))
+            fills.append((event_selection, adhoc_selection[branch_name] if eventClassification else None, branch_name, hist))
+            histograms.setdefault(output_file, []).append(hist)
+
+    # Each expression is translated once, and only the columns it reads are read
+    compiled = dict()
+    for expression in list(definitions.values()) + [weight] + [x for fill in fills for x in fill[:3] if x]:
+        if not expression in compiled:
+            compiled[expression] = vectorized_expression(expression)
+    columns = sorted(set([column for expression in compiled.values() for column in expression.columns]) - set(definitions.keys()))
+
+    # Choose the chunk size and the number of threads from the memory budget: each entry of a chunk holds the columns read, the derived columns,
+    # the selection masks and the weights, and about as much again in temporary arrays
+    threads = 1
+    if memory_budget > 0:
+        entry_bytes = 2 * (bytes_per_entry(read_file, tree_name, columns) + 8 * (len(definitions) + 1) + len(fills))
+        chunk_size, threads = choose_chunking(entry_bytes, memory_budget, max_threads or available_cores())
+        print(f"{Fore.YELLOW}Streaming chunks of {chunk_size} entries on {threads} threads ({entry_bytes:.0f} bytes per entry, budget {memory_budget:.2f} GB){Style.RESET_ALL}")
+
+    # Read only one part of the entries, aligned on the baskets of the tree that is actually read (e.g. the skim)
+    begin, end = None, None
+    if entry_part:
+        entries, starts = tree_clusters(read_file, tree_name)
+        begin, end = entry_range(entries, starts, *entry_part)
+        print(f"Processing entries [{begin}, {end}) of {entries} (part {entry_part[0] + 1}/{entry_part[1]})")
+
+    # Streaming pipeline: read -> define, select, weight, fill (concurrently on several chunks) -> reduce in the order of the chunks
+    chunks = read_chunks(read_file, tree_name, columns, chunk_size, begin, end)
+    for filled in stream_map(lambda chunk: fill_chunk(chunk, definitions, weight, fills, compiled), chunks, threads):
+        for (_, _, _, hist), chunk_hist in zip(fills, filled):
+            hist.add(chunk_hist)
+
+    return {output_file: [numpy_to_th1(hist) for hist in hists] for output_file, hists in histograms.items()}
+
+def numpy_to_th1(hist):
+    """
+    Convert a histogram filled with NumPy into a TH1D, with the same content, errors, number of entries and statistics.
+
+    Parameters:
+    - hist: Histogram filled with NumPy (see numpy_backend.py).
+    """
+    if hist.fixed:
+        th1 = ROOT.TH1D(hist.name, hist.title, hist.nbins, hist.xmin, hist.xmax)
+    else:
+        th1 = ROOT.TH1D(hist.name, hist.title, hist.nbins, hist.edges)
+    th1.SetDirectory(0)
+    th1.Sumw2()
+    for idx in range(hist.nbins + 2):
+        th1.SetBinContent(idx, hist.sumw[idx])
+        th1.GetSumw2().AddAt(hist.sumw2[idx], idx)
+    th1.SetEntries(hist.entries)
+    th1.PutStats(np.array(hist.stats, dtype=np.float64))
+
+    return th1
+
+def booked_expressions(hist_configs, variants, sample, sparse_nbins=0):
+    """
+    Return the expressions of all the actions booked for an input file (selections, weight, derived columns, filled branches), from which the columns read are discovered.
+
+    Parameters:
+    - hist_configs: List of dictionaries with keys 'branch', 'nbins', 'xmin', 'xmax'.
+    - variants: List of analysis variants (see read_variants_csv).
+    - sample: Description of the input file (see manifest.py).
+    - sparse_nbins: Number of bins per score of the multidimensional score histogram. 0 means the histogram is not filled.
+    """
+    return [expression for variant in variants for expression in variant["selections"].values()] + ["passTrigMu", sample["weight"], adhoc_event_category] \
+        + list(fscore_definitions.values()) + list(leading_jet_definitions.values()) + [hist_config['branch'] for hist_config in hist_configs] \
+        + (score_columns if sparse_nbins > 0 else [])
 
-            # Create histograms for each branch
-            final_df = dict()
-            for hist_config in hist_configs:
-                branch_name = hist_config['branch']
-                nbins = int(hist_config['nbins'])
-                xmin = float(hist_config['xmin'])
-                xmax = float(hist_config['xmax'])
-                print(f"Creating histogram for branch: {branch_name}")
-                
-                final_df[branch_name] = df_selected.Filter(adhoc_selection[branch_name]) if eventClassification else df_selected
+def find_read_file(infile, tree_name, selections, expressions, skim_dir=None, staged_file=None):
+    """
+    Return the file to read for an input file: its skim if it is up to date, or else its local copy, or else the input file itself.
+    The name of the input file still determines how it is processed.
 
-                # Create histogram
-                if eventClassification:
-                    hist = final_df[branch_name].Histo1D((f"h_{branch_name}", f"Histogram of {branch_name}", len(adhoc_binning[branch_name])-1, adhoc_binning[branch_name]), branch_name, weight_column)
-                else:
-                    hist = final_df[branch_name].Histo1D((f"h_{branch_name}", f"Histogram of {branch_name}", nbins, xmin, xmax), branch_name, weight_column)
+    Parameters:
+    - infile: Input ROOT file.
+    - tree_name: Name of the TTree.
+    - selections: Dictionary containing event selections.
+    - expressions: Expressions of the booked actions (see booked_expressions).
+    - skim_dir: Directory of the skims produced by skim.py, or None.
+    - staged_file: Local copy of the input file, or None.
+    """
+    read_file = staged_file or infile
+    if skim_dir:
+        skim = find_skim(skim_dir, infile, tree_name, selections["base"], expressions)
+        read_file = skim if not skim == infile else read_file
 
-                #print(f"Number of events after full selection: {hist.Integral()}")
+    return read_file
 
+def selection_output_file(outfile, variant_name, selection_name):
+    """
+    Return the output file of a selection: the output file of the input file for the base selection, with the name of the selection appended otherwise,
+    in the subdirectory of the variant.
 
-                # Write histogram to output file
-                hist.Write()
+    Parameters:
+    - outfile: Output ROOT file of the input file.
+    - variant_name: Name of the variant, or an empty string for no subdirectory.
+    - selection_name: Name of the selection.
+    """
+    variant_outfile = os.path.join(os.path.dirname(outfile), variant_name, os.path.basename(outfile)) if variant_name else outfile
+    tt_outfile_name = variant_outfile.replace('.root','_'+selection_name+'.root')
+
+    return tt_outfile_name if not "base" in selection_name else variant_outfile
+
+def full_selection(infile, selections, selection_name):
+    """
+    Return the full event selection of a selection, making sure that the "base" selection is applied everywhere.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - selections: Dictionary containing event selections.
+    - selection_name: Name of the selection.
+    """
+    event_selection = f"{selections['base']}{selections[selection_name]}" if not "base" in selection_name else f"{selections[selection_name]}"
+    if "singlee" in infile:
+        event_selection += " && passTrigMu==0" # Remove from the electron channel the events that fired the muon trigger. Could choose to do vice versa as well.
+
+    return event_selection
+
+def finalize_file(infile, outfile, input_file, df, booked_histograms, cache=None, collected_histograms=None):
+    """
+    Write the booked histograms of an input file (or collect them in memory), report the number of event loops and close the file.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - outfile: Output ROOT file.
+    - input_file: The opened input TFile.
+    - df: The RDataFrame built on the input TTree.
+    - booked_histograms: Dictionary {output file : list of booked histograms}.
+    - cache: Histogram cache, where the newly filled histograms are stored. None means that the cache is not used.
+    - collected_histograms: Dictionary {output file : {histogram name : histogram}} where the filled histograms are added, detached from any file,
+                            instead of being written. None means that the histograms are written immediately.
+    """
+    # Accessing the first histogram triggers the only event loop, which fills all the booked histograms at once
+    store_histograms(booked_histograms, collected_histograms)
 
-            # Close files
-            output_root.Close()
+    if cache:
+        cache.store_pending()
 
-        input_file.Close()
+    print(f"{Fore.YELLOW}Event loops run for {infile}: {df.GetNRuns()}{Style.RESET_ALL}")
 
-        print(f"Saved histograms to: {outfile}\n")
+    input_file.Close()
+
+    print(f"{'Collected' if collected_histograms is not None else 'Saved'} histograms for: {outfile}\n")
+
+def store_histograms(booked_histograms, collected_histograms=None):
+    """
+    Write the histograms of each output file, or add them to the collected histograms, detached from any file.
+
+    Parameters:
+    - booked_histograms: Dictionary {output file : list of (booked) histograms}.
+    - collected_histograms: Dictionary {output file : {histogram name : histogram}}, or None to write the histograms immediately.
+    """
+    for output_file, hists in booked_histograms.items():
+        if collected_histograms is None:
+            write_histograms(output_file, hists)
+            continue
+        collected_histograms[output_file] = dict()
+        for hist in hists:
+            hist_clone = hist.Clone()
+            if isinstance(hist_clone, ROOT.TH1):
+                hist_clone.SetDirectory(0)
+            collected_histograms[output_file][hist_clone.GetName()] = hist_clone
+
+def write_histograms(output_file, hists):
+    """
+    Write a list of (booked) histograms to a new ROOT file, atomically (see histogram_io.py).
+
+    Parameters:
+    - output_file: Output ROOT file.
+    - hists: List of histograms (or RDataFrame results) to be written.
+    """
+    write_histograms_atomically(output_file, {hist.GetName(): hist for hist in hists})
+
+def sample_units(infile, outfile, sample, selections, use5FS, variants=None, scan_points=None):
+    """
+    Return the units of work of an input file, i.e. its (selection, variant) pairs, as a dictionary {unit name : list of its possible output files}.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - outfile: Output ROOT file of the input file.
+    - sample: Description of the input file (see manifest.py).
+    - See process_trees for the other parameters.
+    """
+    if not variants:
+        variants = [{"name": "", "selections": selections, "use5FS": use5FS}]
+
+    units = dict()
+    for variant, selection_name in [(variant, selection_name) for variant in variants for selection_name in variant["selections"]]:
+        if not selection_name in sample["selections_5FS" if variant["use5FS"] else "selections_4FS"]:
+            continue
+        output_file = selection_output_file(outfile, variant["name"], selection_name)
+        point_files = [os.path.join(os.path.dirname(output_file), point['name'], os.path.basename(output_file)) for point in scan_points or []]
+        units[unit_name(infile, variant["name"], selection_name)] = [output_file] + point_files
+
+    return units
+
+def resume_from_journal(journal, input_files, output_files, samples, year, selections, use5FS, variants=None, scan_points=None, collected_histograms=None):
+    """
+    Find the units of each input file that were not completed by a previous run, and read back the collected histograms of the completed ones.
+    Return the input files, output files and samples with units to process, and a dictionary {input file : {unit name : list of its possible output files}}
+    with the units to process.
+
+    Parameters:
+    - journal: Run journal (see journal.py).
+    - collected_histograms: Dictionary {output file : {histogram name : histogram}} where the histograms of the completed units are added,
+                            or None if the histograms are written (and thus already in the output files).
+    - See process_trees for the other parameters.
+    """
+    pending_files = []
+    pending_units = dict()
+    for infile, outfile, sample in zip(input_files, output_files, samples):
+        if sample is None:
+            sample = describe_sample(infile, year, list(selections.keys()), assign_event_weight)
+        units = sample_units(infile, outfile, sample, selections, use5FS, variants, scan_points)
+        pending_units[infile] = dict()
+        for unit, unit_files in units.items():
+            if not journal.completed(unit, infile):
+                pending_units[infile][unit] = unit_files
+            elif collected_histograms is not None:
+                collected_histograms.update(journal.load(unit))
+        if pending_units[infile]:
+            pending_files.append((infile, outfile, sample))
+        else:
+            print(f"{Fore.YELLOW}Skipping {infile}: its {len(units)} units were completed by a previous run.{Style.RESET_ALL}")
+
+    return [x[0] for x in pending_files], [x[1] for x in pending_files], [x[2] for x in pending_files], pending_units
+
+def record_units(journal, infile, units, booked_histograms, collected_histograms=None):
+    """
+    Record the units of an input file as completed in the journal, with the checksums of their output files
+    (or of the copies of their collected histograms kept in the journal directory).
+
+    Parameters:
+    - journal: Run journal (see journal.py).
+    - infile: Input ROOT file.
+    - units: Dictionary {unit name : list of its possible output files}.
+    - booked_histograms: Dictionary {output file : list of histograms} of the output files produced for the input file.
+    - collected_histograms: Dictionary {output file : {histogram name : histogram}}, or None if the histograms were written.
+    """
+    for unit, unit_files in units.items():
+        if collected_histograms is None:
+            outputs = {output_file: output_file for output_file in unit_files if output_file in booked_histograms}
+        else:
+            outputs = {output_file: journal.stash(unit, output_file, collected_histograms[output_file]) for output_file in unit_files if output_file in booked_histograms}
+        journal.done(unit, infile, outputs)
 
 def read_csv(csv_file):
     """
@@ -169,6 +773,137 @@ def read_csv(csv_file):
 
     return dict_list
 
+def read_scan_csv(csv_file):
+    """
+    Open and read a csv file containing the event classification weight sets and thresholds to scan.
+    Each line defines a named weight set. Several values separated by ';' in a cell define a grid, expanded into one scan point per combination.
+    Return a list of dictionaries with keys 'name', 'weights', and 'thresholds'.
+
+    Parameters:
+    - csv_file: The csv file with columns name, ttbb, ttbj, ttcc, ttcj, ttLF, score_tt_Wcb_min, score_ttLF_max, SR_score_tt_Wcb.
+    """
+    weight_keys = ["ttbb", "ttbj", "ttcc", "ttcj", "ttLF"]
+    threshold_keys = ["score_tt_Wcb_min", "score_ttLF_max", "SR_score_tt_Wcb"]
+
+    scan_points = []
+    with open(csv_file, mode = 'r') as f:
+        csv_reader = csv.DictReader(f, skipinitialspace=True)
+        for line in csv_reader:
+            values = {key: [float(x) for x in line[key].split(';')] for key in weight_keys + threshold_keys}
+            grid_keys = [key for key in values if len(values[key]) > 1]
+            for combination in itertools.product(*values.values()):
+                point = dict(zip(values.keys(), combination))
+                name = line['name'] + "".join([f"_{key}{point[key]}".replace('.', 'p') for key in grid_keys])
+                scan_points.append({
+                    'name': name,
+                    'weights': {key: point[key] for key in weight_keys},
+                    'thresholds': {key: point[key] for key in threshold_keys}
+                })
+
+    return scan_points
+
+def variant_selections(selections, channels, add_selection):
+    """
+    Return a copy of the selections for a channel and an additional selection.
+
+    Parameters:
+    - selections: Dictionary containing event selections.
+    - channels: List of channels whose trigger is required ('electron', 'muon').
+    - add_selection: Additional selection to apply to all processes, or None.
+    """
+    selections = selections.copy()
+    # Apply trigger selection to separate channels
+    if "electron" in channels:
+        selections["base"] += " && passTrigEl"
+    if "muon" in channels:
+        selections["base"] += " && passTrigMu"
+    # Apply additional selections
+    if add_selection:
+        for key in selections.keys():
+            selections[key] += f" && ({add_selection})"
+
+    return selections
+
+def read_variants_csv(csv_file, selections):
+    """
+    Open and read a csv file containing the analysis variants to fill from the same read of the input trees.
+    Each line defines a named variant: the channel ('electron', 'muon', or 'all'), the flavour scheme (1 for 5FS, 0 for 4FS)
+    and an additional selection (possibly empty, in quotes if it contains commas).
+    Return a list of dictionaries with keys 'name', 'selections', and 'use5FS'.
+
+    Parameters:
+    - csv_file: The csv file with columns name, channel, use5FS, add_selection.
+    - selections: Dictionary containing the event selections common to all variants.
+    """
+    variants = []
+    with open(csv_file, mode = 'r') as f:
+        csv_reader = csv.DictReader(f, skipinitialspace=True)
+        for line in csv_reader:
+            channel = line['channel'].strip()
+            if not channel in ["electron", "muon", "all"]:
+                raise ValueError(f"Unknown channel '{channel}' for variant '{line['name']}': expected 'electron', 'muon', or 'all'.")
+            variants.append({
+                'name': line['name'].strip(),
+                'selections': variant_selections(selections, [channel], line['add_selection'].strip()),
+                'use5FS': bool(int(line['use5FS']))
+            })
+
+    return variants
+
+def summarize_scan(output_dir, scan_points, hist_configs, data_files, histograms=None):
+    """
+    Compute the yield and the purity of each event classification category for each scan point from the output files
+    (or from the histograms collected in memory), print them and save them to a csv file in the output directory.
+    Must be called before the output files are merged.
+
+    Parameters:
+    - output_dir: Output directory, containing one subdirectory per scan point.
+    - scan_points: List of scan points (see read_scan_csv).
+    - hist_configs: List of dictionaries with keys 'branch', 'nbins', 'xmin', 'xmax'.
+    - data_files: Names of the output files with collision data, which are not included in the yields.
+    - histograms: Dictionary {output file : {histogram name : histogram}} collected by process_trees. None means that the output files are read.
+    """
+    summary = []
+    for point in scan_points:
+        yields = {hist_config['branch']: dict() for hist_config in hist_configs}
+        point_dir = os.path.normpath(f"{output_dir}{point['name']}")
+        if histograms is None:
+            file_names = sorted(glob.glob(f"{point_dir}/h_*.root"))
+        else:
+            file_names = sorted([file_name for file_name in histograms if os.path.normpath(os.path.dirname(file_name)) == point_dir])
+        for file_name in file_names:
+            if os.path.basename(file_name) in data_files:
+                continue
+            process = os.path.basename(file_name).replace('h_', '', 1).replace('.root', '')
+            root_file = ROOT.TFile.Open(file_name) if histograms is None else None
+            for branch_name in yields:
+                hist = root_file.Get(f"h_{branch_name}") if root_file else histograms[file_name].get(f"h_{branch_name}")
+                if hist:
+                    yields[branch_name][process] = hist.Integral()
+            if root_file:
+                root_file.Close()
+
+        for branch_name, process_yields in yields.items():
+            target = adhoc_category_process[branch_name]
+            total_yield = sum(process_yields.values())
+            target_yield = sum([y for process, y in process_yields.items() if process.endswith(target)])
+            summary.append({
+                "point": point['name'], "category": branch_name, "target": target,
+                "target_yield": target_yield, "total_yield": total_yield,
+                "purity": target_yield / total_yield if total_yield > 0 else 0.
+            })
+
+    print(f"{Fore.YELLOW}Event classification scan summary:{Style.RESET_ALL}")
+    for entry in summary:
+        print(f"{entry['point']:<50} {entry['category']:<14} {entry['target']:<5} yield: {entry['target_yield']:>12.2f} / {entry['total_yield']:>12.2f} purity: {entry['purity']:.4f}")
+
+    summary_file = f"{output_dir}scan_summary.csv"
+    with open(summary_file, mode = 'w', newline = '') as f:
+        csv_writer = csv.DictWriter(f, fieldnames=["point", "category", "target", "target_yield", "total_yield", "purity"])
+        csv_writer.writeheader()
+        csv_writer.writerows(summary)
+    print(f"Scan summary saved to: {summary_file}")
+
 def assign_event_weight(year, infile):
     """
     Define the MC event weight according to the year. Collision data should be handled separately.
@@ -201,23 +936,94 @@ def prepare_output(output_dir, input_files):
         for input_file in input_files
     ]
 
-def merge_files(directory, input_files, output_file):
+def read_merge_csv(csv_file):
     """
-    Merges multiple ROOT files into a single ROOT file.
+    Open and read a csv file containing the groups of output files that are merged, e.g. the processes that are plotted together.
+    Each line defines the merged output file, the output files that are summed into it (separated by ';') and the flavour scheme
+    to which the group applies ('4FS', '5FS', or 'all'). A merged file can be the input of a later group.
+    Return a list of dictionaries with keys 'output', 'inputs', and 'scheme'.
 
     Parameters:
-    - directory: Directory where the ROOT files are located.
-    - input_files: List of input ROOT files.
-    - output_file: Output ROOT file.
+    - csv_file: The csv file with columns output, inputs, scheme.
     """
-    if not all([os.path.exists(directory+'/'+infile) for infile in input_files]):
-        print(f"Input files {input_files} not found in directory: {directory}")
-        return
-    
-    hadd_command = f"hadd -f {directory}/{output_file} {' '.join([directory+'/'+infile for infile in input_files])}"
-    os.system(hadd_command)
-    rm_command = f"rm {' '.join([directory+'/'+infile for infile in input_files])}"
-    os.system(rm_command)
+    merge_groups = []
+    with open(csv_file, mode = 'r') as f:
+        csv_reader = csv.DictReader(f, skipinitialspace=True)
+        for line in csv_reader:
+            scheme = line['scheme'].strip()
+            if not scheme in ["4FS", "5FS", "all"]:
+                raise ValueError(f"Unknown flavour scheme '{scheme}' for merged file '{line['output']}': expected '4FS', '5FS', or 'all'.")
+            merge_groups.append({
+                'output': line['output'].strip(),
+                'inputs': [x.strip() for x in line['inputs'].split(';')],
+                'scheme': scheme
+            })
+
+    return merge_groups
+
+def merge_files(directory, merge_groups, use5FS, keep_inputs=False):
+    """
+    Merge the output files of a directory, following the merge groups in order, like hadd does: the histograms of the input files of each group
+    are summed in memory and the merged file is written atomically. The input files are then removed, unless they are kept.
+    A group is skipped if any of its input files is missing, e.g. when the collision data and the simulation are processed in separate runs.
+    Return the list of the merged files.
+
+    Parameters:
+    - directory: Output directory.
+    - merge_groups: List of merge groups (see read_merge_csv).
+    - use5FS: Boolean indicating whether the 5-flavor scheme MC was used for ttbb and ttbj processes.
+    - keep_inputs: Boolean indicating whether to keep the input files of the merge groups as well.
+    """
+    merged_files = []
+    merged_inputs = []
+    for group in merge_groups:
+        if not group['scheme'] in ["all", "5FS" if use5FS else "4FS"]:
+            continue
+        if not all([os.path.exists(os.path.join(directory, infile)) for infile in group['inputs']]):
+            print(f"Input files {group['inputs']} not found in directory: {directory}, {group['output']} is not produced.")
+            continue
+        write_histograms_atomically(os.path.join(directory, group['output']), sum_histograms([read_histograms(os.path.join(directory, infile)) for infile in group['inputs']]))
+        merged_files.append(group['output'])
+        merged_inputs += group['inputs']
+
+    # The inputs are removed once all the groups are merged, since a merged file can be the input of a later group
+    if not keep_inputs:
+        for infile in set(merged_inputs):
+            if os.path.exists(os.path.join(directory, infile)):
+                os.remove(os.path.join(directory, infile))
+
+    return merged_files
+
+def sum_partial_histograms(results):
+    """
+    Combine the histograms returned by the tasks, in the order of the tasks: the histograms of the parts of an input file split into entry ranges are summed,
+    so that the result only depends on the list of tasks, and not on the order in which they finish.
+    Return a dictionary {output file : {histogram name : histogram}}.
+
+    Parameters:
+    - results: List of dictionaries {output file : {histogram name : histogram}}, one per task.
+    """
+    histograms = dict()
+    for result in results:
+        for output_file, hists in result.items():
+            histograms[output_file] = sum_histograms([histograms[output_file], hists]) if output_file in histograms else hists
+
+    return histograms
+
+def write_outputs(histograms):
+    """
+    Write the histograms collected in memory, each output file once.
+
+    Parameters:
+    - histograms: Dictionary {output file : {histogram name : histogram}} collected by process_trees.
+    """
+    directories = dict()
+    for output_file, hists in histograms.items():
+        write_histograms_atomically(output_file, hists)
+        directories[os.path.dirname(output_file)] = directories.get(os.path.dirname(output_file), 0) + 1
+
+    for directory, written in directories.items():
+        print(f"{Fore.YELLOW}Wrote {written} output files to: {directory}{Style.RESET_ALL}")
 
 def score_calculation(score_tt_Wcb, score_ttLF, score_ttbb, score_ttbj):
     """
@@ -246,12 +1052,51 @@ if __name__ == "__main__":
     parser.add_argument("--event_counting_file", type=str, required=False, help="File to save event counts for each selection.")
     parser.add_argument("--eventClassification", nargs="?", const=1, type=bool, default=False, required=False, help="Apply event classification selection.")
     parser.add_argument("--use5FS", nargs="?", const=1, type=bool, default=False, required=False, help="Use 5-flavor scheme.")
+    parser.add_argument("--variants_csv", type=str, required=False, help="csv file with analysis variants (channel, flavour scheme, additional selection) to fill from a single read of the input files, each in its own output subdirectory.")
+    parser.add_argument("--scan_csv", type=str, required=False, help="csv file with event classification weight sets and thresholds to fill in a single event loop (requires --eventClassification).")
+    parser.add_argument("--sparse_nbins", type=int, default=0, required=False, help="Also fill a multidimensional histogram of the scores with this number of bins per score (see scoreCuts.py).")
+    parser.add_argument("--fine_binning", nargs="?", const=1, type=bool, default=False, required=False, help="Fill the event classification histograms with a fine binning, to be rebinned with rebinHistos.py.")
+    parser.add_argument("--cache_dir", type=str, required=False, help="Directory of the histogram cache. Histograms whose inputs did not change are reused from the cache.")
+    parser.add_argument("--cache_max_size", type=float, default=10., required=False, help="Maximum size of the histogram cache in GB. The least recently used histograms are evicted first.")
+    parser.add_argument("--skim_dir", type=str, required=False, help="Directory of the skims produced by skim.py, read instead of the input files when they are up to date.")
+    parser.add_argument("--friends", nargs="?", const=1, type=bool, default=False, required=False, help="Read the derived columns from friend trees, built on the first run and rebuilt when stale.")
+    parser.add_argument("--friend_dir", type=str, required=False, help="Directory of the friend trees (required for remote input files). Default: the friends/ subdirectory of the input directory.")
+    parser.add_argument("--kernels", nargs="?", const=1, type=bool, default=False, required=False, help="Declare the selections, weights and derived columns as C++ functions once per process, instead of compiling them again for each file.")
+    parser.add_argument("--timing", nargs="?", const=1, type=bool, default=False, required=False, help="Report the time spent by RDataFrame in just-in-time compilation and in the event loops.")
+    parser.add_argument("--optimize", nargs="?", const=1, type=bool, default=False, required=False, help="Fold the known constants in the selections and weights, filter the base selection once per file, and order the conditions by rejection power.")
+    parser.add_argument("--pass_rates_file", type=str, required=False, help="csv file with the pass rate of each condition of the selections (columns 'conjunct' and 'pass_rate'), used with --optimize to evaluate the most rejecting conditions first.")
+    parser.add_argument("--measure_pass_rates", type=int, default=0, required=False, help="Measure the pass rate of each condition on this number of events per file and add it to --pass_rates_file (requires --optimize).")
+    parser.add_argument("--manifest_file", type=str, default="sample_manifest.json", required=False, help="json file caching the sample manifest. The input directories and files that did not change are not scanned again.")
+    parser.add_argument("--stage_dir", type=str, required=False, help="Local directory (e.g. on the SSD of the node) where the input files are copied, the next ones in the background while the current one is processed, and reused by later runs.")
+    parser.add_argument("--stage_max_size", type=float, default=50., required=False, help="Maximum size of the staging directory in GB. The least recently used copies are evicted first.")
+    parser.add_argument("--prefetch", type=int, default=2, required=False, help="Number of upcoming input files copied to --stage_dir in the background.")
+    parser.add_argument("--io_profile", type=str, required=False, help="Input/output profile of --io_csv (e.g. 'eos' or 'local'), setting the TTreeCache size, the read-ahead, the cluster prefetching and the explicit branch list.")
+    parser.add_argument("--io_csv", type=str, default="hconfig_io.csv", required=False, help="csv file with the input/output profiles.")
+    parser.add_argument("--tree_cache_size", type=float, required=False, help="TTreeCache size in MB (0 disables the cache), overriding the profile.")
+    parser.add_argument("--readahead_size", type=float, required=False, help="Read-ahead size of the input files in MB (0 disables it), overriding the profile.")
+    parser.add_argument("--cluster_prefetch", nargs="?", const=1, type=bool, default=False, required=False, help="Prefetch the next cluster of the input trees asynchronously.")
+    parser.add_argument("--explicit_branches", nargs="?", const=1, type=bool, default=False, required=False, help="Cache the branches read by the booked actions from the first entry, instead of learning them.")
+    parser.add_argument("--merge_csv", type=str, default="hconfig_merge.csv", required=False, help="csv file with the groups of output files merged at the end of the run, once all the output files are written. An empty string disables the merging.")
+    parser.add_argument("--keep_merge_inputs", nargs="?", const=1, type=bool, default=False, required=False, help="Keep the output files that are merged into the groups of --merge_csv.")
+    parser.add_argument("--backend", type=str, default="rdf", choices=["rdf", "numpy"], required=False, help="Fill the histograms with RDataFrame, or read the columns with uproot and fill the histograms with NumPy (no just-in-time compilation).")
+    parser.add_argument("--chunk_size", type=int, default=1000000, required=False, help="Number of entries read and processed at once by the NumPy backend.")
+    parser.add_argument("--memory_budget", type=float, default=0., required=False, help="Memory budget in GB of the chunks streamed by the NumPy backend, from which the chunk size and the number of threads (at most --threads) are chosen. Requires --backend numpy: the memory of the RDataFrame backend (per-thread copies of the histograms) is not bounded by the budget, use --threads to limit it.")
+    parser.add_argument("--jobs", type=int, default=1, required=False, help="Number of input files processed concurrently in separate processes.")
+    parser.add_argument("--max_entries_per_task", type=int, default=0, required=False, help="Split the input files with more entries into entry ranges, processed as separate single-threaded tasks by the --jobs worker processes, and sum their histograms. 0 means one task per file.")
+    parser.add_argument("--threads", type=int, default=0, required=False, help="Number of ROOT threads (per process). 0 means all the available cores.")
+    parser.add_argument("--run_graphs", nargs="?", const=1, type=bool, default=False, required=False, help="Build the computation graphs of all files up front and run them concurrently in one process.")
+    parser.add_argument("--single_event_loop", nargs="?", const=1, type=bool, default=False, required=False, help="Book all histograms of a file first and fill them in a single event loop.")
+    parser.add_argument("--journal", nargs="?", const=1, type=bool, default=False, required=False, help="Record each (file, selection, variant) unit in a run journal in the output directory as soon as its histograms are written, so that the run can be resumed.")
+    parser.add_argument("--resume", nargs="?", const=1, type=bool, default=False, required=False, help="Resume a run recorded in the journal: skip the completed units and process the failed or interrupted ones again (implies --journal).")
 
     args = parser.parse_args()
 
-    # Get input files from the input_dirs list
-    for input_dir in args.input_dirs:
-        input_files = glob.glob(f"{input_dir}*.root")
+    # Scan all the input directories into the sample manifest, cached between runs, and process all the samples in a single run
+    manifest = build_manifest(args.input_dirs, args.tree_name, args.year, list(event_selections.keys()), assign_event_weight, args.manifest_file)
+
+    # Process the largest files first to minimize the tail of the run
+    manifest = sorted(manifest, key=lambda sample: -sample["size"])
+    input_files = [sample["path"] for sample in manifest]
 
     # Prepare list of output files based on the name of the input files
     output_files = prepare_output(args.output_dir, input_files)
@@ -259,53 +1104,131 @@ if __name__ == "__main__":
     # Prepare histogram configurations for each branch
     hist_configs = read_csv(args.input_csv)
 
-    selections = {"base": "n_ak4>=4 && (n_btagM+n_ctagM)>=3 && n_btagM>=1",
-                 "ttbb" : " && genEventClassifier==9 && wcb==0",
-                 "ttbj" : " && (genEventClassifier==7 || genEventClassifier==8) && wcb==0",
-                 "ttcc" : " && genEventClassifier==6 && wcb==0",
-                 "ttcj" : " && (genEventClassifier==4 || genEventClassifier==5) && wcb==0",
-                 "ttLF" : " && tt_category==0 && higgs_decay==0 && wcb==0"
-    }
+    # Prepare the event classification weight sets to scan, each written to its own output directory
+    scan_points = None
+    if args.scan_csv:
+        if not args.eventClassification:
+            raise ValueError("Scanning the event classification weight sets requires --eventClassification.")
+        scan_points = read_scan_csv(args.scan_csv)
+        print(f"{Fore.YELLOW}Scanning {len(scan_points)} event classification weight sets: {[point['name'] for point in scan_points]}{Style.RESET_ALL}")
 
     # These weights correspond (roughly) to the fraction of events of a certain process expected in the corresponding category after the ttWcb and ttLF score selection.
     #from weights_and_constants import weights_and_constants
     #wc = weights_and_constants()
     #evtClassification_weights = wc.weights_0p6ttWcb_and_0p1ttLF
 
-    # Apply trigger selection to separate channels if requested
-    if args.electron:
-        selections["base"] += " && passTrigEl"
-    if args.muon:
-        selections["base"] += " && passTrigMu"
+    # Apply trigger selection to separate channels and additional selections if requested
+    channels = [channel for channel, requested in [("electron", args.electron), ("muon", args.muon)] if requested]
+    selections = variant_selections(event_selections, channels, args.add_selection)
 
     use5FS = False
     if args.use5FS:
         use5FS = True
         print(f"{Fore.GREEN}Using 5-flavor scheme for ttbb and ttbj processes.{Style.RESET_ALL}")
 
-    # Apply additional selections if specified
-    if args.add_selection:
-        for key in selections.keys():
-            selections[key] += f" && ({args.add_selection})"
-
-    process_trees(input_files, output_files, args.tree_name, hist_configs, args.year, selections, args.eventClassification, use5FS)
-
-    # Merge some of the output files
-    ttV_list = ["h_ttW.root", "h_ttZ.root"]
-    merge_files(args.output_dir, ttV_list, "h_ttV.root")
-    ttH_list = ["h_ttHbb.root", "h_ttHcc.root", "h_ttV.root"]
-    merge_files(args.output_dir, ttH_list, "h_ttH-ttV.root")
-    if use5FS:
-        ttbb_list = ["h_ttbar-powheg_ttbb.root", "h_ttbb-dps_ttbb.root"]
-        merge_files(args.output_dir, ttbb_list, "h_ttbb-withDPS.root")
-        ttbj_list = ["h_ttbar-powheg_ttbj.root", "h_ttbb-dps_ttbj.root"]
-        merge_files(args.output_dir, ttbj_list, "h_ttbj-withDPS.root")
+    # Fill all the variants from the same read of the input trees, each in its own output subdirectory
+    variants = None
+    output_dirs = [(args.output_dir, use5FS)]
+    if args.variants_csv:
+        variants = read_variants_csv(args.variants_csv, event_selections)
+        print(f"{Fore.YELLOW}Filling {len(variants)} variants: {[variant['name'] for variant in variants]}{Style.RESET_ALL}")
+        output_dirs = [(f"{args.output_dir}{variant['name']}/", variant['use5FS']) for variant in variants]
+    for output_dir, _ in output_dirs:
+        os.makedirs(output_dir, exist_ok=True)
+        for point in scan_points or []:
+            os.makedirs(f"{output_dir}{point['name']}/", exist_ok=True)
+
+    # Input/output settings from the profile, overridden by the command line
+    io_settings = read_io_csv(args.io_csv, args.io_profile) if args.io_profile else dict(default_io_settings)
+    if args.tree_cache_size is not None:
+        io_settings["cache_size_mb"] = args.tree_cache_size
+    if args.readahead_size is not None:
+        io_settings["readahead_mb"] = args.readahead_size
+    io_settings["cluster_prefetch"] = io_settings["cluster_prefetch"] or args.cluster_prefetch
+    io_settings["explicit_branches"] = io_settings["explicit_branches"] or args.explicit_branches
+
+    # Groups of output files merged at the end of the run
+    merge_groups = read_merge_csv(args.merge_csv) if args.merge_csv else None
+
+    if args.backend == "numpy":
+        unsupported = [option for option, value in [("--sparse_nbins", args.sparse_nbins), ("--cache_dir", args.cache_dir), ("--friends", args.friends), ("--kernels", args.kernels),
+                                                    ("--timing", args.timing), ("--optimize", args.optimize), ("--run_graphs", args.run_graphs)] if value]
+        if unsupported:
+            raise ValueError(f"The NumPy backend does not support: {', '.join(unsupported)}.")
+    elif args.memory_budget > 0:
+        raise ValueError("The memory budget requires --backend numpy: the memory of the RDataFrame backend is not bounded (use --threads to limit it).")
+
+    # Distributed mode: the histograms of the parts of a file are collected and summed before being written
+    distributed = args.max_entries_per_task > 0
+    if distributed:
+        unsupported = [option for option, value in [("--cache_dir", args.cache_dir), ("--measure_pass_rates", args.measure_pass_rates), ("--run_graphs", args.run_graphs)] if value]
+        if unsupported:
+            raise ValueError(f"Splitting the input files into entry ranges does not support: {', '.join(unsupported)}.")
+    collect = distributed
+
+    if args.measure_pass_rates > 0 and not (args.optimize and args.pass_rates_file):
+        raise ValueError("Measuring the pass rates requires --optimize and --pass_rates_file.")
+    pass_rates = read_pass_rates(args.pass_rates_file) if args.pass_rates_file and os.path.exists(args.pass_rates_file) else None
+
+    # Journal of the units of the run. Everything that determines the content of the outputs is part of its configuration:
+    # the units completed with another configuration are processed again.
+    journal = None
+    if args.journal or args.resume:
+        configuration = {"tree": args.tree_name, "hist_configs": hist_configs, "year": args.year, "selections": selections, "eventClassification": args.eventClassification,
+                         "use5FS": use5FS, "variants": variants, "scan_points": scan_points, "sparse_nbins": args.sparse_nbins, "fine_binning": args.fine_binning, "collect": collect}
+        journal = run_journal(f"{args.output_dir}run_journal.jsonl", configuration, args.resume)
+        if args.resume:
+            journal.report()
+
+    # Arguments of process_trees shared by all the tasks
+    options = dict(tree_name=args.tree_name, hist_configs=hist_configs, year=args.year, selections=selections, eventClassification=args.eventClassification, use5FS=use5FS,
+                   single_event_loop=args.single_event_loop, scan_points=scan_points, sparse_nbins=args.sparse_nbins, fine_binning=args.fine_binning,
+                   cache_dir=args.cache_dir, cache_max_size=args.cache_max_size, skim_dir=args.skim_dir, friends=args.friends, friend_dir=args.friend_dir,
+                   kernels=args.kernels, timing=args.timing, optimize=args.optimize, pass_rates=pass_rates, measure_events=args.measure_pass_rates,
+                   pass_rates_file=args.pass_rates_file, variants=variants, collect_histograms=collect, stage_dir=args.stage_dir, stage_max_size=args.stage_max_size,
+                   prefetch=args.prefetch, io_settings=io_settings, backend=args.backend, chunk_size=args.chunk_size, memory_budget=args.memory_budget)
+
+    if args.jobs > 1 or distributed:
+        # In distributed mode (a local stand-in for a batch cluster), each task runs on a single core, and the files with more entries than
+        # max_entries_per_task are split into parts of about the same size. The parts are not journaled, and their histograms are summed in the order of the parts.
+        threads = 1 if distributed else args.threads
+        tasks = []
+        labels = []
+        task_entries = []
+        for infile, outfile, sample in zip(input_files, output_files, manifest):
+            parts = max(1, -(-sample["entries"] // args.max_entries_per_task)) if distributed else 1
+            for part in range(parts):
+                tasks.append(dict(options, input_files=[infile], output_files=[outfile], samples=[sample], run_graphs=False, max_threads=threads or max(1, available_cores() // args.jobs),
+                                  journal=journal if parts == 1 else None, entry_parts=[(part, parts)] if parts > 1 else None))
+                labels.append(f"{os.path.basename(infile)} ({part + 1}/{parts})" if parts > 1 else os.path.basename(infile))
+                task_entries.append(sample["entries"] / parts)
+        if distributed:
+            print(f"{Fore.YELLOW}Splitting {len(input_files)} files into {len(tasks)} tasks of at most about {args.max_entries_per_task} entries.{Style.RESET_ALL}")
+
+        # The largest tasks are started first, and the results are summed in the order of the files and of their parts
+        order = sorted(range(len(tasks)), key=lambda idx: -task_entries[idx])
+        timings = []
+        task_results = [None] * len(tasks)
+        for idx, result in zip(order, run_process_pool(process_trees, [tasks[idx] for idx in order], args.jobs, threads, timings)):
+            task_results[idx] = result
+        collected_histograms = sum_partial_histograms(task_results)
+        print_task_timing([labels[idx] for idx in order], timings)
     else:
-        ttbb_list = ["h_ttbb-4f_ttbb.root", "h_ttbb-dps_ttbb.root"]
-        merge_files(args.output_dir, ttbb_list, "h_ttbb-withDPS.root")
-        ttbj_list = ["h_ttbb-4f_ttbj.root", "h_ttbb-dps_ttbj.root"]
-        merge_files(args.output_dir, ttbj_list, "h_ttbj-withDPS.root")
-    diboson_list = ["h_TWZ.root", "h_diboson.root"]
-    merge_files(args.output_dir, diboson_list, "h_diboson-tWZ.root")
-    data_list = ["h_singlee.root", "h_singlemu.root"]
-    merge_files(args.output_dir, data_list, "h_Data.root")
+        enable_multithreading(args.threads)
+        collected_histograms = process_trees(input_files, output_files, samples=manifest, run_graphs=args.run_graphs, max_threads=args.threads, journal=journal, **options)
+
+    # Summarize the scan before the output files are merged
+    if scan_points:
+        for output_dir, _ in output_dirs:
+            summarize_scan(output_dir, scan_points, hist_configs, ["h_singlee.root", "h_singlemu.root", "h_Data.root"], collected_histograms if collect else None)
+
+    # Write the histograms summed in memory
+    if collect:
+        write_outputs(collected_histograms)
+
+    # Merge some of the output files of each variant, once they are all written
+    if merge_groups:
+        for output_dir, variant_use5FS in output_dirs:
+            for directory in [output_dir] + [f"{output_dir}{point['name']}/" for point in scan_points or []]:
+                merged_files = merge_files(directory, merge_groups, variant_use5FS, args.keep_merge_inputs)
+                print(f"{Fore.YELLOW}Merged {len(merged_files)} output files in: {directory}{Style.RESET_ALL}")
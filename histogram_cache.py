@@ -0,0 +1,147 @@
+import ROOT
+import os
+import json
+import hashlib
+from colorama import Fore, Style
+
+# Increase when the definition of the derived columns changes, to invalidate the cached histograms
+CACHE_VERSION = 1
+
+class histogram_cache:
+    """
+    Content-addressed cache of filled histograms. Each histogram is stored in its own ROOT file, named after the hash of everything
+    that determines its content (input file, tree, selection, weight, derived columns, binning, branch). The least recently used histograms are evicted
+    when the cache exceeds its maximum size.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=10.):
+        self.cache_dir = cache_dir
+        self.max_size = max_size_gb * 1024**3
+        self.hits = 0
+        self.misses = 0
+        self.pending = []
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, fields):
+        """
+        Return the cache key of a histogram.
+
+        Parameters:
+        - fields: Dictionary with everything that determines the content of the histogram.
+        """
+        fields = dict(fields, cache_version=CACHE_VERSION)
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key):
+        """
+        Return the path of the cache entry for a key.
+        """
+        return os.path.join(self.cache_dir, f"{key}.root")
+
+    def load(self, key):
+        """
+        Return the cached histogram for a key, or None if it is not in the cache.
+
+        Parameters:
+        - key: Cache key of the histogram.
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        cache_file = ROOT.TFile.Open(path)
+        hist = cache_file.Get("hist") if cache_file and not cache_file.IsZombie() else None
+        if not hist:
+            print(f"{Fore.YELLOW}Removing unreadable cache entry: {path}{Style.RESET_ALL}")
+            if cache_file:
+                cache_file.Close()
+            os.remove(path)
+            self.misses += 1
+            return None
+        hist = hist.Clone()
+        if isinstance(hist, ROOT.TH1): # Multidimensional (THnSparse) histograms are not attached to files
+            hist.SetDirectory(0) # Detach from the file
+        cache_file.Close()
+
+        # Mark the entry as recently used
+        os.utime(path)
+        self.hits += 1
+
+        return hist
+
+    def add_pending(self, key, hist):
+        """
+        Register a booked histogram, to be stored once it has been filled.
+
+        Parameters:
+        - key: Cache key of the histogram.
+        - hist: Booked histogram.
+        """
+        self.pending.append((key, hist))
+
+    def store_pending(self):
+        """
+        Store the registered histograms, which must have been filled already, and evict the least recently used entries if needed.
+        """
+        for key, hist in self.pending:
+            path = self.path(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            cache_file = ROOT.TFile(tmp_path, "RECREATE")
+            hist.Write("hist")
+            cache_file.Close()
+            os.replace(tmp_path, path)
+        self.pending = []
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is smaller than its maximum size.
+        """
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(".root"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError: # Evicted by a concurrent process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+
+        total_size = sum([size for _, size, _ in entries])
+        for _, size, file_name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def report(self):
+        """
+        Print the number of cache hits and misses.
+        """
+        print(f"{Fore.YELLOW}Histogram cache: {self.hits} hits, {self.misses} misses.{Style.RESET_ALL}")
+
+def book_cached(cache, fields, book):
+    """
+    Load a histogram from the cache, or book it and register it to be stored in the cache after the event loop.
+
+    Parameters:
+    - cache: Histogram cache, or None to always book the histogram.
+    - fields: Dictionary with everything that determines the content of the histogram.
+    - book: Function booking the histogram.
+    """
+    if cache is None:
+        return book()
+
+    key = cache.key(fields)
+    hist = cache.load(key)
+    if hist is not None:
+        return hist
+
+    hist = book()
+    cache.add_pending(key, hist)
+
+    return hist
@@ -0,0 +1,85 @@
+import ROOT
+import os
+import fcntl
+
+def read_histograms(root_file_name):
+    """
+    Read all the histograms of a ROOT file into memory, including the multidimensional (THnSparse) ones. Return a dictionary {histogram name : histogram}.
+
+    Parameters:
+    - root_file_name: Input ROOT file.
+    """
+    root_file = ROOT.TFile.Open(root_file_name)
+    if not root_file or root_file.IsZombie():
+        raise FileNotFoundError(f"Could not open file: {root_file_name}")
+
+    histograms = dict()
+    for key in root_file.GetListOfKeys():
+        # Keys are sorted by decreasing cycle, so keep only the first (i.e., latest) cycle of each histogram
+        if key.GetName() in histograms:
+            continue
+        obj = key.ReadObj()
+        if obj.InheritsFrom(ROOT.TH1.Class()):
+            obj.SetDirectory(0) # Detach from the file
+        elif not obj.InheritsFrom(ROOT.THnBase.Class()): # Not attached to the file
+            continue
+        histograms[key.GetName()] = obj
+    root_file.Close()
+
+    return histograms
+
+def write_histograms_atomically(output_file, histograms, update=False):
+    """
+    Write histograms to a ROOT file in one go. The histograms are first written to a temporary file in the same directory,
+    which then replaces the output file, so that an interrupted run never leaves a half-written file behind.
+    The directory of the output file is locked (with a single lock file per directory) while the file is being rewritten, so that concurrent
+    processes can safely update the same file. The temporary file is removed if the writing fails.
+
+    Parameters:
+    - output_file: Output ROOT file.
+    - histograms: Dictionary {histogram name : histogram}.
+    - update: Keep the histograms already in the output file, unless they are replaced by new histograms with the same name.
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(output_file)), ".histograms.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        tmp_file = f"{output_file}.{os.getpid()}.tmp"
+        output_root = None
+        try:
+            all_histograms = read_histograms(output_file) if update and os.path.exists(output_file) else dict()
+            all_histograms.update(histograms)
+
+            output_root = ROOT.TFile(tmp_file, "RECREATE")
+            if not output_root or output_root.IsZombie():
+                raise OSError(f"Could not create file: {tmp_file}")
+            output_root.cd()
+            for hist_name, hist in all_histograms.items():
+                hist.Write(hist_name)
+            output_root.Close()
+            os.replace(tmp_file, output_file)
+        finally:
+            # Nothing is left behind if the writing failed
+            if output_root:
+                output_root.Close()
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def sum_histograms(histogram_sets):
+    """
+    Sum sets of histograms by name, like hadd does for files. Return a dictionary {histogram name : summed histogram},
+    with the histograms in the order in which they first appear. The input histograms are not modified.
+
+    Parameters:
+    - histogram_sets: List of dictionaries {histogram name : histogram}.
+    """
+    summed = dict()
+    for histograms in histogram_sets:
+        for hist_name, hist in histograms.items():
+            if hist_name in summed:
+                summed[hist_name].Add(hist)
+                continue
+            summed[hist_name] = hist.Clone()
+            if isinstance(summed[hist_name], ROOT.TH1):
+                summed[hist_name].SetDirectory(0)
+
+    return summed
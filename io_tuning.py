@@ -0,0 +1,103 @@
+import ROOT
+import csv
+from colorama import Fore, Style
+from skim import discover_columns
+
+# Settings that leave the ROOT defaults untouched. Sizes are in MB, -1 means the ROOT default.
+default_io_settings = {"cache_size_mb": -1., "readahead_mb": -1., "cluster_prefetch": False, "explicit_branches": False}
+
+def read_io_csv(csv_file, profile):
+    """
+    Open and read a csv file containing named input/output profiles (e.g. for EOS or for a local SSD) and return the settings of one of them,
+    as a dictionary with keys 'cache_size_mb', 'readahead_mb', 'cluster_prefetch', 'explicit_branches'.
+
+    Parameters:
+    - csv_file: The csv file with columns profile, cache_size_mb, readahead_mb, cluster_prefetch, explicit_branches.
+    - profile: Name of the profile.
+    """
+    with open(csv_file, mode = 'r') as f:
+        csv_reader = csv.DictReader(f, skipinitialspace=True)
+        for line in csv_reader:
+            if line['profile'].strip() == profile:
+                return {
+                    "cache_size_mb": float(line['cache_size_mb']), "readahead_mb": float(line['readahead_mb']),
+                    "cluster_prefetch": bool(int(line['cluster_prefetch'])), "explicit_branches": bool(int(line['explicit_branches']))
+                }
+
+    raise ValueError(f"Input/output profile '{profile}' not found in {csv_file}.")
+
+def apply_global_io_settings(settings):
+    """
+    Apply the settings that are global to the process, i.e. the read-ahead of the input files.
+
+    Parameters:
+    - settings: Dictionary of input/output settings (see read_io_csv).
+    """
+    if settings["readahead_mb"] >= 0:
+        ROOT.TFile.SetReadaheadSize(int(settings["readahead_mb"] * 1024**2))
+
+def tree_io_settings(settings):
+    """
+    Return the settings applied to the input trees. With implicit multithreading, RDataFrame reads the tree through one tree per task,
+    which the TTreeCache size, the cluster prefetching and the explicit branch list of the input tree do not reach: these settings are
+    then dropped, with a warning, and only the global settings apply.
+
+    Parameters:
+    - settings: Dictionary of input/output settings (see read_io_csv).
+    """
+    if not ROOT.ROOT.IsImplicitMTEnabled():
+        return settings
+
+    ignored = [name for name, value in settings.items() if not name == "readahead_mb" and not value == default_io_settings[name]]
+    if ignored:
+        print(f"{Fore.YELLOW}Implicit multithreading is enabled: the settings {ignored} do not apply to the trees read by the RDataFrame tasks "
+              f"and are ignored (use --threads 1 to apply them).{Style.RESET_ALL}")
+
+    return dict(settings, cache_size_mb=default_io_settings["cache_size_mb"], cluster_prefetch=False, explicit_branches=False)
+
+def configure_tree(tree, settings, expressions):
+    """
+    Configure the TTreeCache of an input tree: its size, the asynchronous prefetching of the next cluster and, instead of learning
+    the branches to cache on the first entries, the explicit list of the branches read by the booked selections, weights and histograms.
+    With implicit multithreading, these settings do not apply (see tree_io_settings).
+    Return the list of branches added to the cache.
+
+    Parameters:
+    - tree: Input TTree.
+    - settings: Dictionary of input/output settings (see read_io_csv).
+    - expressions: Selections, weights, definitions and branches of the booked actions, from which the branches read are discovered.
+    """
+    if settings["cache_size_mb"] >= 0:
+        tree.SetCacheSize(int(settings["cache_size_mb"] * 1024**2))
+    if settings["cluster_prefetch"]:
+        tree.SetClusterPrefetch(True)
+
+    cached_branches = []
+    if settings["explicit_branches"] and not settings["cache_size_mb"] == 0: # A size of 0 disables the cache
+        cached_branches = discover_columns(expressions, [branch.GetName() for branch in tree.GetListOfBranches()])
+        for branch_name in cached_branches:
+            tree.AddBranchToCache(branch_name, True)
+        tree.StopCacheLearningPhase()
+
+    return cached_branches
+
+def io_counters():
+    """
+    Return the number of bytes read and of read calls from all the files opened by the process so far, including the files opened
+    by RDataFrame in the worker threads.
+    """
+    return ROOT.TFile.GetFileBytesRead(), ROOT.TFile.GetFileReadCalls()
+
+def print_io_report(infile, start_counters, elapsed):
+    """
+    Print the bytes read, the number of read calls and the effective throughput since the given counters were taken.
+
+    Parameters:
+    - infile: Input ROOT file (or description of the files) the report refers to.
+    - start_counters: Counters (see io_counters) taken at the start.
+    - elapsed: Elapsed time in seconds.
+    """
+    bytes_read, read_calls = [end - start for start, end in zip(start_counters, io_counters())]
+    throughput = bytes_read / 1024**2 / elapsed if elapsed > 0 else 0.
+    print(f"{Fore.YELLOW}Input/output for {infile}: {bytes_read / 1024**2:.1f} MB read in {read_calls} calls "
+          f"({bytes_read / read_calls / 1024 if read_calls > 0 else 0.:.1f} kB per call), {throughput:.1f} MB/s{Style.RESET_ALL}")
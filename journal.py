@@ -0,0 +1,175 @@
+import fcntl
+import hashlib
+import json
+import os
+import time
+from colorama import Fore, Style
+from histogram_io import read_histograms, write_histograms_atomically
+from staging import file_checksum
+
+# Increase when the layout of the journal changes, to process all the units again
+JOURNAL_VERSION = 1
+
+def unit_name(infile, variant_name, selection_name):
+    """
+    Return the name of a unit of work, i.e. the histograms of one selection of one variant of an input file.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - variant_name: Name of the variant, or an empty string.
+    - selection_name: Name of the selection.
+    """
+    return f"{infile}:{variant_name}:{selection_name}"
+
+def input_stamp(infile):
+    """
+    Return the size and the modification time of an input file, or None if they cannot be determined (e.g., remote xrootd paths).
+
+    Parameters:
+    - infile: Input ROOT file.
+    """
+    try:
+        stat = os.stat(infile)
+    except OSError:
+        return None
+
+    return [stat.st_size, stat.st_mtime]
+
+class run_journal:
+    """
+    Journal of a run, recording which units of work were started and which were completed, with the checksums of their outputs.
+    The journal is a json file with one record per line, appended (under a lock, so that concurrent processes can share it) and flushed
+    as soon as a unit starts or completes, so that it survives a crash. A unit is completed if its last record says so, the configuration
+    and the input file did not change, and its outputs still match their checksums; units that were started but not completed (failed,
+    or interrupted by a crash) are processed again.
+    The histograms of the units that are written at the end of the run are kept in a directory next to the journal.
+    """
+
+    def __init__(self, journal_file, configuration, resume=True):
+        self.journal_file = journal_file
+        self.unit_dir = f"{os.path.splitext(journal_file)[0]}_units"
+        self.configuration = hashlib.sha256(json.dumps(configuration, sort_keys=True, default=lambda x: x.tolist() if hasattr(x, "tolist") else str(x)).encode()).hexdigest()
+        self.records = dict()
+        os.makedirs(self.unit_dir, exist_ok=True)
+
+        if not resume:
+            # A new run: start from an empty journal
+            with open(f"{journal_file}.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                open(journal_file, "w").close()
+                for file_name in os.listdir(self.unit_dir):
+                    os.remove(os.path.join(self.unit_dir, file_name))
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        elif os.path.exists(journal_file):
+            with open(journal_file) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError: # Last line cut by a crash
+                        continue
+                    if record.get("version") == JOURNAL_VERSION:
+                        self.records[record["unit"]] = record
+
+    def append(self, records):
+        """
+        Append records to the journal and flush them to disk.
+
+        Parameters:
+        - records: List of dictionaries.
+        """
+        with open(f"{self.journal_file}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.journal_file, "ab+") as f:
+                # Terminate the last line if it was cut by a crash
+                if f.seek(0, os.SEEK_END) > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if not f.read(1) == b"\n":
+                        f.write(b"\n")
+                for record in records:
+                    f.write((json.dumps(dict(record, version=JOURNAL_VERSION, configuration=self.configuration, time=time.time())) + "\n").encode())
+                f.flush()
+                os.fsync(f.fileno())
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        for record in records:
+            self.records[record["unit"]] = dict(record, version=JOURNAL_VERSION, configuration=self.configuration)
+
+    def completed(self, unit, infile):
+        """
+        Return True if a unit was completed by this or a previous run with the same configuration, and its outputs did not change since.
+
+        Parameters:
+        - unit: Name of the unit (see unit_name).
+        - infile: Input ROOT file of the unit.
+        """
+        record = self.records.get(unit)
+        if not record or not record["status"] == "done" or not record["configuration"] == self.configuration or not record["input"] == input_stamp(infile):
+            return False
+        for output in record["outputs"].values():
+            if not os.path.exists(output["path"]) or not file_checksum(output["path"]) == output["checksum"]:
+                return False
+
+        return True
+
+    def start(self, infile, units):
+        """
+        Record that units of an input file are being processed.
+
+        Parameters:
+        - infile: Input ROOT file.
+        - units: List of unit names.
+        """
+        self.append([{"unit": unit, "status": "started", "input": input_stamp(infile)} for unit in units])
+
+    def done(self, unit, infile, outputs, data=None):
+        """
+        Record that a unit was completed, with the checksums of its outputs.
+
+        Parameters:
+        - unit: Name of the unit.
+        - infile: Input ROOT file of the unit.
+        - outputs: Dictionary {output file : file holding its histograms}, i.e. the output file itself or its copy in the journal (see stash).
+        - data: Additional json-serializable data kept with the record (e.g. the cutflow of the unit).
+        """
+        self.append([{
+            "unit": unit, "status": "done", "input": input_stamp(infile), "data": data,
+            "outputs": {output_file: {"path": path, "checksum": file_checksum(path)} for output_file, path in outputs.items()}
+        }])
+
+    def stash(self, unit, output_file, histograms):
+        """
+        Write the histograms of an output file of a unit to the journal directory, to be loaded by a resumed run. Return the path of the file.
+
+        Parameters:
+        - unit: Name of the unit.
+        - output_file: Output file the histograms belong to.
+        - histograms: Dictionary {histogram name : histogram}.
+        """
+        path = os.path.join(self.unit_dir, f"{hashlib.sha256(f'{unit}|{output_file}'.encode()).hexdigest()[:16]}_{os.path.basename(output_file)}")
+        write_histograms_atomically(path, histograms)
+
+        return path
+
+    def load(self, unit):
+        """
+        Read the histograms of a completed unit. Return a dictionary {output file : {histogram name : histogram}}.
+
+        Parameters:
+        - unit: Name of the unit.
+        """
+        return {output_file: read_histograms(output["path"]) for output_file, output in self.records[unit]["outputs"].items()}
+
+    def data(self, unit):
+        """
+        Return the additional data recorded with a completed unit.
+
+        Parameters:
+        - unit: Name of the unit.
+        """
+        return self.records[unit].get("data")
+
+    def report(self):
+        """
+        Print the number of units completed and of units started but not completed (failed or interrupted) in the journal.
+        """
+        statuses = [record["status"] for record in self.records.values()]
+        print(f"{Fore.YELLOW}Journal {self.journal_file}: {statuses.count('done')} units completed, {statuses.count('started')} started but not completed.{Style.RESET_ALL}")
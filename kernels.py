@@ -0,0 +1,61 @@
+import ROOT
+import hashlib
+import time
+from colorama import Fore, Style
+from skim import discover_columns
+
+# Kernels already declared in this process, {expression : call template}
+declared_kernels = dict()
+# Time spent declaring (i.e., compiling) the kernels in this process
+kernel_timing = {"declared": 0, "reused": 0, "declare_time": 0.}
+
+def compiled_expression(df, expression):
+    """
+    Turn an expression into a named C++ function template of the columns it reads, declared once per process and reused by all
+    the files, and return the call of the function to be given to Filter, Define, or Vary. The interpreter then only compiles a short call
+    for each file, instead of the full expression. Constants and bare column names are returned unchanged.
+
+    Parameters:
+    - df: RDataFrame node where the expression is used, to find the columns it reads.
+    - expression: C++ expression.
+    """
+    if expression in declared_kernels:
+        kernel_timing["reused"] += 1
+        return declared_kernels[expression]
+
+    # Columns of friend trees can be read without the name of the friend tree
+    available_columns = [str(column) for column in df.GetColumnNames()]
+    available_columns += [column.split('.')[-1] for column in available_columns if '.' in column]
+    columns = discover_columns([expression], available_columns)
+    if not columns or columns == [expression.strip()]:
+        return expression
+
+    name = f"k_{hashlib.sha256(expression.encode()).hexdigest()[:16]}"
+    template = ", ".join([f"typename T{idx}" for idx in range(len(columns))])
+    arguments = ", ".join([f"const T{idx}& {column}" for idx, column in enumerate(columns)])
+    start = time.time()
+    ROOT.gInterpreter.Declare(f"""
+namespace vcb_kernels {{
+template <{template}>
+auto {name}({arguments}) {{ return ({expression}); }}
+}}
+""")
+    kernel_timing["declare_time"] += time.time() - start
+    kernel_timing["declared"] += 1
+
+    declared_kernels[expression] = f"vcb_kernels::{name}({', '.join(columns)})"
+
+    return declared_kernels[expression]
+
+def print_kernel_timing():
+    """
+    Print the number of kernels declared and reused, and the time spent declaring them.
+    """
+    print(f"{Fore.YELLOW}Kernels: {kernel_timing['declared']} declared in {kernel_timing['declare_time']:.2f} s, {kernel_timing['reused']} reused.{Style.RESET_ALL}")
+
+def enable_rdf_timing_log():
+    """
+    Make RDataFrame report the time spent in just-in-time compilation and in each event loop.
+    Return the verbosity object, which must be kept alive as long as the reports are wanted.
+    """
+    return ROOT.Experimental.RLogScopedVerbosity(ROOT.Detail.RDF.RDFLogChannel(), ROOT.Experimental.ELogLevel.kInfo)
@@ -0,0 +1,163 @@
+import ROOT
+import glob
+import json
+import os
+from colorama import Fore, Style
+
+# Increase when the content of the manifest changes, to rescan all the files
+MANIFEST_VERSION = 1
+
+# Samples to which the tt+jets selections apply, and the selections requiring the 4FS/5FS ttbb or the powheg samples
+tt_file_names = ["ttbb-4f", "ttbb-dps", "ttbar-powheg"]
+tt4f_strings = ["ttbb", "ttbj"]
+tt_strings   = ["ttcc", "ttcj", "ttLF"]
+
+def sample_type(infile):
+    """
+    Return the type of a sample from its path: 'data' for collision data, 'ttbar' for the samples split into tt+jets components, 'mc' otherwise.
+
+    Parameters:
+    - infile: Input ROOT file.
+    """
+    if "data" in infile:
+        return "data"
+    if any(x in infile for x in tt_file_names):
+        return "ttbar"
+
+    return "mc"
+
+def applicable_selections(infile, selection_names, use5FS):
+    """
+    Return the names of the selections that apply to a sample. The base selection applies to every sample;
+    the ttbar-specific selections apply to the right 4F, dps, and 5F powheg samples.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - selection_names: Names of all the selections.
+    - use5FS: Boolean indicating whether to use 5-flavor scheme MC for ttbb and ttbj processes.
+    """
+    applicable = []
+    for selection_name in selection_names:
+        if not "base" in selection_name and not any(x in infile for x in tt_file_names):
+            continue
+        if any(x in infile for x in tt_file_names) and "base" in selection_name:
+            continue
+        if use5FS: # "ttbb", "ttbj" -> both powheg and dps samples; "ttcc", "ttcj", "ttLF" --> only powheg
+            if any(x in selection_name for x in tt4f_strings) and not ("powheg" in infile or "dps" in infile):
+                continue
+            if any(x in selection_name for x in tt_strings) and not "powheg" in infile:
+                continue
+        else:
+            if any(x in selection_name for x in tt4f_strings) and not "bb" in infile:
+                continue
+            if any(x in selection_name for x in tt_strings) and not "powheg" in infile:
+                continue
+        applicable.append(selection_name)
+
+    return applicable
+
+def describe_sample(infile, year, selection_names, assign_event_weight):
+    """
+    Return the description of a sample derived from its path: a dictionary with keys 'path', 'type', 'weight', 'selections_4FS', 'selections_5FS'.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - year: Data taking year.
+    - selection_names: Names of all the selections.
+    - assign_event_weight: Function (year, infile) returning the event weight of a sample.
+    """
+    sample = {"path": infile, "type": sample_type(infile)}
+    sample["weight"] = assign_event_weight(year, infile) if not sample["type"] == "data" else "1"
+    sample["selections_4FS"] = applicable_selections(infile, selection_names, False)
+    sample["selections_5FS"] = applicable_selections(infile, selection_names, True)
+
+    return sample
+
+def scan_file(infile, tree_name):
+    """
+    Open an input file and return the number of entries and of clusters of its tree.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - tree_name: Name of the TTree.
+    """
+    input_file = ROOT.TFile.Open(infile)
+    if not input_file or input_file.IsZombie():
+        raise FileNotFoundError(f"Could not open file: {infile}")
+    tree = input_file.Get(tree_name)
+    if not tree or not isinstance(tree, ROOT.TTree):
+        raise ValueError(f"TTree '{tree_name}' not found in file '{infile}'.")
+
+    entries = tree.GetEntries()
+    clusters = 0
+    cluster_iterator = tree.GetClusterIterator(0)
+    while cluster_iterator.Next() < entries:
+        clusters += 1
+    input_file.Close()
+
+    return entries, clusters
+
+def build_manifest(input_dirs, tree_name, year, selection_names, assign_event_weight, manifest_file=None):
+    """
+    Scan the input directories and return the sample manifest: a list of dictionaries, one per input file, with keys
+    'path', 'size', 'mtime', 'entries', 'clusters', 'type', 'weight', 'selections_4FS', 'selections_5FS'.
+    The manifest is cached in manifest_file: the directories whose modification time did not change are not listed again
+    (their files are only checked with stat), and the files whose size and modification time did not change are not opened again.
+
+    Parameters:
+    - input_dirs: List of directories where the ROOT files are fetched.
+    - tree_name: Name of the TTree.
+    - year: Data taking year.
+    - selection_names: Names of all the selections.
+    - assign_event_weight: Function (year, infile) returning the event weight of a sample.
+    - manifest_file: json file caching the manifest, or None not to cache it.
+    """
+    cache = {"version": MANIFEST_VERSION, "tree": tree_name, "dirs": dict()}
+    if manifest_file and os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            cached = json.load(f)
+        if cached.get("version") == MANIFEST_VERSION and cached.get("tree") == tree_name:
+            cache = cached
+
+    scanned, reused = 0, 0
+    dirs = dict()
+    for input_dir in input_dirs:
+        dir_mtime = os.path.getmtime(input_dir) if os.path.isdir(input_dir) else None
+        cached_dir = cache["dirs"].get(input_dir)
+        cached_files = {entry["path"]: entry for entry in cached_dir["files"]} if cached_dir else dict()
+        if cached_dir and dir_mtime is not None and cached_dir["mtime"] == dir_mtime:
+            paths = list(cached_files.keys()) # No file was added or removed
+        else:
+            paths = sorted(glob.glob(f"{input_dir}*.root"))
+
+        files = []
+        for infile in paths:
+            size, mtime = os.path.getsize(infile), os.path.getmtime(infile)
+            entry = cached_files.get(infile)
+            if entry and entry["size"] == size and entry["mtime"] == mtime:
+                reused += 1
+            else:
+                entries, clusters = scan_file(infile, tree_name)
+                entry = {"path": infile, "size": size, "mtime": mtime, "entries": entries, "clusters": clusters}
+                scanned += 1
+            files.append(entry)
+        dirs[input_dir] = {"mtime": dir_mtime, "files": files}
+
+    # The sample type, weight and selections only depend on the path: they are derived again, e.g. for another year
+    manifest = []
+    for input_dir in input_dirs:
+        for entry in dirs[input_dir]["files"]:
+            entry.update(describe_sample(entry["path"], year, selection_names, assign_event_weight))
+            manifest.append(entry)
+
+    if manifest_file:
+        cache["dirs"].update(dirs)
+        tmp_file = f"{manifest_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f, indent=1)
+        os.replace(tmp_file, manifest_file)
+
+    print(f"{Fore.YELLOW}Sample manifest: {len(manifest)} files ({scanned} scanned, {reused} reused), "
+          f"{sum([entry['entries'] for entry in manifest])} entries, {sum([entry['size'] for entry in manifest]) / 1024**3:.2f} GB{Style.RESET_ALL}")
+
+    return manifest
@@ -0,0 +1,46 @@
+import os
+import resource
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the process to its current value (Linux only), so that the peak of each input file can be measured.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss():
+    """
+    Return the peak resident set size of the process in bytes, since the last reset_peak_rss on Linux, or since the start of the process otherwise.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def available_cores():
+    """
+    Return the number of cores available to the process.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def histogram_bytes(nbins, variable_binning=False):
+    """
+    Return the expected memory in bytes of a filled weighted TH1D: the bin contents and the sums of squared weights, including the
+    underflow and overflow bins, the bin edges of a variable binning, and about 1 kB for the object itself (axes, names, statistics).
+
+    Parameters:
+    - nbins: Number of bins.
+    - variable_binning: Boolean indicating whether the histogram has variable bin edges.
+    """
+    return 8 * (2 * (nbins + 2) + (nbins + 1 if variable_binning else 0)) + 1024
@@ -0,0 +1,445 @@
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import awkward as ak
+import uproot
+
+# Vectorized implementations of the functions that can be called in the selections, weights and definitions
+functions = {
+    "abs": "np.abs", "std::abs": "np.abs", "fabs": "np.abs", "std::fabs": "np.abs", "TMath::Abs": "np.abs",
+    "sqrt": "np.sqrt", "std::sqrt": "np.sqrt", "TMath::Sqrt": "np.sqrt",
+    "exp": "np.exp", "std::exp": "np.exp", "log": "np.log", "std::log": "np.log",
+    "cos": "np.cos", "std::cos": "np.cos", "sin": "np.sin", "std::sin": "np.sin", "atan2": "np.arctan2", "std::atan2": "np.arctan2",
+    "pow": "np.power", "std::pow": "np.power", "TMath::Power": "np.power",
+    "min": "np.minimum", "std::min": "np.minimum", "max": "np.maximum", "std::max": "np.maximum",
+    "vcb::event_category": "event_category"
+}
+casts = {"double": "np.float64", "float": "np.float32", "int": "np.int64", "bool": "np.bool_"}
+
+token_pattern = re.compile(r"\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)[fFuUlL]*|([A-Za-z_][A-Za-z0-9_]*(?:::[A-Za-z_][A-Za-z0-9_]*)*)|(&&|\|\||==|!=|<=|>=|[-+*/%<>!?:()\[\],.]))")
+
+def tokenize(expression):
+    """
+    Split a C++ expression into tokens: ('number', text), ('name', text) or ('op', text).
+
+    Parameters:
+    - expression: C++ expression.
+    """
+    tokens = []
+    idx = 0
+    expression = expression.rstrip()
+    while idx < len(expression):
+        match = token_pattern.match(expression, idx)
+        if not match:
+            raise ValueError(f"Cannot translate '{expression}' at position {idx}.")
+        number, name, op = match.groups()
+        tokens.append(("number", number) if number else ("name", name) if name else ("op", op))
+        idx = match.end()
+
+    return tokens
+
+class translator:
+    """
+    Recursive-descent parser of the C++ expressions used in the selections, weights and definitions, following the C++ operator precedence.
+    It returns an equivalent Python expression on NumPy/awkward arrays, where the columns are read from the dictionary 'c'.
+    """
+
+    # Binary operators, from the loosest to the tightest binding
+    binary_levels = [["||"], ["&&"], ["==", "!="], ["<", "<=", ">", ">="], ["+", "-"], ["*", "/", "%"]]
+    logical = {"||": "np.logical_or", "&&": "np.logical_and", "%": "np.fmod", "/": "divide"}
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.pos = 0
+        self.columns = []
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def expect(self, text):
+        kind, token = self.peek()
+        if not token == text:
+            raise ValueError(f"Expected '{text}' instead of '{token}' in '{self.expression}'.")
+        self.pos += 1
+
+    def translate(self):
+        result = self.ternary()
+        if self.pos < len(self.tokens):
+            raise ValueError(f"Unexpected '{self.peek()[1]}' in '{self.expression}'.")
+        return result
+
+    def ternary(self):
+        condition = self.binary(0)
+        if self.peek()[1] == "?":
+            self.pos += 1
+            if_true = self.ternary()
+            self.expect(":")
+            if_false = self.ternary()
+            return f"np.where({condition}, {if_true}, {if_false})"
+        return condition
+
+    def binary(self, level):
+        if level == len(self.binary_levels):
+            return self.unary()
+        left = self.binary(level + 1)
+        while self.peek()[1] in self.binary_levels[level]:
+            operator = self.peek()[1]
+            self.pos += 1
+            right = self.binary(level + 1)
+            left = f"{self.logical[operator]}({left}, {right})" if operator in self.logical else f"({left} {operator} {right})"
+        return left
+
+    def unary(self):
+        kind, token = self.peek()
+        if token in ["!", "-", "+"]:
+            self.pos += 1
+            operand = self.unary()
+            return f"np.logical_not({operand})" if token == "!" else f"({token}{operand})"
+        return self.postfix()
+
+    def postfix(self):
+        result = self.primary()
+        while True:
+            kind, token = self.peek()
+            if token == "[":
+                self.pos += 1
+                index = self.ternary()
+                self.expect("]")
+                result = f"element_at({result}, {index})"
+            elif token == ".":
+                self.pos += 1
+                kind, member = self.peek()
+                self.pos += 1
+                self.expect("(")
+                self.expect(")")
+                if not member == "size":
+                    raise ValueError(f"Unsupported member function '{member}' in '{self.expression}'.")
+                result = f"collection_size({result})"
+            else:
+                return result
+
+    def primary(self):
+        kind, token = self.peek()
+        self.pos += 1
+        if kind == "number":
+            # Floating-point literals are doubles (or floats with the f suffix) that promote float columns, like in C++
+            if not any(x in token for x in ".eE"):
+                return token.rstrip("uUlL")
+            return f"np.float32({token.rstrip('fF')})" if token[-1] in "fF" else f"np.float64({token})"
+        if token == "(":
+            result = self.ternary()
+            self.expect(")")
+            return f"({result})"
+        if kind != "name":
+            raise ValueError(f"Unexpected '{token}' in '{self.expression}'.")
+        if token in ["true", "false"]:
+            return "True" if token == "true" else "False"
+        if token == "static_cast":
+            self.expect("<")
+            cast_type = self.peek()[1]
+            self.pos += 1
+            self.expect(">")
+            self.expect("(")
+            operand = self.ternary()
+            self.expect(")")
+            if not cast_type in casts:
+                raise ValueError(f"Unsupported cast to '{cast_type}' in '{self.expression}'.")
+            return f"np.asarray({operand}).astype({casts[cast_type]})" if not cast_type == "int" else f"np.trunc({operand}).astype(np.int64)"
+        if self.peek()[1] == "(":
+            if not token in functions:
+                raise ValueError(f"Unsupported function '{token}' in '{self.expression}'.")
+            self.pos += 1
+            arguments = []
+            while not self.peek()[1] == ")":
+                arguments.append(self.ternary())
+                if self.peek()[1] == ",":
+                    self.pos += 1
+            self.expect(")")
+            return f"{functions[token]}({', '.join(arguments)})"
+        if not token in self.columns:
+            self.columns.append(token)
+        return f"c[{token!r}]"
+
+def divide(numerator, denominator):
+    """
+    Divide like C++: the division of two integers is truncated towards zero.
+
+    Parameters:
+    - numerator, denominator: Arrays or scalars.
+    """
+    if np.issubdtype(np.asarray(numerator).dtype, np.integer) and np.issubdtype(np.asarray(denominator).dtype, np.integer):
+        return np.trunc(np.true_divide(numerator, denominator)).astype(np.int64)
+
+    return np.true_divide(numerator, denominator)
+
+def collection_size(values):
+    """
+    Return the number of elements of each entry of a jagged column (the C++ .size()).
+
+    Parameters:
+    - values: Jagged (awkward) array.
+    """
+    return ak.to_numpy(ak.num(values, axis=1))
+
+def element_at(values, index):
+    """
+    Return the element of each entry of a jagged column at a fixed index (the C++ operator[]), or 0 for the entries that are too short.
+    The out-of-range entries are never selected by the expressions, which check the size first, but both branches of np.where are evaluated.
+
+    Parameters:
+    - values: Jagged (awkward) array.
+    - index: Index of the element.
+    """
+    index = int(index)
+    return ak.to_numpy(ak.fill_none(ak.pad_none(values, index + 1, axis=1, clip=True)[:, index], 0))
+
+def event_category(score_tt_Wcb, score_ttbb, score_ttbj, score_ttcc, score_ttcj, score_ttLF, score_tt_Wcb_min, score_ttLF_max, SR_score_tt_Wcb,
+                   w_ttbb, w_ttbj, w_ttcc, w_ttcj, w_ttLF):
+    """
+    Vectorized version of vcb::event_category (see weights_and_constants.py): -1 for the events failing the event classification selection,
+    0 for the SR, and 1-5 for the ttbb, ttbj, ttcc, ttcj, and ttLF CRs.
+    """
+    # The C++ function takes doubles
+    score_tt_Wcb, score_ttbb, score_ttbj, score_ttcc, score_ttcj, score_ttLF = [np.asarray(x, dtype=np.float64) for x in [score_tt_Wcb, score_ttbb, score_ttbj, score_ttcc, score_ttcj, score_ttLF]]
+    passed = np.logical_and(score_tt_Wcb > score_tt_Wcb_min, score_ttLF < score_ttLF_max)
+    weighted_scores = np.stack([w_ttbb * score_ttbb, w_ttbj * score_ttbj, w_ttcc * score_ttcc, w_ttcj * score_ttcj, w_ttLF * score_ttLF], axis=1)
+    best = np.argmax(weighted_scores, axis=1)
+    best_score = np.take_along_axis(weighted_scores, best[:, None], axis=1)
+    # Ties are not assigned to any CR: all the other weighted scores must be strictly smaller
+    unique = np.sum(best_score > weighted_scores, axis=1) == 4
+
+    category = np.full(len(passed), -1.)
+    category[passed & (score_tt_Wcb < SR_score_tt_Wcb) & unique] = (best + 1)[passed & (score_tt_Wcb < SR_score_tt_Wcb) & unique]
+    category[passed & (score_tt_Wcb > SR_score_tt_Wcb)] = 0.
+
+    return category
+
+class compiled_expression:
+    """
+    C++ expression translated to a vectorized Python expression, evaluated on a chunk of columns.
+    """
+
+    def __init__(self, expression):
+        parser = translator(expression)
+        self.source = parser.translate()
+        self.columns = parser.columns
+        self.code = compile(self.source, expression, "eval")
+
+    def __call__(self, columns, size):
+        """
+        Evaluate the expression and return an array with one value per entry of the chunk.
+
+        Parameters:
+        - columns: Dictionary {column : array} of the chunk.
+        - size: Number of entries of the chunk, to broadcast constant expressions.
+        """
+        # Divisions by zero give inf or nan, like in C++
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = eval(self.code, {"np": np, "divide": divide, "element_at": element_at, "collection_size": collection_size, "event_category": event_category}, {"c": columns})
+        return np.broadcast_to(np.asarray(result), (size,))
+
+def read_chunks(file_name, tree_name, columns, chunk_size, entry_start=None, entry_stop=None):
+    """
+    Read the columns of a tree in chunks of entries. Yield dictionaries {column : array}: the flat columns are NumPy arrays of the type of the branch,
+    so that the expressions are evaluated with the same precision as in C++, and the jagged columns are awkward arrays.
+
+    Parameters:
+    - file_name: Input ROOT file.
+    - tree_name: Name of the TTree.
+    - columns: List of the columns to read.
+    - chunk_size: Number of entries per chunk.
+    - entry_start: First entry to read. None means the first entry of the tree.
+    - entry_stop: Entry after the last entry to read. None means the end of the tree.
+    """
+    with uproot.open(file_name) as root_file:
+        tree = root_file[tree_name]
+        for arrays in tree.iterate(columns, step_size=chunk_size, entry_start=entry_start, entry_stop=entry_stop, library="ak"):
+            chunk = dict()
+            for column in columns:
+                values = arrays[column]
+                chunk[column] = values if values.ndim > 1 else ak.to_numpy(values)
+            yield chunk
+
+def tree_clusters(file_name, tree_name):
+    """
+    Return the number of entries of a tree and the entries at which all its branches start a new basket, i.e. where it can be split without reading a basket twice.
+
+    Parameters:
+    - file_name: Input ROOT file.
+    - tree_name: Name of the TTree.
+    """
+    with uproot.open(file_name) as root_file:
+        tree = root_file[tree_name]
+        return tree.num_entries, [int(offset) for offset in tree.common_entry_offsets()[:-1]]
+
+def bytes_per_entry(file_name, tree_name, columns):
+    """
+    Return the uncompressed size per entry of the columns of a tree, i.e. the memory they take once read.
+
+    Parameters:
+    - file_name: Input ROOT file.
+    - tree_name: Name of the TTree.
+    - columns: List of the columns to read.
+    """
+    with uproot.open(file_name) as root_file:
+        tree = root_file[tree_name]
+        return sum([tree[column].uncompressed_bytes for column in columns]) / max(1, tree.num_entries)
+
+def choose_chunking(entry_bytes, memory_budget_gb, max_threads, min_chunk_size=10000):
+    """
+    Choose the number of entries per chunk and the number of threads processing chunks concurrently so that the chunks in memory
+    (one per thread, plus the one being read) fit in the memory budget. The threads are reduced first, down to one, before the chunks
+    get smaller than min_chunk_size.
+    Return the chunk size and the number of threads.
+
+    Parameters:
+    - entry_bytes: Memory per entry of a chunk, including the derived columns and the temporary arrays.
+    - memory_budget_gb: Memory budget for the chunks in GB.
+    - max_threads: Maximum number of threads.
+    - min_chunk_size: Minimum number of entries per chunk, below which the overhead per chunk dominates.
+    """
+    budget = memory_budget_gb * 1024**3
+    threads = max(1, min(max_threads, int(budget / (min_chunk_size * entry_bytes)) - 1))
+    chunk_size = max(min_chunk_size, int(budget / ((threads + 1) * entry_bytes)))
+
+    return chunk_size, threads
+
+def stream_map(function, items, threads):
+    """
+    Apply a function to the items of a generator in a pool of threads, with at most one item per thread in flight, and yield the results
+    in the order of the items, so that the reduction does not depend on the number of threads.
+
+    Parameters:
+    - function: Function of one item.
+    - items: Iterable of items, consumed lazily.
+    - threads: Number of threads. 1 means that the items are processed in the calling thread.
+    """
+    if threads <= 1:
+        for item in items:
+            yield function(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(function, item))
+            if len(pending) >= threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def fill_chunk(chunk, definitions, weight, fills, compiled):
+    """
+    Process a chunk of entries: define the derived columns, select the events, weight them, and fill new histograms with the binning
+    of the booked ones. Return the list of filled histograms, in the order of the fills, to be added to the booked histograms.
+
+    Parameters:
+    - chunk: Dictionary {column : array} of the chunk (see read_chunks).
+    - definitions: Dictionary {column : definition} of the derived columns, in the order in which they are defined.
+    - weight: Event weight expression.
+    - fills: List of (event selection, category selection or None, branch, booked histogram).
+    - compiled: Dictionary {expression : compiled_expression} with all the expressions.
+    """
+    size = len(next(iter(chunk.values()))) if chunk else 0
+
+    # Define
+    for column, definition in definitions.items():
+        chunk[column] = compiled[definition](chunk, size)
+
+    # Select, with each selection evaluated once per chunk
+    masks = dict()
+    for event_selection, category_selection, _, _ in fills:
+        for expression in [event_selection, category_selection]:
+            if expression and not expression in masks:
+                masks[expression] = compiled[expression](chunk, size).astype(bool)
+
+    # Weight
+    weights = compiled[weight](chunk, size)
+
+    # Fill
+    filled = []
+    for event_selection, category_selection, branch_name, booked in fills:
+        mask = masks[event_selection] & masks[category_selection] if category_selection else masks[event_selection]
+        hist = booked.empty_copy()
+        hist.fill(chunk[branch_name][mask] if branch_name in chunk else compiled[branch_name](chunk, size)[mask], weights[mask])
+        filled.append(hist)
+
+    return filled
+
+class numpy_histogram:
+    """
+    One-dimensional histogram filled with NumPy, with the content, the sum of squared weights and the statistics of a ROOT TH1D.
+    The bin of a value is found like TH1::FindBin does: arithmetically for fixed bins, by binary search for variable bins.
+    """
+
+    def __init__(self, name, title, edges, nbins=None, xmin=None, xmax=None):
+        self.name = name
+        self.title = title
+        self.fixed = nbins is not None
+        self.edges = np.linspace(xmin, xmax, nbins + 1) if self.fixed else np.asarray(edges, dtype=np.float64)
+        self.nbins, self.xmin, self.xmax = (nbins, xmin, xmax) if self.fixed else (len(self.edges) - 1, self.edges[0], self.edges[-1])
+        self.sumw = np.zeros(self.nbins + 2)
+        self.sumw2 = np.zeros(self.nbins + 2)
+        self.entries = 0
+        self.stats = np.zeros(4) # Sums of w, w^2, w*x and w*x^2 over the entries in range
+
+    def empty_copy(self):
+        """
+        Return an empty histogram with the same name, title and binning.
+        """
+        if self.fixed:
+            return numpy_histogram(self.name, self.title, None, self.nbins, self.xmin, self.xmax)
+        return numpy_histogram(self.name, self.title, self.edges)
+
+    def add(self, other):
+        """
+        Add the content and the statistics of another histogram with the same binning.
+
+        Parameters:
+        - other: Histogram to add.
+        """
+        self.sumw += other.sumw
+        self.sumw2 += other.sumw2
+        self.entries += other.entries
+        self.stats += other.stats
+
+    def find_bins(self, values):
+        """
+        Return the bin of each value, 0 for the underflow and nbins + 1 for the overflow (and NaN).
+
+        Parameters:
+        - values: Array of values.
+        """
+        if self.fixed:
+            bins = np.ones(len(values), dtype=np.int64)
+            in_range = (values >= self.xmin) & (values < self.xmax)
+            bins[in_range] = 1 + (self.nbins * (values[in_range] - self.xmin) / (self.xmax - self.xmin)).astype(np.int64)
+            bins[values < self.xmin] = 0
+            bins[~(values < self.xmax)] = self.nbins + 1 # Including NaN, like ROOT
+            return bins
+
+        return np.searchsorted(self.edges, values, side="right")
+
+    def fill(self, values, weights):
+        """
+        Fill the histogram.
+
+        Parameters:
+        - values: Array of values. For a jagged column, every element is filled with the weight of its entry, like RDataFrame does.
+        - weights: Array of weights.
+        """
+        if isinstance(values, ak.Array):
+            weights = np.repeat(np.asarray(weights), ak.to_numpy(ak.num(values, axis=1)))
+            values = ak.to_numpy(ak.flatten(values, axis=1))
+        values = np.asarray(values, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        bins = self.find_bins(values)
+        self.sumw += np.bincount(bins, weights=weights, minlength=self.nbins + 2)
+        self.sumw2 += np.bincount(bins, weights=weights * weights, minlength=self.nbins + 2)
+        self.entries += len(values)
+
+        in_range = (bins > 0) & (bins <= self.nbins)
+        x, w = values[in_range], weights[in_range]
+        self.stats += [np.sum(w), np.sum(w * w), np.sum(w * x), np.sum(w * x * x)]
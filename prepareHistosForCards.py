@@ -4,11 +4,24 @@ import glob
 import csv
 import os
 import numpy as np
+import time
 from colorama import Fore, Style
-
-ROOT.ROOT.EnableImplicitMT()
-
-def process_trees(input_files, output_files, tree_name, year, selections, adhoc_selection, adhoc_binning, systematics):
+from weights_and_constants import event_category_declaration, adhoc_event_category, event_selections, fscore_definitions
+from scheduler import sort_by_size, enable_multithreading, run_process_pool, rdf_slots
+from histogram_io import write_histograms_atomically
+from skim import find_skim, read_skim_stamp
+from friends import friend_definitions, attach_friend
+from kernels import compiled_expression, print_kernel_timing, enable_rdf_timing_log
+from expressions import fold_constants, optimize_selection, read_pass_rates
+from memory import histogram_bytes, reset_peak_rss, peak_rss
+from journal import run_journal, unit_name
+
+# Input files split into tt+jets components, and the selections of these components
+tt_file_names = ["ttbb-4f", "ttbar-powheg"]
+tt4f_strings = ["ttbb", "ttbj"]
+tt_strings   = ["ttcc", "ttcj", "ttLF"]
+
+def process_trees(input_files, output_files, tree_name, year, selections, adhoc_selection, adhoc_binning, systematics, run_graphs=False, skim_dir=None, friends=False, friend_dir=None, kernels=False, timing=False, optimize=False, pass_rates=None, memory_budget=0., journal=None):
     """
     Processes multiple TTrees, converts them to multiple TH1Ds for specified branches, and saves them to ROOT files.
 
@@ -21,100 +34,426 @@ def process_trees(input_files, output_files, tree_name, year, selections, adhoc_
     - adhoc_selection: Dictionary containing an ad-hoc event selection to fill the scores.
     - adhoc_binning: Dictionary containing ad-hoc binning for the scores.
     - systematics: Dictionary containing systematic variations.
+    - run_graphs: Boolean indicating whether to build the computation graphs of all files up front and run them concurrently.
+    - skim_dir: Directory of the skims produced by skim.py, read instead of the input files when they are up to date. None means that the input files are always read.
+    - friends: Boolean indicating whether to read the derived columns (fractional scores, event weight) from friend trees, built when missing or stale.
+    - friend_dir: Directory of the friend trees. None means the friends/ subdirectory of the input directory.
+    - kernels: Boolean indicating whether to declare the selections, weights and derived columns as C++ functions once per process, reused by all files.
+    - timing: Boolean indicating whether RDataFrame should report the time spent in just-in-time compilation and in the event loops.
+    - optimize: Boolean indicating whether to fold the known constants (the data taking year) in the selections and weights,
+                filter the base selection once per file, and order the conditions of the selections by rejection power.
+    - pass_rates: Dictionary {condition : fraction of events passing it}, used to order the conditions of the selections. None keeps the order.
+    - memory_budget: Memory budget in GB of the histograms booked at once, i.e. filled in the same event loop. The booking of a file is split
+                     into several event loops when its expected histogram memory exceeds the budget. 0 means no budget.
+    - journal: Run journal (see journal.py), where each (file, selection) unit is recorded as soon as its file is processed,
+               and from which the units completed by a previous run are read back instead of being processed. None means no journal.
+
+    Return the histograms, grouped by output file, and the cutflow, i.e. a list of dictionaries with the number of events before and after each selection of each file.
     """
 
-    for infile in input_files:
-        print(f"{Fore.RED}Processing file: {infile}{Style.RESET_ALL}")
-
-        # Open input file
-        input_file = ROOT.TFile.Open(infile)
-        if not input_file or input_file.IsZombie():
-            raise FileNotFoundError(f"Could not open file: {infile}")
+    collected_histograms = dict()
+    cutflow = []
+    rdf_log = enable_rdf_timing_log() if timing else None
+    # Arguments of book_histograms shared by all the input files
+    options = dict(output_files=output_files, tree_name=tree_name, year=year, selections=selections, adhoc_selection=adhoc_selection, adhoc_binning=adhoc_binning,
+                   systematics=systematics, skim_dir=skim_dir, friends=friends, friend_dir=friend_dir, kernels=kernels, optimize=optimize, pass_rates=pass_rates)
+
+    if run_graphs and journal:
+        print(f"{Fore.YELLOW}Processing the files one at a time, so that the journal records each file as soon as it is processed.{Style.RESET_ALL}")
+        run_graphs = False
+    if run_graphs:
+        # The histograms of all files are booked at once: fall back to one file at a time if they do not fit in the memory budget
+        expected = sum([expected_bytes for infile in input_files for _, expected_bytes in plan_booking(infile, selections, adhoc_selection, adhoc_binning, systematics)])
+        print(f"{Fore.YELLOW}Expected memory of the histograms of {len(input_files)} files: {expected / 1024**3:.2f} GB{Style.RESET_ALL}")
+        if memory_budget > 0 and expected > memory_budget * 1024**3:
+            print(f"{Fore.YELLOW}Warning: the histograms of all files exceed the memory budget of {memory_budget:.2f} GB, processing the files one at a time.{Style.RESET_ALL}")
+            run_graphs = False
+    if run_graphs:
+        # Book everything first, then let ROOT run the event loops of all files concurrently
+        reset_peak_rss()
+        booked_files = [book_histograms(infile, **options) for infile in input_files]
+        print(f"{Fore.YELLOW}Running the computation graphs of {len(booked_files)} files concurrently.{Style.RESET_ALL}")
+        ROOT.RDF.RunGraphs([result for _, booked_histograms, _ in booked_files for _, _, result, variation, _ in booked_histograms if variation is None])
+        print(f"{Fore.YELLOW}Peak RSS for {len(booked_files)} files: {peak_rss() / 1024**3:.2f} GB (expected histograms: {expected / 1024**3:.2f} GB){Style.RESET_ALL}")
+        for input_file, booked_histograms, booked_cutflow in booked_files:
+            collect_histograms(booked_histograms, collected_histograms)
+            cutflow += resolve_cutflow(booked_cutflow)
+            input_file.Close()
+    else:
+        for infile in input_files:
+            cutflow += fill_file(infile, collected_histograms, memory_budget=memory_budget, journal=journal, **options)
+
+    if kernels:
+        print_kernel_timing()
+
+    return collected_histograms, cutflow
+
+def book_histograms(infile, output_files, tree_name, year, selections, adhoc_selection, adhoc_binning, systematics, skim_dir=None, friends=False, friend_dir=None, kernels=False, optimize=False, pass_rates=None, units=None, cutflow_selections=None):
+    """
+    Open a TTree and book the histograms of all selections, systematic variations and categories that apply to it.
+    Return the input file, a list of (output file, histogram name, booked result, variation, selection name) tuples,
+    where variation is None for the nominal histograms and the key in the map of varied results otherwise,
+    and the booked cutflow (event counts are booked lazily as well, so that they do not trigger additional event loops).
 
-        # Access the TTree
-        tree = input_file.Get(tree_name)
-        if not tree or not isinstance(tree, ROOT.TTree):
-            raise ValueError(f"TTree '{tree_name}' not found in file '{infile}'.")
+    Parameters:
+    - infile: Input ROOT file.
+    - units: List of (selection name, score) pairs to book (see booking_units). None means all of them.
+    - cutflow_selections: List of the selections whose cutflow is booked. None means all the selections that apply to the file.
+    - See process_trees for the other parameters.
+    """
+    print(f"{Fore.RED}Processing file: {infile}{Style.RESET_ALL}")
+
+    # Read the skim of the input file if it is up to date. The name of the input file still determines how it is processed.
+    read_file = infile
+    if skim_dir:
+        expressions = list(selections.values()) + ["passTrigMu", assign_event_weight(year, infile), adhoc_event_category] \
+            + list(systematics.values()) + list(fscore_definitions.values()) + list(adhoc_selection.keys())
+        read_file = find_skim(skim_dir, infile, tree_name, selections["base"], expressions)
+
+    # Open input file
+    input_file = ROOT.TFile.Open(read_file)
+    if not input_file or input_file.IsZombie():
+        raise FileNotFoundError(f"Could not open file: {read_file}")
+
+    # Access the TTree
+    tree = input_file.Get(tree_name)
+    if not tree or not isinstance(tree, ROOT.TTree):
+        raise ValueError(f"TTree '{tree_name}' not found in file '{read_file}'.")
+
+    # Read the derived columns from the friend tree, so that they are neither compiled nor computed again
+    friend_columns = []
+    if friends:
+        friend_columns = attach_friend(input_file, tree, tree_name, friend_definitions(assign_event_weight(year, infile) if not "data" in infile else None), friend_dir)
+
+    # Create RDataFrame from TTree
+    df = ROOT.RDataFrame(tree)
+
+    # Declare the expressions as C++ functions once per process, if requested
+    kernel = compiled_expression if kernels else (lambda node, expression: expression)
+
+    # Define the fractional scores
+    for column, definition in fscore_definitions.items():
+        if not column in friend_columns:
+            df = df.Define(column, kernel(df, definition))
+
+    # Compute the event category once per event; the categories are then split by an integer comparison
+    ROOT.gInterpreter.Declare(event_category_declaration)
+    df = df.Define("event_category", adhoc_event_category)
+
+    booked_histograms = []
+    booked_cutflow = []
+    # The number of events before selection is that of the original file, also when its skim is read (recorded in the skim stamp)
+    count_before = df.Count() if read_file == infile else read_skim_stamp(read_file)["entries_in"]
+
+    # Values known before the event loop, folded into the selections and weights
+    constants = {"year": year}
+    # Node filtering on the base selection, shared by all the selections of the file
+    base_node = None
+
+    # Process each selection-output combinations
+    for selection_name in selections:
+
+        if not selection_applies(infile, selection_name):
+            continue
+        scores = [score for score in adhoc_selection if units is None or (selection_name, score) in units]
+        book_cutflow = cutflow_selections is None or selection_name in cutflow_selections
+        if not scores and not book_cutflow:
+            continue
+
+        # Add event selection making sure that the "base" selection is applied everywhere
+        event_selection = f"{selections['base']}{selections[selection_name]}" if not "base" in selection_name else f"{selections[selection_name]}"
+        if "singlee" in infile:
+            event_selection += " && passTrigMu==0" # Remove from the electron channel the events that fired the muon trigger. Could choose to do vice versa as well.
+        #print(f"Applying selection: {event_selection} -> Producing output file: {output_file}")
+        if optimize:
+            if base_node is None:
+                base_node = df.Filter(kernel(df, optimize_selection(selections['base'], constants, pass_rates)))
+            other_selection = optimize_selection(event_selection[len(selections['base']):], constants, pass_rates)
+            df_selected = base_node.Filter(kernel(base_node, other_selection)) if not other_selection == "true" else base_node
+        else:
+            df_selected = df.Filter(kernel(df, event_selection))
+
+        # Book the number of events after selection, to be reported in the cutflow
+        if book_cutflow:
+            booked_cutflow.append({"file": infile, "selection": selection_name, "before": count_before, "after": df_selected.Count()})
+        if not scores:
+            continue
+
+        # Assign event weight based on data taking year and process type.
+        # The weight is stored as a double, which is the type of the varied weights below (and of the weight passed to TH1::Fill anyway).
+        weight_column = "weight_column"
+        if not "data" in infile:
+            weight = assign_event_weight(year, infile)
+            if optimize:
+                weight = fold_constants(weight, constants)
+            print(f"Event weight: {Fore.GREEN}{weight}{Style.RESET_ALL}")
+            df_selected = df_selected.Define(weight_column, kernel(df_selected, f"static_cast<double>({weight})") if not "event_weight" in friend_columns else "event_weight")
+        else: # Keep the weight == 1 for collision data
+            df_selected = df_selected.Define(weight_column, "1.")
+
+        # Attach all the weight-based systematic variations to the nominal weight, so that they are filled in the same event loop.
+        # Do not produce the systematic variations for collision data.
+        variations = weight_variations(infile, systematics)
+        if variations:
+            varied_weights = ", ".join([f"{weight_column}*({systematics[syst]})" if not "data" in infile else "1." for syst in variations])
+            print(f"Weight variations: {Fore.GREEN}{', '.join(variations)}{Style.RESET_ALL}")
+            df_selected = df_selected.Vary(weight_column, kernel(df_selected, f"ROOT::RVecD{{{varied_weights}}}"), variations, "weights")
+
+        final_df = dict()
+        for (score, adhoc_sel), outfile in zip(adhoc_selection.items(), output_files):
+            if not score in scores:
+                continue
+            print(f"Creating histogram for category: {outfile.split('_')[-2]} and selection: {selection_name}")
+            hist_name = infile.split('/')[-1].replace('_tree.root','')
+            if any(x in infile for x in tt_file_names):
+                hist_name = selection_name
+            if "Data" in infile:
+                hist_name = "data_obs"
 
-        # Create RDataFrame from TTree
-        df = ROOT.RDataFrame(tree)
+            final_df[score] = df_selected.Filter(adhoc_sel)
 
-        # Define the fractional scores
-        df = df.Define("fscore_ttbb", "score_ttbb / (score_ttbb + score_ttbj + score_ttcc + score_ttcj + score_ttLF)")
-        df = df.Define("fscore_ttbj", "score_ttbj / (score_ttbb + score_ttbj + score_ttcc + score_ttcj + score_ttLF)")
-        df = df.Define("fscore_ttcc", "score_ttcc / (score_ttbb + score_ttbj + score_ttcc + score_ttcj + score_ttLF)")
-        df = df.Define("fscore_ttcj", "score_ttcj / (score_ttbb + score_ttbj + score_ttcc + score_ttcj + score_ttLF)")
-        df = df.Define("fscore_ttLF", "score_ttLF / (score_ttbb + score_ttbj + score_ttcc + score_ttcj + score_ttLF)")
+            hist = final_df[score].Histo1D((f"{hist_name}", f"Histogram of {score} for process {hist_name}", len(adhoc_binning[score])-1, adhoc_binning[score]), score, weight_column)
+            booked_histograms.append((outfile, hist_name, hist, None, selection_name))
 
-        tt_file_names = ["ttbb-4f", "ttbar-powheg"]
-        tt4f_strings = ["ttbb", "ttbj"]
-        tt_strings   = ["ttcc", "ttcj", "ttLF"]
+            # The varied histograms keep the nominal name until they are written as <process>_<systematic>
+            if variations:
+                varied_hists = ROOT.RDF.Experimental.VariationsFor(hist)
+                for syst in variations:
+                    booked_histograms.append((outfile, f"{hist_name}_{syst}", varied_hists, f"weights:{syst}", selection_name))
 
+    return input_file, booked_histograms, booked_cutflow
 
-        # Process each selection-output combinations
-        for selection_name in selections:
+def fill_file(infile, collected_histograms, output_files, tree_name, year, selections, adhoc_selection, adhoc_binning, systematics, skim_dir=None, friends=False, friend_dir=None, kernels=False, optimize=False, pass_rates=None, memory_budget=0., journal=None):
+    """
+    Book and fill the histograms of an input file, in as many event loops as needed for the histograms booked at once to fit in the memory budget,
+    and collect them. Report the expected histogram memory and the peak RSS of each event loop. Return the cutflow of the file.
+    With a journal, the selections completed by a previous run are read back from it, and the other ones are recorded once they are filled.
 
-            # Apply base selection to every sample; apply the ttbar-specific selection to the right 4f and powheg samples
-            if not "base" in selection_name and not any(x in infile for x in tt_file_names): 
-                continue
-            if any(x in infile for x in tt_file_names) and "base" in selection_name:
-                continue
-            if any(x in selection_name for x in tt4f_strings) and not "4f" in infile:
-                continue
-            if any(x in selection_name for x in tt_strings) and not "powheg" in infile:
+    Parameters:
+    - infile: Input ROOT file.
+    - collected_histograms: Dictionary {output file : {histogram name : histogram}} to be filled.
+    - See process_trees for the other parameters.
+    """
+    cutflow = []
+    pending = [selection_name for selection_name in selections if selection_applies(infile, selection_name)]
+    if journal:
+        for selection_name in list(pending):
+            unit = unit_name(infile, "", selection_name)
+            if not journal.completed(unit, infile):
                 continue
+            for outfile, histograms in journal.load(unit).items():
+                collected_histograms.setdefault(outfile, dict()).update(histograms)
+            cutflow += journal.data(unit)
+            pending.remove(selection_name)
+        if not pending:
+            print(f"{Fore.YELLOW}Skipping {infile}: its selections were completed by a previous run.{Style.RESET_ALL}")
+            return cutflow
+        journal.start(infile, [unit_name(infile, "", selection_name) for selection_name in pending])
+
+    batches = plan_booking(infile, selections, adhoc_selection, adhoc_binning, systematics, memory_budget, pending)
+    if len(batches) > 1:
+        print(f"{Fore.YELLOW}Splitting the booking of {infile} into {len(batches)} event loops to fit in the memory budget of {memory_budget:.2f} GB.{Style.RESET_ALL}")
+
+    # Histograms of each selection, collected once all the event loops of the file have run
+    selection_histograms = {selection_name: dict() for selection_name in pending}
+    file_cutflow = []
+    for idx, (units, expected_bytes) in enumerate(batches):
+        reset_peak_rss()
+        start = time.time()
+        # The cutflow of all the selections is booked in the first event loop only
+        input_file, booked_histograms, booked_cutflow = book_histograms(infile, output_files, tree_name, year, selections, adhoc_selection, adhoc_binning, systematics, skim_dir=skim_dir, friends=friends, friend_dir=friend_dir,
+                                                                      kernels=kernels, optimize=optimize, pass_rates=pass_rates, units=units, cutflow_selections=pending if idx == 0 else [])
+        booked = time.time()
+        for selection_name, histograms in selection_histograms.items():
+            collect_histograms([booked for booked in booked_histograms if booked[4] == selection_name], histograms)
+        file_cutflow += resolve_cutflow(booked_cutflow)
+        input_file.Close()
+        batch = f" ({idx + 1}/{len(batches)})" if len(batches) > 1 else ""
+        print(f"{Fore.YELLOW}Wall time for {infile}{batch}: booking {booked - start:.2f} s, event loop (including just-in-time compilation) {time.time() - booked:.2f} s{Style.RESET_ALL}")
+        print(f"{Fore.YELLOW}Peak RSS for {infile}{batch}: {peak_rss() / 1024**3:.2f} GB (expected histograms: {expected_bytes / 1024**3:.2f} GB){Style.RESET_ALL}")
 
-            # Add event selection making sure that the "base" selection is applied everywhere
-            print(f"Events before selection: {df.Count().GetValue()}")
-            event_selection = f"{selections['base']}{selections[selection_name]}" if not "base" in selection_name else f"{selections[selection_name]}"
-            if "singlee" in infile:
-                event_selection += " && passTrigMu==0" # Remove from the electron channel the events that fired the muon trigger. Could choose to do vice versa as well.
-            #print(f"Applying selection: {event_selection} -> Producing output file: {output_file}")
-            df_selected = df.Filter(event_selection)
-
-            # Check the number of events after selection
-            print(f"Events passing selection: {df_selected.Count().GetValue()}")
-
-            # Assign event weight based on data taking year and process type
-            for syst in systematics.keys():
-                if syst == "None":
-                    weight = assign_event_weight(year, infile)
-                else:
-                    weight = assign_event_weight(year, infile, systematics[syst])
-
-                # If weight is a complex expression, define it as a new column
-                weight_column = "weight_column" + syst
-                if not "data" in infile:
-                    print(f"Event weight: {Fore.GREEN}{weight}{Style.RESET_ALL}")
-                    df_selected = df_selected.Define(weight_column, weight)
-                else: # Keep the weight == 1 for collision data
-                    df_selected = df_selected.Define(weight_column, "1")
-
-                final_df = dict()
-                for (score, adhoc_sel), outfile in zip(adhoc_selection.items(), output_files):
-                    fOut = ROOT.TFile(outfile, "UPDATE")
-                    fOut.cd()
-                    print(f"Creating histogram for category: {outfile.split('_')[-2]} and selection: {selection_name}")
-                    hist_name = infile.split('/')[-1].replace('_tree.root','')
-                    if any(x in infile for x in tt_file_names):
-                        hist_name = selection_name
-                    if "Data" in infile:
-                        hist_name = "data_obs"
-                    if not syst == "None":
-                        hist_name = f"{hist_name}_{syst}"
-
-                    final_df[score] = df_selected.Filter(adhoc_sel)
-
-                    hist = final_df[score].Histo1D((f"{hist_name}", f"Histogram of {score} for process {hist_name}", len(adhoc_binning[score])-1, adhoc_binning[score]), score, weight_column)
-                    hist.Write()
-
-                    print(f"Saved histograms to: {outfile}\n")
-                    fOut.Close()
-
-                if "Data" in infile: break # Do not continue with the systematic variations for collision data
+    for selection_name, histograms in selection_histograms.items():
+        for outfile, hists in histograms.items():
+            collected_histograms.setdefault(outfile, dict()).update(hists)
+        if journal:
+            unit = unit_name(infile, "", selection_name)
+            journal.done(unit, infile, {outfile: journal.stash(unit, outfile, hists) for outfile, hists in histograms.items()},
+                         [entry for entry in file_cutflow if entry["selection"] == selection_name])
 
-        input_file.Close()
+    return cutflow + file_cutflow
+
+def fill_histograms(infile, output_files, tree_name, year, selections, adhoc_selection, adhoc_binning, systematics, skim_dir=None, friends=False, friend_dir=None, kernels=False, timing=False, optimize=False, pass_rates=None, memory_budget=0., journal=None):
+    """
+    Book and fill the histograms of a single input file, to be run in a worker process.
+    Return the histograms, grouped by output file and detached from any file so that they can be sent back to the main process, and the cutflow of the file.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - See process_trees for the other parameters.
+    """
+    rdf_log = enable_rdf_timing_log() if timing else None
+    filled_histograms = dict()
+    cutflow = fill_file(infile, filled_histograms, output_files, tree_name, year, selections, adhoc_selection, adhoc_binning, systematics, skim_dir=skim_dir, friends=friends,
+                        friend_dir=friend_dir, kernels=kernels, optimize=optimize, pass_rates=pass_rates, memory_budget=memory_budget, journal=journal)
+    if kernels:
+        print_kernel_timing()
+
+    return filled_histograms, cutflow
+
+def selection_applies(infile, selection_name):
+    """
+    Return True if a selection applies to an input file: the base selection applies to every sample,
+    the ttbar-specific selections to the right 4f and powheg samples.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - selection_name: Name of the selection.
+    """
+    if not "base" in selection_name and not any(x in infile for x in tt_file_names):
+        return False
+    if any(x in infile for x in tt_file_names) and "base" in selection_name:
+        return False
+    if any(x in selection_name for x in tt4f_strings) and not "4f" in infile:
+        return False
+    if any(x in selection_name for x in tt_strings) and not "powheg" in infile:
+        return False
+
+    return True
+
+def weight_variations(infile, systematics):
+    """
+    Return the names of the systematic variations filled for an input file (none for collision data).
+
+    Parameters:
+    - infile: Input ROOT file.
+    - systematics: Dictionary containing systematic variations.
+    """
+    return [syst for syst in systematics.keys() if not syst == "None"] if not "Data" in infile else []
+
+def booking_units(infile, selections, adhoc_selection, booked_selections=None):
+    """
+    Return the (selection name, score) pairs booked for an input file, in the order they are booked.
+    Each pair books one nominal histogram and one histogram per systematic variation.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - selections: Dictionary containing event selections.
+    - adhoc_selection: Dictionary containing an ad-hoc event selection to fill the scores.
+    - booked_selections: List of the selections to book. None means all the selections that apply to the file.
+    """
+    return [
+        (selection_name, score) for selection_name in selections
+        if selection_applies(infile, selection_name) and (booked_selections is None or selection_name in booked_selections) for score in adhoc_selection
+    ]
+
+def plan_booking(infile, selections, adhoc_selection, adhoc_binning, systematics, memory_budget=0., booked_selections=None):
+    """
+    Estimate the memory of the histograms booked for an input file before the event loop, i.e. the memory of each histogram times the number
+    of histograms times the number of processing slots (RDataFrame fills one copy of each histogram per slot), and split the booking into
+    batches whose expected memory fits in the budget. A unit exceeding the budget on its own is booked alone, with a warning.
+    Return a list of (list of (selection name, score) pairs, expected bytes) tuples, one per event loop.
 
+    Parameters:
+    - infile: Input ROOT file.
+    - memory_budget: Memory budget in GB of the histograms booked at once. 0 means no budget, i.e. a single batch.
+    - booked_selections: List of the selections to book. None means all the selections that apply to the file.
+    - See process_trees for the other parameters.
+    """
+    slots = rdf_slots()
+    histograms_per_unit = 1 + len(weight_variations(infile, systematics))
+    all_units = booking_units(infile, selections, adhoc_selection, booked_selections)
+    batches = [([], 0)]
+    for selection_name, score in all_units:
+        unit_bytes = histogram_bytes(len(adhoc_binning[score]) - 1, True) * histograms_per_unit * slots
+        units, expected_bytes = batches[-1]
+        if memory_budget > 0 and units and expected_bytes + unit_bytes > memory_budget * 1024**3:
+            batches.append(([], 0))
+            units, expected_bytes = batches[-1]
+        if memory_budget > 0 and unit_bytes > memory_budget * 1024**3:
+            print(f"{Fore.YELLOW}Warning: the {histograms_per_unit} histograms of {score} for selection {selection_name} alone exceed the memory budget of {memory_budget:.2f} GB ({unit_bytes / 1024**2:.1f} MB).{Style.RESET_ALL}")
+        units.append((selection_name, score))
+        batches[-1] = (units, expected_bytes + unit_bytes)
+
+    print(f"{Fore.YELLOW}Expected memory of the histograms of {infile}: {len(all_units) * histograms_per_unit} histograms x {slots} slots = {sum([expected_bytes for _, expected_bytes in batches]) / 1024**2:.1f} MB{Style.RESET_ALL}")
+
+    return batches
+
+def get_histogram(hist_name, result, variation):
+    """
+    Retrieve a filled histogram from a booked result and give it its final name.
+
+    Parameters:
+    - hist_name: Name of the histogram in the output file.
+    - result: Booked histogram, or map of varied histograms.
+    - variation: None for a nominal histogram, otherwise the key of the variation in the map.
+    """
+    hist = result.GetValue() if variation is None else result[variation]
+    hist.SetName(hist_name)
+
+    return hist
+
+def collect_histograms(booked_histograms, collected_histograms):
+    """
+    Retrieve the filled histograms and keep them in memory, grouped by output file, until they are all written at the end of the run.
+
+    Parameters:
+    - booked_histograms: List of (output file, histogram name, booked result, variation, selection name) tuples.
+    - collected_histograms: Dictionary {output file : {histogram name : histogram}} to be filled.
+    """
+    for outfile, hist_name, result, variation, _ in booked_histograms:
+        hist_clone = get_histogram(hist_name, result, variation).Clone()
+        hist_clone.SetDirectory(0)
+        collected_histograms.setdefault(outfile, dict())[hist_name] = hist_clone
+
+def write_histograms(collected_histograms):
+    """
+    Write the histograms to the category files, once per file. Histograms already present in the files
+    (e.g., produced by a previous run on collision data) are kept unless they are replaced by new ones.
+
+    Parameters:
+    - collected_histograms: Dictionary {output file : {histogram name : histogram}}.
+    """
+    for outfile, histograms in collected_histograms.items():
+        write_histograms_atomically(outfile, histograms, update=True)
+        print(f"Saved {len(histograms)} histograms to: {outfile}")
+
+def resolve_cutflow(booked_cutflow):
+    """
+    Replace the booked event counts of a cutflow with their values. Must be called after the event loop has run.
+
+    Parameters:
+    - booked_cutflow: List of dictionaries with keys 'file', 'selection', 'before', 'after'. 'before' may already be a number (read from a skim stamp).
+    """
+    return [
+        {"file": entry["file"], "selection": entry["selection"], "before": entry["before"] if isinstance(entry["before"], int) else entry["before"].GetValue(), "after": entry["after"].GetValue()}
+        for entry in booked_cutflow
+    ]
+
+def print_cutflow(cutflow):
+    """
+    Print a summary of the number of events before and after each selection.
+
+    Parameters:
+    - cutflow: List of dictionaries with keys 'file', 'selection', 'before', 'after'.
+    """
+    print(f"{Fore.YELLOW}Cutflow summary:{Style.RESET_ALL}")
+    for entry in cutflow:
+        efficiency = entry["after"] / entry["before"] if entry["before"] > 0 else 0.
+        print(f"{entry['file'].split('/')[-1]:<40} {entry['selection']:<6} before: {entry['before']:>12} after: {entry['after']:>12} ({efficiency:.4f})")
+
+def write_cutflow(cutflow, cutflow_file):
+    """
+    Write the cutflow to a csv file.
+
+    Parameters:
+    - cutflow: List of dictionaries with keys 'file', 'selection', 'before', 'after'.
+    - cutflow_file: Output csv file.
+    """
+    with open(cutflow_file, mode='w', newline='') as f:
+        csv_writer = csv.DictWriter(f, fieldnames=["file", "selection", "before", "after"])
+        csv_writer.writeheader()
+        csv_writer.writerows(cutflow)
+    print(f"Cutflow saved to: {cutflow_file}")
 
 def read_csv(csv_file):
     """
@@ -175,6 +514,30 @@ def assign_event_weight(year, infile, syst=""):
     
     return weight
 
+def weight_systematics(year):
+    """
+    Return the weight-based systematic variations, as a dictionary {name : ratio of the varied to the nominal weight}.
+    The "None" entry stands for the nominal weight.
+
+    Parameters:
+    - year: Data taking year.
+    """
+    return {"None" : "", 
+            "CMS_pileup_%sUp" % year : "puWeightUp/puWeight", 
+            "CMS_pileup_%sDown" % year : "puWeightDown/puWeight",
+            #"CMS_PS_isr%sUp" % year : "flavTagWeight_PSWeightISR_ttbar_UP/flavTagWeight",
+            #"CMS_PS_isr%sDown" % year : "flavTagWeight_PSWeightISR_ttbar_DOWN/flavTagWeight",
+            #"CMS_PS_fsr%sUp" % year : "flavTagWeight_PSWeightFSR_ttbar_UP/flavTagWeight",
+            #"CMS_PS_fsr%sDown" % year : "flavTagWeight_PSWeightFSR_ttbar_DOWN/flavTagWeight",
+            #"CMS_LHE_weights_scale_muF%sUp" % year: "flavTagWeight_LHEScaleWeight_muF_ttbar_UP/flavTagWeight",
+            #"CMS_LHE_weights_scale_muF%sDown" % year: "flavTagWeight_LHEScaleWeight_muF_ttbar_DOWN/flavTagWeight",
+            #"CMS_LHE_weights_scale_muR%sUp" % year: "flavTagWeight_LHEScaleWeight_muR_ttbar_UP/flavTagWeight",
+            #"CMS_LHE_weights_scale_muR%sDown" % year: "flavTagWeight_LHEScaleWeight_muR_ttbar_DOWN/flavTagWeight",
+            "CMS_JER%sUp" % year : "flavTagWeight_JER_UP/flavTagWeight",
+            "CMS_JER%sDown" % year : "flavTagWeight_JER_DOWN/flavTagWeight",
+            "CMS_JES%sUp" % year : "flavTagWeight_JES_UP/flavTagWeight",
+            "CMS_JES%sDown" % year : "flavTagWeight_JES_DOWN/flavTagWeight"}
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process ROOT TTrees into TH1D histograms.")
     parser.add_argument("--input_dirs", nargs='+', required=True, help="List of directories where the ROOT files are fetched.")
@@ -183,6 +546,21 @@ if __name__ == "__main__":
     parser.add_argument("--year", type=int, required=True, help="Data taking year.")
     parser.add_argument("--electron", nargs="?", const=1, type=bool, default=False, required=False, help="Process electron channel only.")
     parser.add_argument("--muon", nargs="?", const=1, type=bool, default=False, required=False, help="Process muon channel only.")
+    parser.add_argument("--fine_binning", nargs="?", const=1, type=bool, default=False, required=False, help="Fill the histograms with a fine binning, to be rebinned with rebinHistos.py.")
+    parser.add_argument("--jobs", type=int, default=1, required=False, help="Number of input files processed concurrently in separate processes.")
+    parser.add_argument("--threads", type=int, default=0, required=False, help="Number of ROOT threads (per process). 0 means all the available cores.")
+    parser.add_argument("--cutflow_file", type=str, required=False, help="csv file to save the number of events before and after each selection.")
+    parser.add_argument("--run_graphs", nargs="?", const=1, type=bool, default=False, required=False, help="Build the computation graphs of all files up front and run them concurrently in one process.")
+    parser.add_argument("--friends", nargs="?", const=1, type=bool, default=False, required=False, help="Read the derived columns from friend trees, built on the first run and rebuilt when stale.")
+    parser.add_argument("--friend_dir", type=str, required=False, help="Directory of the friend trees (required for remote input files). Default: the friends/ subdirectory of the input directory.")
+    parser.add_argument("--kernels", nargs="?", const=1, type=bool, default=False, required=False, help="Declare the selections, weights and derived columns as C++ functions once per process, instead of compiling them again for each file.")
+    parser.add_argument("--timing", nargs="?", const=1, type=bool, default=False, required=False, help="Report the time spent by RDataFrame in just-in-time compilation and in the event loops.")
+    parser.add_argument("--optimize", nargs="?", const=1, type=bool, default=False, required=False, help="Fold the known constants in the selections and weights, filter the base selection once per file, and order the conditions by rejection power.")
+    parser.add_argument("--pass_rates_file", type=str, required=False, help="csv file with the pass rate of each condition of the selections (columns 'conjunct' and 'pass_rate'), used with --optimize to evaluate the most rejecting conditions first.")
+    parser.add_argument("--skim_dir", type=str, required=False, help="Directory of the skims produced by skim.py, read instead of the input files when they are up to date.")
+    parser.add_argument("--journal", nargs="?", const=1, type=bool, default=False, required=False, help="Record each (file, selection) unit in a run journal in the output directory as soon as its file is processed, so that the run can be resumed.")
+    parser.add_argument("--resume", nargs="?", const=1, type=bool, default=False, required=False, help="Resume a run recorded in the journal: read back the completed units and process the failed or interrupted ones again (implies --journal).")
+    parser.add_argument("--memory_budget", type=float, default=0., required=False, help="Memory budget in GB (per process) of the histograms filled in the same event loop, including their copies per thread. The booking of a file exceeding it is split into several event loops.")
 
     args = parser.parse_args()
 
@@ -196,22 +574,19 @@ if __name__ == "__main__":
     for input_dir in args.input_dirs:
         input_files += glob.glob(f"{input_dir}*.root")
 
+    # Process the largest files first to minimize the tail of the run
+    input_files = sort_by_size(input_files)
+
     # Prepare list of output files based on the name of the input files
     output_files = prepare_output(args.output_dir, args.year, categories, prepended_, appended_)
     print(f"Output files: {output_files}")
 
     # Define event selections. Some are process-specific.
-    selections = {"base": "n_ak4>=4 && (n_btagM+n_ctagM)>=3 && n_btagM>=1",
-                 "ttbb" : " && genEventClassifier==9 && wcb==0",
-                 "ttbj" : " && (genEventClassifier==7 || genEventClassifier==8) && wcb==0",
-                 "ttcc" : " && genEventClassifier==6 && wcb==0",
-                 "ttcj" : " && (genEventClassifier==4 || genEventClassifier==5) && wcb==0",
-                 "ttLF" : " && tt_category==0 && higgs_decay==0 && wcb==0"
-    }
-
-    from weights_and_constants import adhoc_selection, adhoc_binning
+    selections = event_selections.copy()
+
+    from weights_and_constants import adhoc_selection, adhoc_binning, adhoc_fine_binning
     adhoc_selection = adhoc_selection.copy()
-    adhoc_binning = adhoc_binning.copy()
+    adhoc_binning = adhoc_binning.copy() if not args.fine_binning else adhoc_fine_binning.copy()
     
     # Apply trigger selection to separate channels if requested
     if args.electron:
@@ -221,20 +596,40 @@ if __name__ == "__main__":
 
     year = args.year
     # Define list of systematic variations to include
-    systematics = {"None" : "", 
-                   "CMS_pileup_%sUp" % year : "puWeightUp/puWeight", 
-                   "CMS_pileup_%sDown" % year : "puWeightDown/puWeight",
-                   #"CMS_PS_isr%sUp" % year : "flavTagWeight_PSWeightISR_ttbar_UP/flavTagWeight",
-                   #"CMS_PS_isr%sDown" % year : "flavTagWeight_PSWeightISR_ttbar_DOWN/flavTagWeight",
-                   #"CMS_PS_fsr%sUp" % year : "flavTagWeight_PSWeightFSR_ttbar_UP/flavTagWeight",
-                   #"CMS_PS_fsr%sDown" % year : "flavTagWeight_PSWeightFSR_ttbar_DOWN/flavTagWeight",
-                   #"CMS_LHE_weights_scale_muF%sUp" % year: "flavTagWeight_LHEScaleWeight_muF_ttbar_UP/flavTagWeight",
-                   #"CMS_LHE_weights_scale_muF%sDown" % year: "flavTagWeight_LHEScaleWeight_muF_ttbar_DOWN/flavTagWeight",
-                   #"CMS_LHE_weights_scale_muR%sUp" % year: "flavTagWeight_LHEScaleWeight_muR_ttbar_UP/flavTagWeight",
-                   #"CMS_LHE_weights_scale_muR%sDown" % year: "flavTagWeight_LHEScaleWeight_muR_ttbar_DOWN/flavTagWeight",
-                   "CMS_JER%sUp" % year : "flavTagWeight_JER_UP/flavTagWeight",
-                   "CMS_JER%sDown" % year : "flavTagWeight_JER_DOWN/flavTagWeight",
-                   "CMS_JES%sUp" % year : "flavTagWeight_JES_UP/flavTagWeight",
-                   "CMS_JES%sDown" % year : "flavTagWeight_JES_DOWN/flavTagWeight"}    
-
-    process_trees(input_files, output_files, args.tree_name, args.year, selections, adhoc_selection, adhoc_binning, systematics)
+    systematics = weight_systematics(year)
+
+    pass_rates = read_pass_rates(args.pass_rates_file) if args.pass_rates_file and os.path.exists(args.pass_rates_file) else None
+
+    # Journal of the units of the run. Everything that determines the content of the histograms is part of its configuration:
+    # the units completed with another configuration are processed again.
+    journal = None
+    if args.journal or args.resume:
+        configuration = {"tree": args.tree_name, "year": args.year, "selections": selections, "adhoc_selection": adhoc_selection, "adhoc_binning": adhoc_binning,
+                         "systematics": systematics, "output_files": output_files}
+        journal = run_journal(f"{args.output_dir}{args.year}/run_journal.jsonl", configuration, args.resume)
+        if args.resume:
+            journal.report()
+
+    # Arguments of fill_histograms and process_trees shared by all the input files
+    options = dict(output_files=output_files, tree_name=args.tree_name, year=args.year, selections=selections, adhoc_selection=adhoc_selection, adhoc_binning=adhoc_binning,
+                   systematics=systematics, skim_dir=args.skim_dir, friends=args.friends, friend_dir=args.friend_dir, kernels=args.kernels, timing=args.timing,
+                   optimize=args.optimize, pass_rates=pass_rates, memory_budget=args.memory_budget, journal=journal)
+
+    if args.jobs > 1:
+        # The workers only fill the histograms: they are all written to the category files at the end of the run
+        tasks = [dict(options, infile=infile) for infile in input_files]
+        collected_histograms = dict()
+        cutflow = []
+        for filled_histograms, file_cutflow in run_process_pool(fill_histograms, tasks, args.jobs, args.threads):
+            for outfile, histograms in filled_histograms.items():
+                collected_histograms.setdefault(outfile, dict()).update(histograms)
+            cutflow += file_cutflow
+    else:
+        enable_multithreading(args.threads)
+        collected_histograms, cutflow = process_trees(input_files, run_graphs=args.run_graphs, **options)
+
+    write_histograms(collected_histograms)
+
+    print_cutflow(cutflow)
+    if args.cutflow_file:
+        write_cutflow(cutflow, args.cutflow_file)
@@ -0,0 +1,162 @@
+import ROOT
+import argparse
+import glob
+import math
+import os
+from array import array
+from colorama import Fore, Style
+from histogram_io import read_histograms, write_histograms_atomically
+from weights_and_constants import adhoc_binning
+
+# Distribution filled in each datacard category (see prepareHistosForCards.py and prepareDatacards.py)
+category_distribution = {"catWcb" : "score_tt_Wcb", "catBB" : "fscore_ttbb", "catBJ" : "fscore_ttbj", "catCC" : "fscore_ttcc", "catCJ" : "fscore_ttcj", "catLF" : "fscore_ttLF"}
+
+def group_histograms(input_files, layout):
+    """
+    Read all the histograms of the input files and group them by distribution, since all the histograms of a distribution must share the same binning.
+    Return a dictionary {distribution : list of (file, histogram name, histogram, is nominal background)}.
+
+    Parameters:
+    - input_files: List of input ROOT files.
+    - layout: 'cards' for the category files of prepareHistosForCards.py (one file per category, one histogram per process),
+              'hdumper' for the files of hdumper.py (one file per process, one histogram per distribution).
+    """
+    groups = dict()
+    for infile in input_files:
+        file_name = os.path.basename(infile).replace('.root', '')
+        for hist_name, hist in read_histograms(infile).items():
+            if not isinstance(hist, ROOT.TH1):
+                continue
+            if layout == "cards":
+                category = file_name.split('_')[1]
+                distribution = category_distribution[category]
+                is_background = not (hist_name == "data_obs" or "Wcb" in hist_name or hist_name.endswith("Up") or hist_name.endswith("Down"))
+            else:
+                distribution = hist_name.replace('h_', '', 1)
+                is_background = not (file_name in ["h_Data", "h_singlee", "h_singlemu"] or "Wcb" in file_name)
+            groups.setdefault(distribution, []).append((infile, hist_name, hist, is_background))
+
+    return groups
+
+def auto_binning(bkg_hist, min_bkg, max_rel_unc):
+    """
+    Merge the fine bins of the total background histogram, starting from the upper edge (where the signal is), until each bin has a
+    background yield of at least min_bkg and a relative MC statistical uncertainty of at most max_rel_unc. Leftover bins at the lower
+    edge are merged into the last bin. Return the list of bin edges.
+
+    Parameters:
+    - bkg_hist: Total background histogram with the fine binning.
+    - min_bkg: Minimum background yield per bin.
+    - max_rel_unc: Maximum relative MC statistical uncertainty of the background per bin.
+    """
+    nbins = bkg_hist.GetNbinsX()
+    edges = [bkg_hist.GetBinLowEdge(nbins + 1)]
+    content, error2 = 0., 0.
+    for ibin in range(nbins, 0, -1):
+        content += bkg_hist.GetBinContent(ibin)
+        error2 += bkg_hist.GetBinError(ibin)**2
+        if content > 0 and content >= min_bkg and math.sqrt(error2) / content <= max_rel_unc:
+            edges.append(bkg_hist.GetBinLowEdge(ibin))
+            content, error2 = 0., 0.
+
+    # Make sure that the binning covers the full range
+    xmin = bkg_hist.GetBinLowEdge(1)
+    if len(edges) > 1:
+        edges[-1] = xmin
+    else:
+        edges.append(xmin)
+
+    return edges[::-1]
+
+def check_edges(hist, edges):
+    """
+    Check that the new bin edges are also edges of the fine binning of the histogram.
+
+    Parameters:
+    - hist: Histogram with the fine binning.
+    - edges: New bin edges.
+    """
+    fine_edges = [hist.GetBinLowEdge(ibin) for ibin in range(1, hist.GetNbinsX() + 2)]
+    for edge in edges:
+        if min([abs(edge - fine_edge) for fine_edge in fine_edges]) > 1e-9:
+            raise ValueError(f"Bin edge {edge} is not an edge of the fine binning of histogram '{hist.GetName()}'.")
+
+def rebin_groups(groups, binning, auto, min_bkg, max_rel_unc):
+    """
+    Rebin the histograms of each distribution. Return a dictionary {file : {histogram name : rebinned histogram}}.
+
+    Parameters:
+    - groups: Dictionary {distribution : list of (file, histogram name, histogram, is nominal background)}.
+    - binning: Dictionary {distribution : bin edges}, used unless the automatic binning is requested.
+    - auto: Boolean indicating whether to derive the bin edges from the background yields and MC statistics.
+    - min_bkg: Minimum background yield per bin for the automatic binning.
+    - max_rel_unc: Maximum relative MC statistical uncertainty of the background per bin for the automatic binning.
+    """
+    rebinned_histograms = dict()
+    for distribution, hists in groups.items():
+        if auto:
+            backgrounds = [hist for _, _, hist, is_background in hists if is_background]
+            if not backgrounds:
+                print(f"{Fore.YELLOW}No background histograms for {distribution}: skipping.{Style.RESET_ALL}")
+                continue
+            bkg_hist = backgrounds[0].Clone(f"bkg_{distribution}")
+            bkg_hist.SetDirectory(0)
+            for hist in backgrounds[1:]:
+                bkg_hist.Add(hist)
+            edges = auto_binning(bkg_hist, min_bkg, max_rel_unc)
+        elif distribution in binning:
+            edges = list(binning[distribution])
+        else:
+            print(f"{Fore.YELLOW}No binning defined for {distribution}: skipping.{Style.RESET_ALL}")
+            continue
+        print(f"Binning for {Fore.GREEN}{distribution}{Style.RESET_ALL}: {[round(edge, 6) for edge in edges]}")
+
+        for infile, hist_name, hist, _ in hists:
+            check_edges(hist, edges)
+            rebinned = hist.Rebin(len(edges) - 1, hist_name, array('d', edges))
+            rebinned.SetDirectory(0)
+            rebinned_histograms.setdefault(infile, dict())[hist_name] = rebinned
+
+    return rebinned_histograms
+
+def parse_binning(binning_args):
+    """
+    Parse bin edges given on the command line, e.g. "fscore_ttbb=0,0.6,1". Return a dictionary {distribution : bin edges}.
+
+    Parameters:
+    - binning_args: List of strings <distribution>=<comma-separated edges>.
+    """
+    binning = dict()
+    for binning_arg in binning_args:
+        distribution, edges = binning_arg.split('=')
+        binning[distribution] = [float(edge) for edge in edges.split(',')]
+
+    return binning
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebin fine-binned histograms into variable-width bins, without reprocessing the ntuples.")
+    parser.add_argument("--input_dir", type=str, required=True, help="Input directory, where the fine-binned ROOT files are located.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Output directory for the rebinned ROOT files.")
+    parser.add_argument("--layout", type=str, default="cards", choices=["cards", "hdumper"], required=False, help="Layout of the input files: category files from prepareHistosForCards.py or process files from hdumper.py.")
+    parser.add_argument("--binning", nargs='+', default=[], required=False, help="Bin edges overriding the adhoc_binning, e.g. \"fscore_ttbb=0,0.6,1\".")
+    parser.add_argument("--auto", nargs="?", const=1, type=bool, default=False, required=False, help="Derive the bin edges from the background yields and MC statistics.")
+    parser.add_argument("--min_bkg", type=float, default=10., required=False, help="Minimum background yield per bin for the automatic binning.")
+    parser.add_argument("--max_rel_unc", type=float, default=0.1, required=False, help="Maximum relative MC statistical uncertainty of the background per bin for the automatic binning.")
+
+    args = parser.parse_args()
+
+    input_files = glob.glob(f"{args.input_dir}*.root")
+    if args.layout == "cards":
+        input_files = [infile for infile in input_files if os.path.basename(infile).startswith("Vcb_cat")]
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    binning = {distribution : list(edges) for distribution, edges in adhoc_binning.items()}
+    binning.update(parse_binning(args.binning))
+
+    groups = group_histograms(input_files, args.layout)
+    rebinned_histograms = rebin_groups(groups, binning, args.auto, args.min_bkg, args.max_rel_unc)
+
+    for infile, histograms in rebinned_histograms.items():
+        output_file = os.path.join(args.output_dir, os.path.basename(infile))
+        write_histograms_atomically(output_file, histograms)
+        print(f"Saved {len(histograms)} rebinned histograms to: {output_file}")
@@ -5,4 +5,7 @@
 python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/mc/ --output_dir histos_07072025/scores_ttLFm0p1_ttWcbM0p6/  --tree_name Events --input_csv hconfig_minimal.csv --year 2018 --add_selection "score_ttLF < 0.1 && score_tt_Wcb > 0.6"
 # Use 5FS and select ttLF < 0.1
 #python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/mc/ --output_dir histos_07072025/scores_ttLFm0p1_5FS/  --tree_name Events --input_csv hconfig_scores.csv --year 2018 --add_selection "score_ttLF < 0.1" --use5FS
-#python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/data/ --output_dir histos_07072025/scores_ttLFm0p1_5FS/  --tree_name Events --input_csv hconfig_scores.csv --year 2018 --add_selection "score_ttLF < 0.1" --use5FS
\ No newline at end of file
+#python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/data/ --output_dir histos_07072025/scores_ttLFm0p1_5FS/  --tree_name Events --input_csv hconfig_scores.csv --year 2018 --add_selection "score_ttLF < 0.1" --use5FS
+# Fill the multidimensional score histograms once, then derive any rectangular score cut with scoreCuts.py
+#python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/mc/ --output_dir histos_07072025/scores_sparse/  --tree_name Events --input_csv hconfig_scores.csv --year 2018 --sparse_nbins 100 --single_event_loop
+#python3 scoreCuts.py --input_dir histos_07072025/scores_sparse/ --cuts "score_ttLF<0.1" "score_tt_Wcb>0.6" --project score_tt_Wcb score_ttbb --output_dir histos_07072025/scores_ttLFm0p1_ttWcbM0p6_fromSparse/
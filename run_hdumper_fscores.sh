@@ -4,4 +4,10 @@ python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/290120
 python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/data/ --output_dir histos_07072025/evtClassification_ttLFm0p1/  --tree_name Events --input_csv hconfig_fscores.csv --year 2018 --eventClassification
 
 #python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/mc/ --output_dir histos_07072025/  --tree_name Events --input_csv hconfig_fscores.csv --year 2018 --eventClassification --use5FS
-#python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/data/ --output_dir histos_07072025/  --tree_name Events --input_csv hconfig_fscores.csv --year 2018 --eventClassification --use5FS
\ No newline at end of file
+#python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/data/ --output_dir histos_07072025/  --tree_name Events --input_csv hconfig_fscores.csv --year 2018 --eventClassification --use5FS
+# Scan several event classification weight sets and thresholds in a single event loop (one output subdirectory per weight set)
+#python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/mc/ --output_dir histos_07072025/evtClassification_scan/  --tree_name Events --input_csv hconfig_fscores.csv --year 2018 --eventClassification --scan_csv hconfig_scan.csv
+# Fill the 4FS/5FS and electron/muon variants from a single read of the input files (one output subdirectory per variant)
+#python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/mc/ --output_dir histos_07072025/evtClassification_variants/  --tree_name Events --input_csv hconfig_fscores.csv --year 2018 --eventClassification --variants_csv hconfig_variants.csv
+# Process MC and data in a single run, scheduled over all the samples of the manifest (cached in sample_manifest.json)
+#python3 hdumper.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/mc/ /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/data/ --output_dir histos_07072025/evtClassification_ttLFm0p1/  --tree_name Events --input_csv hconfig_fscores.csv --year 2018 --eventClassification --jobs 4
@@ -3,4 +3,7 @@
 #python3 prepareHistosForCards.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/mc/ --output_dir test_withSyst_newHists/ --tree_name Events --year 2018
 
 python3 prepareHistosForCards.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/data/total/ --output_dir datacard_preparation/ --tree_name Events --year 2018
-python3 prepareHistosForCards.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/mc/ --output_dir datacard_preparation/ --tree_name Events --year 2018
\ No newline at end of file
+python3 prepareHistosForCards.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/mc/ --output_dir datacard_preparation/ --tree_name Events --year 2018
+# Fill the histograms once with a fine binning, then derive the binning for the cards without touching the ntuples
+#python3 prepareHistosForCards.py --input_dirs /eos/cms/store/cmst3/group/top/rsalvatico/29012025_2018_1L/mc/ --output_dir datacard_preparation_fine/ --tree_name Events --year 2018 --fine_binning
+#python3 rebinHistos.py --input_dir datacard_preparation_fine/2018/ --output_dir datacard_preparation/2018/ --auto --min_bkg 10 --max_rel_unc 0.1
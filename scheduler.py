@@ -0,0 +1,156 @@
+import ROOT
+import os
+import bisect
+import time
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from colorama import Fore, Style
+
+def file_size(path):
+    """
+    Return the size in bytes of an input file, or 0 if it cannot be determined (e.g., remote xrootd paths).
+
+    Parameters:
+    - path: Path to the input file.
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def sort_by_size(input_files):
+    """
+    Sort the input files from the largest to the smallest, so that the longest tasks are started first and the tail of the run is minimized.
+
+    Parameters:
+    - input_files: List of input ROOT files.
+    """
+    return sorted(input_files, key=file_size, reverse=True)
+
+def enable_multithreading(threads=0):
+    """
+    Enable ROOT implicit multi-threading.
+
+    Parameters:
+    - threads: Number of threads to use. 0 means all the available cores, 1 means sequential event loops (implicit multi-threading disabled).
+    """
+    if threads == 1:
+        ROOT.ROOT.DisableImplicitMT()
+        return
+    ROOT.ROOT.EnableImplicitMT(threads)
+
+def rdf_slots():
+    """
+    Return the number of processing slots of the RDataFrames created by the process, i.e. the number of copies of each booked histogram.
+    """
+    return ROOT.ROOT.GetThreadPoolSize() if ROOT.ROOT.IsImplicitMTEnabled() else 1
+
+def timed_call(function, *args, **kwargs):
+    """
+    Execute function(*args, **kwargs) and return its result and its wall time in seconds.
+
+    Parameters:
+    - function: Function to execute.
+    - args: Arguments of the function.
+    - kwargs: Keyword arguments of the function.
+    """
+    start = time.time()
+    result = function(*args, **kwargs)
+
+    return result, time.time() - start
+
+def run_process_pool(function, tasks, jobs, threads=0, timings=None):
+    """
+    Execute function(*task), or function(**task) for a dictionary, for every task in a pool of worker processes and return the results in the order of the tasks.
+    Tasks are submitted in the given order, i.e. pass them sorted largest-first to minimize the tail of the run.
+
+    Parameters:
+    - function: Top-level (picklable) function to execute.
+    - tasks: List of tuples of arguments or of dictionaries of keyword arguments, one per task.
+    - jobs: Number of worker processes.
+    - threads: Number of ROOT threads per worker. 0 means the available cores are shared evenly among the workers.
+    - timings: List to which the wall time of each task, measured in the worker, is appended in the order of the tasks. None means that the tasks are not timed.
+    """
+    if threads == 0:
+        threads = max(1, (os.cpu_count() or 1) // jobs)
+    print(f"{Fore.YELLOW}Running {len(tasks)} tasks on {jobs} worker processes with {threads} threads each.{Style.RESET_ALL}")
+
+    # Spawn (rather than fork) the workers, since forking a process with a running thread pool is unsafe
+    context = multiprocessing.get_context("spawn")
+    results = [None] * len(tasks)
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=enable_multithreading, initargs=(threads,)) as pool:
+        futures = dict()
+        for idx, task in enumerate(tasks):
+            args, kwargs = ((), task) if isinstance(task, dict) else (task, dict())
+            futures[pool.submit(timed_call, function, *args, **kwargs) if timings is not None else pool.submit(function, *args, **kwargs)] = idx
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+
+    if timings is not None:
+        timings += [elapsed for _, elapsed in results]
+        results = [result for result, _ in results]
+
+    return results
+
+def cluster_starts(tree):
+    """
+    Return the first entry of each cluster of a tree.
+
+    Parameters:
+    - tree: Input TTree.
+    """
+    entries = tree.GetEntries()
+    starts = []
+    cluster_iterator = tree.GetClusterIterator(0)
+    start = cluster_iterator.Next()
+    while start < entries:
+        starts.append(start)
+        start = cluster_iterator.Next()
+
+    return starts
+
+def entry_range(entries, starts, part, parts):
+    """
+    Return the range [begin, end) of the entries of one part of a tree split into parts of about the same number of entries.
+    The boundaries are moved to the nearest cluster boundary, so that no cluster is read by two parts, unless this would leave a part empty.
+    The boundaries only depend on the tree and the number of parts, so that the parts processed separately cover each entry exactly once.
+
+    Parameters:
+    - entries: Number of entries of the tree.
+    - starts: First entry of each cluster (see cluster_starts).
+    - part: Index of the part.
+    - parts: Number of parts.
+    """
+    # Every part has at least one entry, if the tree has enough entries
+    boundaries = [max(entries * k // parts, min(k, entries)) for k in range(parts + 1)]
+    starts = sorted(starts) + [entries]
+    if len(starts) > 1:
+        aligned = [0]
+        for boundary in boundaries[1:-1]:
+            idx = bisect.bisect_right(starts, boundary) - 1
+            aligned.append(starts[idx] if boundary - starts[idx] <= starts[min(idx + 1, len(starts) - 1)] - boundary else starts[idx + 1])
+        aligned.append(entries)
+        if all([begin < end for begin, end in zip(aligned[:-1], aligned[1:])]):
+            boundaries = aligned
+
+    return boundaries[part], boundaries[part + 1]
+
+def print_task_timing(labels, timings, nbins=10, slowest=5):
+    """
+    Print a histogram of the wall times of the tasks and the slowest tasks, so that the stragglers are visible.
+
+    Parameters:
+    - labels: Description of each task.
+    - timings: Wall time of each task in seconds.
+    - nbins: Number of bins of the histogram.
+    - slowest: Number of slowest tasks listed.
+    """
+    if not timings:
+        return
+    counts, edges = np.histogram(timings, bins=nbins)
+    width = max(1, max(counts))
+    print(f"{Fore.YELLOW}Wall time of {len(timings)} tasks: min {min(timings):.1f} s, median {np.median(timings):.1f} s, max {max(timings):.1f} s, total {sum(timings):.1f} s{Style.RESET_ALL}")
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        print(f"[{low:8.1f}, {high:8.1f}) s {'#' * int(round(40 * count / width)):<40} {count}")
+    print(f"Slowest tasks: {', '.join([f'{labels[idx]} ({timings[idx]:.1f} s)' for idx in np.argsort(timings)[::-1][:slowest]])}")
@@ -0,0 +1,152 @@
+import ROOT
+import argparse
+import glob
+import csv
+import os
+from colorama import Fore, Style
+
+def read_score_histograms(input_files, hist_name):
+    """
+    Read the multidimensional score histograms produced by hdumper.py --sparse_nbins from multiple files.
+    Return a dictionary {process name : histogram}, where the process name is derived from the file name. Collision data are skipped.
+
+    Parameters:
+    - input_files: List of input ROOT files.
+    - hist_name: Name of the multidimensional histograms.
+    """
+    score_histograms = dict()
+    for infile in input_files:
+        process = os.path.basename(infile).replace('h_', '', 1).replace('.root', '')
+        if process in ["Data", "singlee", "singlemu"]:
+            continue
+
+        root_file = ROOT.TFile.Open(infile)
+        if not root_file or root_file.IsZombie():
+            raise FileNotFoundError(f"Could not open file: {infile}")
+
+        hist = root_file.Get(hist_name)
+        if not hist or not isinstance(hist, ROOT.THnBase):
+            print(f"Histogram '{hist_name}' not found in file '{infile}'. Skipping.")
+            root_file.Close()
+            continue
+
+        # Clone the histogram to avoid issues when the file is closed
+        score_histograms[process] = hist.Clone()
+        root_file.Close()
+
+    return score_histograms
+
+def parse_cuts(cuts):
+    """
+    Parse a list of cuts like "score_tt_Wcb>0.6" or "score_ttLF<0.1" into a dictionary {score : [lower bound, upper bound]}.
+
+    Parameters:
+    - cuts: List of strings, each with a single '<' or '>' comparison.
+    """
+    bounds = dict()
+    for cut in cuts:
+        cut = cut.replace(" ", "")
+        if ">" in cut:
+            score, value = cut.split(">")
+            bounds.setdefault(score, [None, None])[0] = float(value.lstrip("="))
+        elif "<" in cut:
+            score, value = cut.split("<")
+            bounds.setdefault(score, [None, None])[1] = float(value.lstrip("="))
+        else:
+            raise ValueError(f"Could not parse cut '{cut}': expected a '<' or '>' comparison.")
+
+    return bounds
+
+def apply_cuts(hist, bounds):
+    """
+    Restrict the axis ranges of a multidimensional score histogram to a rectangular cut. Cuts are rounded to the bin edges.
+
+    Parameters:
+    - hist: Multidimensional score histogram. Its title holds the names of the scores on the axes, separated by ':'.
+    - bounds: Dictionary {score : [lower bound, upper bound]}, with None for no bound.
+    """
+    scores = hist.GetTitle().split(":")
+    for idx in range(hist.GetNdimensions()):
+        hist.GetAxis(idx).SetRange(0, 0) # Reset any previous cut
+    for score, (low, high) in bounds.items():
+        if score not in scores:
+            raise ValueError(f"Score '{score}' not found in the histogram axes: {scores}")
+        axis = hist.GetAxis(scores.index(score))
+        first_bin = 1 if low is None else axis.FindFixBin(low)
+        last_bin = axis.GetNbins() if high is None else axis.FindFixBin(high)
+        if low is not None and abs(axis.GetBinUpEdge(first_bin) - low) < 1e-9:
+            first_bin += 1 # The lower bound is the upper edge of the bin (up to rounding), which is then excluded
+        if high is not None and abs(axis.GetBinLowEdge(last_bin) - high) < 1e-9:
+            last_bin -= 1 # The upper bound is the lower edge of the bin, which is then excluded
+        for value in [low, high]:
+            value_bin = axis.FindFixBin(value) if value is not None else 0
+            if value is not None and min(abs(axis.GetBinLowEdge(value_bin) - value), abs(axis.GetBinUpEdge(value_bin) - value)) > 1e-9:
+                print(f"{Fore.YELLOW}Cut {score} at {value} is not on a bin edge and is rounded to the bin granularity.{Style.RESET_ALL}")
+        axis.SetRange(first_bin, last_bin)
+
+def derive_yields(score_histograms, bounds, sig_name, projections, output_dir):
+    """
+    Derive the yields and the signal purity for a rectangular cut on the scores, and save the 1D projections of the selected events.
+
+    Parameters:
+    - score_histograms: Dictionary {process name : multidimensional score histogram}.
+    - bounds: Dictionary {score : [lower bound, upper bound]}.
+    - sig_name: Name of the signal process, used for the purity.
+    - projections: List of scores to project on.
+    - output_dir: Output directory for the projections. One file per process, with histograms named h_<score>, as produced by hdumper.py.
+    """
+    yields = dict()
+    for process, hist in score_histograms.items():
+        apply_cuts(hist, bounds)
+        yield_hist = hist.Projection(0)
+        yield_hist.SetDirectory(0)
+        yields[process] = yield_hist.Integral(0, yield_hist.GetNbinsX() + 1)
+
+        if output_dir:
+            scores = hist.GetTitle().split(":")
+            output_root = ROOT.TFile(f"{output_dir}h_{process}.root", "RECREATE")
+            for score in projections:
+                proj = hist.Projection(scores.index(score))
+                proj.SetName(f"h_{score}")
+                proj.SetTitle(f"Histogram of {score}")
+                proj.Write()
+            output_root.Close()
+
+    total_yield = sum(yields.values())
+    sig_yield = sum([y for process, y in yields.items() if sig_name in process])
+    for process, y in sorted(yields.items(), key=lambda item: -item[1]):
+        print(f"{process:<30} yield: {y:>12.2f}")
+    print(f"{Fore.GREEN}Total: {total_yield:.2f}, {sig_name}: {sig_yield:.2f}, purity: {sig_yield / total_yield if total_yield > 0 else 0.:.4f}{Style.RESET_ALL}")
+
+    return yields
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Derive yields, purities, and 1D projections for rectangular score cuts from multidimensional score histograms.")
+    parser.add_argument("--input_dir", type=str, required=True, help="Input directory, where the ROOT files produced by hdumper.py --sparse_nbins are located.")
+    parser.add_argument("--hist_name", type=str, default="h_scores", required=False, help="Name of the multidimensional score histogram.")
+    parser.add_argument("--cuts", nargs='+', default=[], required=False, help="Rectangular cuts on the scores, e.g. \"score_tt_Wcb>0.6\" \"score_ttLF<0.1\".")
+    parser.add_argument("--sig_name", type=str, default="Wcb", required=False, help="Name of the signal process, used for the purity.")
+    parser.add_argument("--project", nargs='+', default=[], required=False, help="Scores to project on after the cuts.")
+    parser.add_argument("--output_dir", type=str, required=False, help="Output directory for the 1D projections.")
+    parser.add_argument("--yields_file", type=str, required=False, help="csv file to save the yields for each process.")
+
+    args = parser.parse_args()
+
+    # Get input files from the input_dir
+    input_files = glob.glob(f"{args.input_dir}*.root")
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    score_histograms = read_score_histograms(input_files, args.hist_name)
+    bounds = parse_cuts(args.cuts)
+    print(f"Applying cuts: {Fore.GREEN}{bounds}{Style.RESET_ALL}")
+
+    yields = derive_yields(score_histograms, bounds, args.sig_name, args.project, args.output_dir)
+
+    if args.yields_file:
+        with open(args.yields_file, mode='w', newline='') as f:
+            csv_writer = csv.writer(f)
+            csv_writer.writerow(["process", "yield"])
+            csv_writer.writerows(sorted(yields.items()))
+        print(f"Yields saved to: {args.yields_file}")
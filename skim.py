@@ -0,0 +1,203 @@
+import ROOT
+import argparse
+import glob
+import json
+import os
+import re
+from colorama import Fore, Style
+from scheduler import sort_by_size, enable_multithreading, run_process_pool
+
+# Names that appear in the expressions but are not columns
+cpp_keywords = ["abs", "size", "static_cast", "double", "float", "int", "ROOT", "RVecD", "true", "false"]
+
+def discover_columns(expressions, available_columns):
+    """
+    Find the columns of a tree referenced by a list of expressions (selections, weights, definitions of new columns, branch names).
+    Return the sorted list of columns.
+
+    Parameters:
+    - expressions: List of C++ expressions or column names.
+    - available_columns: List of the columns of the tree.
+    """
+    available_columns = set(available_columns)
+    columns = set()
+    for expression in expressions:
+        for name in re.findall(r"[A-Za-z_][A-Za-z0-9_]*", expression):
+            if name in available_columns and not name in cpp_keywords:
+                columns.add(name)
+
+    return sorted(columns)
+
+def skim_path(skim_dir, infile):
+    """
+    Return the path of the skim of an input file.
+
+    Parameters:
+    - skim_dir: Directory of the skims.
+    - infile: Input ROOT file.
+    """
+    return os.path.join(skim_dir, os.path.basename(infile))
+
+def source_stamp(input_file):
+    """
+    Return the size and the modification date of an opened input file, used to check whether its skim is up to date.
+
+    Parameters:
+    - input_file: The opened input TFile.
+    """
+    return {"size": input_file.GetSize(), "date": input_file.GetModificationDate().Convert()}
+
+def read_skim_stamp(skim_file):
+    """
+    Return the stamp written next to a skim, or None if the skim does not exist.
+
+    Parameters:
+    - skim_file: Skim ROOT file.
+    """
+    if not os.path.exists(skim_file) or not os.path.exists(f"{skim_file}.json"):
+        return None
+    with open(f"{skim_file}.json") as f:
+        return json.load(f)
+
+def find_skim(skim_dir, infile, tree_name, selection, expressions):
+    """
+    Return the skim of an input file if it is up to date, i.e. it was produced from the current version of the input file,
+    with a selection looser than (or equal to) the given one and with all the columns referenced by the expressions.
+    Otherwise, return the input file itself.
+
+    Parameters:
+    - skim_dir: Directory of the skims.
+    - infile: Input ROOT file.
+    - tree_name: Name of the TTree.
+    - selection: Selection applied to all the events read by the caller. It must start with the skim selection.
+    - expressions: List of expressions and column names used by the caller.
+    """
+    skim_file = skim_path(skim_dir, infile)
+    stamp = read_skim_stamp(skim_file)
+    if stamp is None:
+        print(f"{Fore.YELLOW}No skim found for {infile}: reading the original file.{Style.RESET_ALL}")
+        return infile
+
+    input_file = ROOT.TFile.Open(infile)
+    if not input_file or input_file.IsZombie():
+        raise FileNotFoundError(f"Could not open file: {infile}")
+    current_stamp = source_stamp(input_file)
+    input_file.Close()
+
+    missing_columns = [column for column in discover_columns(expressions, stamp["source_columns"]) if not column in stamp["columns"]]
+    if not stamp["source"] == current_stamp:
+        reason = "the input file changed"
+    elif not stamp["tree"] == tree_name:
+        reason = f"it contains the tree '{stamp['tree']}'"
+    elif not selection.startswith(stamp["selection"]):
+        reason = f"its selection '{stamp['selection']}' is not looser than '{selection}'"
+    elif missing_columns:
+        reason = f"it lacks the columns {missing_columns}"
+    else:
+        print(f"Reading the skim {Fore.GREEN}{skim_file}{Style.RESET_ALL} ({stamp['entries_out']}/{stamp['entries_in']} events, {len(stamp['columns'])}/{len(stamp['source_columns'])} columns)")
+        return skim_file
+
+    print(f"{Fore.YELLOW}The skim {skim_file} is out of date ({reason}): reading the original file.{Style.RESET_ALL}")
+    return infile
+
+def skim_file(infile, skim_dir, tree_name, selection, expressions, force=False):
+    """
+    Write a compressed snapshot of the events of an input file passing the selection, with only the columns referenced by the expressions.
+    A stamp with the provenance of the skim is written next to it as <skim>.json.
+
+    Parameters:
+    - infile: Input ROOT file.
+    - skim_dir: Directory of the skims.
+    - tree_name: Name of the TTree.
+    - selection: Selection of the skimmed events.
+    - expressions: List of expressions and column names whose columns are kept.
+    - force: Boolean indicating whether to rewrite the skim even if it is up to date.
+    """
+    output_file = skim_path(skim_dir, infile)
+
+    input_file = ROOT.TFile.Open(infile)
+    if not input_file or input_file.IsZombie():
+        raise FileNotFoundError(f"Could not open file: {infile}")
+    tree = input_file.Get(tree_name)
+    if not tree or not isinstance(tree, ROOT.TTree):
+        raise ValueError(f"TTree '{tree_name}' not found in file '{infile}'.")
+
+    df = ROOT.RDataFrame(tree)
+    source_columns = [str(column) for column in df.GetColumnNames()]
+    columns = discover_columns(expressions, source_columns)
+
+    stamp = read_skim_stamp(output_file)
+    if not force and stamp and stamp["source"] == source_stamp(input_file) and stamp["tree"] == tree_name \
+       and stamp["selection"] == selection and set(columns).issubset(stamp["columns"]):
+        print(f"Skim of {infile} is up to date: skipping.")
+        input_file.Close()
+        return
+
+    print(f"{Fore.RED}Skimming file: {infile}{Style.RESET_ALL} -> keeping {len(columns)}/{len(source_columns)} columns")
+    count_before = df.Count()
+    df_skimmed = df.Filter(selection)
+    count_after = df_skimmed.Count()
+
+    # Write to a temporary file first, so that an interrupted skim is never mistaken for a complete one
+    tmp_file = f"{output_file}.{os.getpid()}.tmp"
+    options = ROOT.RDF.RSnapshotOptions()
+    options.fCompressionAlgorithm = ROOT.ROOT.RCompressionSetting.EAlgorithm.kZSTD
+    options.fCompressionLevel = 5
+    df_skimmed.Snapshot(tree_name, tmp_file, columns, options)
+    os.replace(tmp_file, output_file)
+
+    stamp = {
+        "source": source_stamp(input_file), "tree": tree_name, "selection": selection,
+        "columns": columns, "source_columns": source_columns,
+        "entries_in": count_before.GetValue(), "entries_out": count_after.GetValue()
+    }
+    input_file.Close()
+    with open(f"{output_file}.json", "w") as f:
+        json.dump(stamp, f, indent=1)
+
+    efficiency = stamp["entries_out"] / stamp["entries_in"] if stamp["entries_in"] > 0 else 0.
+    print(f"Saved skim to: {output_file} (selection efficiency: {efficiency:.4f}, size: {os.path.getsize(output_file) / 1024**2:.1f} MB)\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Skim the input trees once per sample: keep only the events passing the base selection and the columns used by hdumper.py and prepareHistosForCards.py.")
+    parser.add_argument("--input_dirs", nargs='+', required=True, help="List of directories where the ROOT files are fetched.")
+    parser.add_argument("--skim_dir", type=str, required=True, help="Output directory of the skims.")
+    parser.add_argument("--tree_name", type=str, required=True, help="Name of the TTree in the input files.")
+    parser.add_argument("--year", type=int, required=True, help="Data taking year.")
+    parser.add_argument("--input_csvs", nargs='+', default=[], required=False, help="csv files with the variables to histogram (as given to hdumper.py). Their columns are kept.")
+    parser.add_argument("--keep", nargs='+', default=[], required=False, help="Additional columns to keep.")
+    parser.add_argument("--force", nargs="?", const=1, type=bool, default=False, required=False, help="Rewrite the skims even if they are up to date.")
+    parser.add_argument("--jobs", type=int, default=1, required=False, help="Number of input files skimmed concurrently in separate processes.")
+    parser.add_argument("--threads", type=int, default=0, required=False, help="Number of ROOT threads (per process). 0 means all the available cores.")
+
+    args = parser.parse_args()
+
+    from hdumper import read_csv, assign_event_weight
+    from prepareHistosForCards import weight_systematics
+    from weights_and_constants import event_selections, adhoc_event_category, adhoc_selection, fscore_definitions, leading_jet_definitions
+
+    # Get input files from the input_dirs list
+    input_files = []
+    for input_dir in args.input_dirs:
+        input_files += glob.glob(f"{input_dir}*.root")
+    input_files = sort_by_size(input_files)
+    os.makedirs(args.skim_dir, exist_ok=True)
+
+    # Everything read by the downstream tools: selections (including the trigger requirements of the single-lepton channels),
+    # event weights and their systematic variations, event classification, derived columns, and histogrammed variables
+    expressions = list(event_selections.values()) + ["passTrigEl", "passTrigMu", "topptWeight", adhoc_event_category]
+    expressions += list(weight_systematics(args.year).values()) + list(adhoc_selection.values())
+    expressions += list(fscore_definitions.values()) + list(leading_jet_definitions.values())
+    expressions += [hist_config['branch'] for input_csv in args.input_csvs for hist_config in read_csv(input_csv)]
+    expressions += args.keep
+
+    tasks = [
+        (infile, args.skim_dir, args.tree_name, event_selections["base"], expressions + [assign_event_weight(args.year, infile)], args.force)
+        for infile in input_files
+    ]
+    if args.jobs > 1:
+        run_process_pool(skim_file, tasks, args.jobs, args.threads)
+    else:
+        enable_multithreading(args.threads)
+        for task in tasks:
+            skim_file(*task)
@@ -0,0 +1,257 @@
+import argparse
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from colorama import Fore, Style
+
+# Increase when the layout of the staged files changes, to copy all of them again
+STAGING_VERSION = 1
+# Size of the blocks read and written while copying and checksumming
+block_size = 16 * 1024**2
+
+def copy_with_checksum(source, destination):
+    """
+    Copy a file block by block and return the number of bytes copied and their adler32 checksum (as used by EOS).
+
+    Parameters:
+    - source: Input file.
+    - destination: Output file.
+    """
+    checksum = 1
+    copied = 0
+    with open(source, "rb") as fin, open(destination, "wb") as fout:
+        while True:
+            block = fin.read(block_size)
+            if not block:
+                break
+            checksum = zlib.adler32(block, checksum)
+            copied += len(block)
+            fout.write(block)
+
+    return copied, f"{checksum:08x}"
+
+def file_checksum(path):
+    """
+    Return the adler32 checksum of a file.
+
+    Parameters:
+    - path: Input file.
+    """
+    checksum = 1
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            checksum = zlib.adler32(block, checksum)
+
+    return f"{checksum:08x}"
+
+class staging_cache:
+    """
+    Local copies of the input files, e.g. on the SSD of the node instead of EOS. The upcoming input files are copied in background threads
+    while the current file is being processed, and are reused by the following runs as long as the source file did not change and the
+    checksum of the copy matches the one computed while copying. The least recently used copies are evicted when the staging directory
+    exceeds its maximum size. Only paths on a (possibly mounted) file system can be staged; other paths (e.g. xrootd URLs) are read directly.
+    """
+
+    def __init__(self, stage_dir, max_size_gb=50., workers=2, verify=True):
+        self.stage_dir = stage_dir
+        self.max_size = max_size_gb * 1024**3
+        self.verify = verify
+        self.futures = dict()
+        self.in_use = set()
+        self.stats = {"reused": 0, "copied": 0, "failed": 0, "bytes": 0, "copy_time": 0., "wait_time": 0.}
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        os.makedirs(stage_dir, exist_ok=True)
+
+    def path(self, source):
+        """
+        Return the path of the local copy of a source file. The hash of the full source path avoids clashes between files with the same name.
+
+        Parameters:
+        - source: Source file.
+        """
+        return os.path.join(self.stage_dir, f"{hashlib.sha256(os.path.abspath(source).encode()).hexdigest()[:16]}_{os.path.basename(source)}")
+
+    def source_stamp(self, source):
+        """
+        Return the stamp of a source file: its copy is stale as soon as any of its fields changes.
+
+        Parameters:
+        - source: Source file.
+        """
+        stat = os.stat(source)
+        return {"version": STAGING_VERSION, "source": os.path.abspath(source), "size": stat.st_size, "mtime": stat.st_mtime}
+
+    def valid_copy(self, source, local_file):
+        """
+        Return True if the local copy of a source file exists, is up to date and (if verify is set) is not corrupted.
+
+        Parameters:
+        - source: Source file.
+        - local_file: Local copy.
+        """
+        if not (os.path.exists(local_file) and os.path.exists(f"{local_file}.json")):
+            return False
+        with open(f"{local_file}.json") as f:
+            stamp = json.load(f)
+        checksum = stamp.pop("checksum", None)
+        if not stamp == self.source_stamp(source) or not os.path.getsize(local_file) == stamp["size"]:
+            return False
+        if self.verify and not file_checksum(local_file) == checksum:
+            print(f"{Fore.YELLOW}Checksum mismatch, copying again: {local_file}{Style.RESET_ALL}")
+            return False
+
+        return True
+
+    def stage(self, source):
+        """
+        Copy a source file to the staging directory, unless a valid copy already exists. Return the path of the local copy.
+        Concurrent processes staging the same file wait for each other.
+
+        Parameters:
+        - source: Source file.
+        """
+        local_file = self.path(source)
+        with open(f"{local_file}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            if self.valid_copy(source, local_file):
+                os.utime(local_file) # Mark the copy as recently used
+                self.stats["reused"] += 1
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                return local_file
+
+            stamp = self.source_stamp(source)
+            self.evict(stamp["size"])
+            start = time.time()
+            tmp_file = f"{local_file}.{os.getpid()}.tmp"
+            copied, checksum = copy_with_checksum(source, tmp_file)
+            if not copied == stamp["size"]:
+                os.remove(tmp_file)
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                raise OSError(f"Incomplete copy of {source}: {copied} of {stamp['size']} bytes.")
+            os.replace(tmp_file, local_file)
+            with open(f"{local_file}.json", "w") as f:
+                json.dump(dict(stamp, checksum=checksum), f, indent=1)
+            self.stats["copy_time"] += time.time() - start
+            self.stats["bytes"] += copied
+            self.stats["copied"] += 1
+
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+        return local_file
+
+    def prefetch(self, sources):
+        """
+        Start copying source files in the background, unless they are already being copied.
+
+        Parameters:
+        - sources: List of source files.
+        """
+        for source in sources:
+            if source in self.futures or "://" in source:
+                continue
+            self.in_use.add(os.path.basename(self.path(source)))
+            self.futures[source] = self.pool.submit(self.stage, source)
+
+    def get(self, source):
+        """
+        Return the path of the local copy of a source file, waiting for its copy to finish (or copying it now if it was not prefetched).
+        The source file itself is returned if it cannot be staged.
+
+        Parameters:
+        - source: Source file.
+        """
+        if "://" in source:
+            return source
+        self.prefetch([source])
+        start = time.time()
+        try:
+            local_file = self.futures[source].result()
+        except OSError as error:
+            print(f"{Fore.YELLOW}Could not stage {source}, reading it directly: {error}{Style.RESET_ALL}")
+            self.stats["failed"] += 1
+            local_file = source
+        self.stats["wait_time"] += time.time() - start
+
+        return local_file
+
+    def release(self, source):
+        """
+        Allow the local copy of a source file to be evicted, once it has been processed.
+
+        Parameters:
+        - source: Source file.
+        """
+        self.in_use.discard(os.path.basename(self.path(source)))
+
+    def evict(self, needed=0):
+        """
+        Remove the least recently used copies (except the ones in use by this process) until the staging directory,
+        with the given number of bytes added, is smaller than its maximum size.
+
+        Parameters:
+        - needed: Number of bytes about to be added.
+        """
+        entries = []
+        for file_name in os.listdir(self.stage_dir):
+            if not file_name.endswith(".root") or file_name in self.in_use:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.stage_dir, file_name))
+            except FileNotFoundError: # Evicted by a concurrent process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_name))
+
+        total_size = sum([size for _, size, _ in entries]) + needed
+        for file_name in self.in_use:
+            try:
+                total_size += os.path.getsize(os.path.join(self.stage_dir, file_name))
+            except FileNotFoundError: # Not copied yet
+                pass
+        for _, size, file_name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            for path in [file_name, f"{file_name}.json"]:
+                try:
+                    os.remove(os.path.join(self.stage_dir, path))
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+
+    def close(self):
+        """
+        Wait for the copies in progress and stop the background threads.
+        """
+        self.pool.shutdown(wait=True)
+
+    def report(self):
+        """
+        Print the number of files reused and copied, and the time spent copying and waiting for the copies.
+        """
+        print(f"{Fore.YELLOW}Staging: {self.stats['reused']} files reused, {self.stats['copied']} copied ({self.stats['bytes'] / 1024**3:.2f} GB in {self.stats['copy_time']:.2f} s), "
+              f"{self.stats['failed']} read directly, {self.stats['wait_time']:.2f} s waiting for copies.{Style.RESET_ALL}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy the input ROOT files to a local staging directory, e.g. before a run.")
+    parser.add_argument("--input_dirs", nargs='+', required=True, help="List of directories where the ROOT files are fetched.")
+    parser.add_argument("--stage_dir", type=str, required=True, help="Local staging directory.")
+    parser.add_argument("--stage_max_size", type=float, default=50., required=False, help="Maximum size of the staging directory in GB.")
+    parser.add_argument("--workers", type=int, default=2, required=False, help="Number of files copied concurrently.")
+
+    args = parser.parse_args()
+
+    input_files = [infile for input_dir in args.input_dirs for infile in sorted(glob.glob(f"{input_dir}*.root"))]
+    staging = staging_cache(args.stage_dir, args.stage_max_size, args.workers)
+    staging.prefetch(input_files)
+    for infile in input_files:
+        print(f"Staged {infile} -> {Fore.GREEN}{staging.get(infile)}{Style.RESET_ALL}")
+    staging.close()
+    staging.report()
@@ -1,5 +1,56 @@
 import numpy as np
 
+# C++ function computing the event category, to be declared once with ROOT.gInterpreter.Declare.
+# Returns -1 for events failing the event classification selection, 0 for the SR, and 1-5 for the ttbb, ttbj, ttcc, ttcj, and ttLF CRs.
+# Ties in the weighted scores are not assigned to any CR, so the categories are mutually exclusive.
+event_category_declaration = """
+#ifndef VCB_EVENT_CATEGORY
+#define VCB_EVENT_CATEGORY
+namespace vcb {
+int event_category(double score_tt_Wcb, double score_ttbb, double score_ttbj, double score_ttcc, double score_ttcj, double score_ttLF,
+                   double score_tt_Wcb_min, double score_ttLF_max, double SR_score_tt_Wcb,
+                   double w_ttbb, double w_ttbj, double w_ttcc, double w_ttcj, double w_ttLF) {
+    if (!(score_tt_Wcb > score_tt_Wcb_min && score_ttLF < score_ttLF_max)) return -1;
+    if (score_tt_Wcb > SR_score_tt_Wcb) return 0;
+    if (!(score_tt_Wcb < SR_score_tt_Wcb)) return -1;
+    const double weighted_scores[5] = {w_ttbb * score_ttbb, w_ttbj * score_ttbj, w_ttcc * score_ttcc, w_ttcj * score_ttcj, w_ttLF * score_ttLF};
+    int best = 0;
+    for (int i = 1; i < 5; ++i) {
+        if (weighted_scores[i] > weighted_scores[best]) best = i;
+    }
+    for (int i = 0; i < 5; ++i) {
+        if (i != best && !(weighted_scores[best] > weighted_scores[i])) return -1;
+    }
+    return best + 1;
+}
+}
+#endif
+"""
+
+# Fractional scores of the tt+jets processes, defined as new columns by hdumper.py and prepareHistosForCards.py
+fscore_definitions = {
+    f"fscore_{process}" : f"score_{process} / (score_ttbb + score_ttbj + score_ttcc + score_ttcj + score_ttLF)"
+    for process in ["ttbb", "ttbj", "ttcc", "ttcj", "ttLF"]
+}
+
+# Kinematics of the four leading jets, defined as new columns by hdumper.py
+leading_jet_definitions = {
+    f"ak4_{idx+1}_{var}" : f"ak4_{var}.size() > {idx} ? ak4_{var}[{idx}] : 0"
+    for idx in range(4) for var in ["pt", "phi", "eta"]
+}
+
+def event_category_expression(weights, thresholds):
+    """
+    Return the expression defining the event_category column for a given set of weights and thresholds.
+
+    Parameters:
+    - weights: Dictionary {process : weight} for the ttbb, ttbj, ttcc, ttcj, and ttLF processes.
+    - thresholds: Dictionary with keys 'score_tt_Wcb_min', 'score_ttLF_max', 'SR_score_tt_Wcb'.
+    """
+    return (f"vcb::event_category(score_tt_Wcb, score_ttbb, score_ttbj, score_ttcc, score_ttcj, score_ttLF, "
+            f"{thresholds['score_tt_Wcb_min']}, {thresholds['score_ttLF_max']}, {thresholds['SR_score_tt_Wcb']}, "
+            f"{weights['ttbb']}, {weights['ttbj']}, {weights['ttcc']}, {weights['ttcj']}, {weights['ttLF']})")
+
 class weights_and_constants:
     """
     This class contains the weights and constants used in the analysis.
@@ -21,23 +72,38 @@ class weights_and_constants:
             "ttbj": 0.10
         }
 
+        # Event selections. The base selection is applied to every sample, the others select the tt+jets components of the ttbar samples.
+        self.event_selections = {
+            "base" : "n_ak4>=4 && (n_btagM+n_ctagM)>=3 && n_btagM>=1",
+            "ttbb" : " && genEventClassifier==9 && wcb==0",
+            "ttbj" : " && (genEventClassifier==7 || genEventClassifier==8) && wcb==0",
+            "ttcc" : " && genEventClassifier==6 && wcb==0",
+            "ttcj" : " && (genEventClassifier==4 || genEventClassifier==5) && wcb==0",
+            "ttLF" : " && tt_category==0 && higgs_decay==0 && wcb==0"
+        }
+
         # Define event classification selection and binning
 
         #################
         evtClassification_weights = self.weights_0p6ttWcb_and_0p1ttLF # Change here the set of weights to use
         #################
 
-        eventClassificationBaseSelection = "score_tt_Wcb > 0.6 && score_ttLF < 0.1"
-        SR_selection = "score_tt_Wcb > 0.85"
-        CR_selection = "score_tt_Wcb < 0.85"
+        # Event classification thresholds: events with score_tt_Wcb > 0.6 and score_ttLF < 0.1 are split into the SR (score_tt_Wcb > 0.85) and
+        # the CRs (score_tt_Wcb < 0.85), where they are assigned to the category of the process with the largest weighted score
+        self.eventClassification_thresholds = {
+            "score_tt_Wcb_min" : 0.6,
+            "score_ttLF_max"   : 0.1,
+            "SR_score_tt_Wcb"  : 0.85
+        }
+        self.event_category_expression = event_category_expression(evtClassification_weights, self.eventClassification_thresholds)
+
+        # The categories are split by the index in the event_category column, computed once per event
+        self.adhoc_category_index = {"score_tt_Wcb" : 0, "fscore_ttbb" : 1, "fscore_ttbj" : 2, "fscore_ttcc" : 3, "fscore_ttcj" : 4, "fscore_ttLF" : 5}
         self.adhoc_selection = {
-            "score_tt_Wcb" : f"{eventClassificationBaseSelection} && {SR_selection}",
-            "fscore_ttbb"  : f"{eventClassificationBaseSelection} && {CR_selection} && {evtClassification_weights['ttbb']} * score_ttbb > {evtClassification_weights['ttbj']} * score_ttbj && {evtClassification_weights['ttbb']} * score_ttbb > {evtClassification_weights['ttcc']} * score_ttcc && {evtClassification_weights['ttbb']} * score_ttbb > {evtClassification_weights['ttcj']} * score_ttcj && {evtClassification_weights['ttbb']} * score_ttbb > {evtClassification_weights['ttLF']} * score_ttLF",
-            "fscore_ttbj"  : f"{eventClassificationBaseSelection} && {CR_selection} && {evtClassification_weights['ttbj']} * score_ttbj > {evtClassification_weights['ttbb']} * score_ttbb && {evtClassification_weights['ttbj']} * score_ttbj > {evtClassification_weights['ttcc']} * score_ttcc && {evtClassification_weights['ttbj']} * score_ttbj > {evtClassification_weights['ttcj']} * score_ttcj && {evtClassification_weights['ttbj']} * score_ttbj > {evtClassification_weights['ttLF']} * score_ttLF",
-            "fscore_ttcc"  : f"{eventClassificationBaseSelection} && {CR_selection} && {evtClassification_weights['ttcc']} * score_ttcc > {evtClassification_weights['ttbb']} * score_ttbb && {evtClassification_weights['ttcc']} * score_ttcc > {evtClassification_weights['ttbj']} * score_ttbj && {evtClassification_weights['ttcc']} * score_ttcc > {evtClassification_weights['ttcj']} * score_ttcj && {evtClassification_weights['ttcc']} * score_ttcc > {evtClassification_weights['ttLF']} * score_ttLF",
-            "fscore_ttcj"  : f"{eventClassificationBaseSelection} && {CR_selection} && {evtClassification_weights['ttcj']} * score_ttcj > {evtClassification_weights['ttbb']} * score_ttbb && {evtClassification_weights['ttcj']} * score_ttcj > {evtClassification_weights['ttbj']} * score_ttbj && {evtClassification_weights['ttcj']} * score_ttcj > {evtClassification_weights['ttcc']} * score_ttcc && {evtClassification_weights['ttcj']} * score_ttcj > {evtClassification_weights['ttLF']} * score_ttLF",
-            "fscore_ttLF"  : f"{eventClassificationBaseSelection} && {CR_selection} && {evtClassification_weights['ttLF']} * score_ttLF > {evtClassification_weights['ttbb']} * score_ttbb && {evtClassification_weights['ttLF']} * score_ttLF > {evtClassification_weights['ttbj']} * score_ttbj && {evtClassification_weights['ttLF']} * score_ttLF > {evtClassification_weights['ttcc']} * score_ttcc && {evtClassification_weights['ttLF']} * score_ttLF > {evtClassification_weights['ttcj']} * score_ttcj"
+            score : f"event_category == {index}" for score, index in self.adhoc_category_index.items()
         }
+        # Process targeted by each category, used to compute its purity
+        self.adhoc_category_process = {"score_tt_Wcb" : "Wcb", "fscore_ttbb" : "ttbb", "fscore_ttbj" : "ttbj", "fscore_ttcc" : "ttcc", "fscore_ttcj" : "ttcj", "fscore_ttLF" : "ttLF"}
         self.adhoc_binning = {
             "score_tt_Wcb" : np.array([0.,0.9,1.]),
             "fscore_ttbb"  : np.array([0.,0.7,1.]),
@@ -46,7 +112,14 @@ class weights_and_constants:
             "fscore_ttcj"  : np.array([0.,0.35,1.]),
             "fscore_ttLF"  : np.array([0.,0.1,1.]),
         }
+        # Fine binning to fill the histograms once and rebin them later (see rebinHistos.py). All the edges of adhoc_binning must be edges of the fine binning.
+        self.adhoc_fine_binning = {score : np.linspace(0., 1., 101) for score in self.adhoc_binning}
 
 _wc_instance = weights_and_constants()
+event_selections = _wc_instance.event_selections
 adhoc_selection = _wc_instance.adhoc_selection
-adhoc_binning = _wc_instance.adhoc_binning
\ No newline at end of file
+adhoc_binning = _wc_instance.adhoc_binning
+adhoc_fine_binning = _wc_instance.adhoc_fine_binning
+adhoc_event_category = _wc_instance.event_category_expression
+adhoc_category_index = _wc_instance.adhoc_category_index
+adhoc_category_process = _wc_instance.adhoc_category_process
\ No newline at end of file